@@ -0,0 +1,165 @@
+"""
+Замер накладных расходов на запросы горячего пути.
+
+Создает синтетическую базу во временном каталоге и для каждого запроса
+сравнивает время вызова со сборкой конструкции select/update/insert заново
+(как было раньше) и с готовым запросом из реестра в database.py.
+
+Запуск: python -m bot.database.benchmark [--users N] [--iterations N]
+"""
+import argparse
+import asyncio
+import os
+import sys
+import tempfile
+import time
+from datetime import datetime, timedelta
+from pathlib import Path
+from typing import Callable, List, Optional, Tuple
+
+from sqlalchemy import insert, select, update
+
+
+def _cases(db, partition) -> List[Tuple[str, Callable[[int], tuple], Callable[[int], tuple]]]:
+    """
+    (название, вызов до, вызов после): по номеру вызова возвращают (запрос, параметры).
+
+    «До» — конструкция собирается заново на каждый вызов, как раньше в database.py,
+    «после» — готовый запрос из реестра с параметрами.
+    """
+    User, Subscription, StatsRollup, UserMessageStats = db.User, db.Subscription, db.StatsRollup, db.UserMessageStats
+    now = datetime.now()
+    message_row = {"user_telegram_id": 1_000_000, "chat_id": 1, "from_user_id": 1,
+                   "message_id": 1, "temp_message_id": 1}
+
+    def user_id(i: int) -> int:
+        return 1_000_000 + i
+
+    return [
+        ("get_user",
+         lambda i: (select(User).where(User.telegram_id == user_id(i)), None),
+         lambda i: (db._GET_USER, {"telegram_id": user_id(i)})),
+        ("get_subscription",
+         lambda i: (select(Subscription).where(Subscription.user_telegram_id == user_id(i)), None),
+         lambda i: (db._GET_SUBSCRIPTION, {"telegram_id": user_id(i)})),
+        ("get_message (партиция)",
+         lambda i: (select(partition).where(partition.c.message_id == i).limit(1), None),
+         lambda i: (db._partition_lookup_stmt(partition), {"message_id": i, "limit": 1})),
+        ("create_message (партиция)",
+         lambda i: (insert(partition).values(**message_row), None),
+         lambda i: (db._partition_insert_stmt(partition), message_row)),
+        ("increase_active_messages_count",
+         lambda i: (update(User).where(User.telegram_id == user_id(i)).values(
+             active_messages_count=User.active_messages_count + 1, last_message_time=now), None),
+         lambda i: (db._INCREASE_ACTIVE_MESSAGES, {"b_telegram_id": user_id(i), "b_now": now})),
+        ("increase_edited_messages_count",
+         lambda i: (update(User).where(User.telegram_id == user_id(i)).values(
+             edited_messages_count=User.edited_messages_count + 1), None),
+         lambda i: (db._INCREASE_EDITED_MESSAGES, {"b_telegram_id": user_id(i)})),
+        ("increase_deleted_messages_count",
+         lambda i: (update(User).where(User.telegram_id == user_id(i)).values(
+             deleted_messages_count=User.deleted_messages_count + 1, last_message_time=now
+         ).returning(User.deleted_messages_count), None),
+         lambda i: (db._INCREASE_DELETED_MESSAGES, {"b_telegram_id": user_id(i), "b_now": now})),
+        ("stats_rollup +1",
+         lambda i: (update(StatsRollup).where(StatsRollup.name == db.STAT_ACTIVE_MESSAGES).values(
+             value=StatsRollup.value + 1), None),
+         lambda i: (db._BUMP_STAT, {"stat_name": db.STAT_ACTIVE_MESSAGES, "delta": 1})),
+        ("update_user_channel_index",
+         lambda i: (update(User).where(User.telegram_id == user_id(i)).values(channel_index=i % 4), None),
+         lambda i: (db._UPDATE_CHANNEL_INDEX, {"b_telegram_id": user_id(i), "b_channel_index": i % 4})),
+        ("update_last_message_time",
+         lambda i: (update(User).where(User.telegram_id == user_id(i)).values(last_message_time=now), None),
+         lambda i: (db._UPDATE_LAST_MESSAGE_TIME, {"b_telegram_id": user_id(i), "b_now": now})),
+        ("increment_messages_count",
+         lambda i: (db.sqlite_insert(UserMessageStats).values(
+             from_user_id=user_id(i), to_user_id=2_000_000 + i % 50, messages_count=1
+         ).on_conflict_do_update(
+             index_elements=[UserMessageStats.from_user_id, UserMessageStats.to_user_id],
+             set_={"messages_count": UserMessageStats.messages_count + 1}
+         ), None),
+         lambda i: (db._INCREMENT_PAIR, {"from_id": user_id(i), "to_id": 2_000_000 + i % 50})),
+    ]
+
+
+async def _prepare(db, users: int):
+    await db.init_db()
+    now = datetime.now()
+    async with db.get_db_session() as session:
+        await session.execute(insert(db.User), [
+            {"telegram_id": 1_000_000 + i, "business_bot_active": True, "channel_index": 0,
+             "created_at": now, "last_message_time": now, "subscription_end_date": now + timedelta(days=30)}
+            for i in range(users)
+        ])
+        await session.execute(insert(db.Subscription), [
+            {"user_telegram_id": 1_000_000 + i, "end_date": now + timedelta(days=30)} for i in range(users)
+        ])
+    partition = await db._ensure_partition(db.Message.__table__, now)
+    async with db.get_db_session() as session:
+        await session.execute(insert(partition), [
+            {"user_telegram_id": 1_000_000 + i % users, "chat_id": i, "from_user_id": i,
+             "message_id": i, "temp_message_id": i}
+            for i in range(users * 10)
+        ])
+    return partition
+
+
+async def _measure(db, call: Callable[[int], tuple], iterations: int, users: int) -> Tuple[float, float]:
+    """
+    Время на вызов в микросекундах: только подготовка запроса и полный execute.
+
+    Подготовка — это сборка конструкции и вычисление ключа кэша компиляции
+    (у готового запроса из реестра ключ запоминается после первого вызова).
+    """
+    started = time.perf_counter()
+    for i in range(iterations):
+        stmt, _ = call(i % users)
+        stmt._generate_cache_key()
+    prepare_us = (time.perf_counter() - started) / iterations * 1_000_000
+
+    async with db.async_session() as session:
+        # Прогрев: первая компиляция не должна попадать в замер
+        for i in range(10):
+            await session.execute(*call(i % users))
+        started = time.perf_counter()
+        for i in range(iterations):
+            await session.execute(*call(i % users))
+        execute_us = (time.perf_counter() - started) / iterations * 1_000_000
+        await session.rollback()
+    return prepare_us, execute_us
+
+
+async def run(users: int, iterations: int):
+    import bot.database.database as db
+
+    partition = await _prepare(db, users)
+
+    print(f"Пользователей: {users}, вызовов на запрос: {iterations}")
+    print("Подготовка — сборка запроса и вычисление ключа кэша, execute — полный вызов, мкс\n")
+    print(f"{'запрос':<34}{'подготовка до/после':>22}{'execute до/после':>21}")
+    totals = [0.0, 0.0, 0.0, 0.0]
+    for name, before, after in _cases(db, partition):
+        before_prepare, before_execute = await _measure(db, before, iterations, users)
+        after_prepare, after_execute = await _measure(db, after, iterations, users)
+        for index, value in enumerate((before_prepare, after_prepare, before_execute, after_execute)):
+            totals[index] += value
+        print(f"{name:<34}{before_prepare:>11.1f} /{after_prepare:>8.1f}{before_execute:>11.1f} /{after_execute:>7.1f}")
+    print(f"{'итого за набор вызовов':<34}{totals[0]:>11.1f} /{totals[1]:>8.1f}{totals[2]:>11.1f} /{totals[3]:>7.1f}")
+    await db.engine.dispose()
+
+
+def main(argv: Optional[List[str]] = None):
+    parser = argparse.ArgumentParser(description="Замер запросов горячего пути на синтетической базе")
+    parser.add_argument("--users", type=int, default=10_000)
+    parser.add_argument("--iterations", type=int, default=2_000)
+    args = parser.parse_args(argv)
+
+    if "bot.database.database" in sys.modules:
+        parser.error("Модуль базы данных уже импортирован: замер должен запускаться отдельным процессом")
+    with tempfile.TemporaryDirectory() as directory:
+        os.environ["DATABASE_URL"] = f"sqlite+aiosqlite:///{Path(directory) / 'benchmark.db'}"
+        asyncio.run(run(args.users, args.iterations))
+
+
+if __name__ == "__main__":
+    main()
@@ -1,44 +1,102 @@
 from datetime import datetime, date, timedelta
 from contextlib import asynccontextmanager
-from typing import Optional, List, Dict, Any
+from dataclasses import dataclass
+from typing import Optional, List, Dict, Any, Callable, Awaitable, Tuple, AsyncIterator, Iterable
 import logging
 import asyncio
+import os
+import time
 
 from aiogram import Bot
-from sqlalchemy.ext.asyncio import create_async_engine, AsyncSession
+from sqlalchemy.ext.asyncio import create_async_engine, AsyncSession, AsyncConnection
 from sqlalchemy.ext.asyncio import async_sessionmaker
+from sqlalchemy import event, make_url
 from sqlalchemy import (
     ForeignKey, Column, Integer, String, BigInteger, Boolean, Date, DateTime,
-    func, select, update, delete, insert, and_, text, or_
+    Index, MetaData, Table, func, select, update, delete, insert, and_, text, or_, union_all, bindparam
 )
+from sqlalchemy.dialects.sqlite import insert as sqlite_insert
+from sqlalchemy.exc import OperationalError
+from sqlalchemy.schema import CreateTable
 from sqlalchemy.orm import declarative_base
-from async_lru import alru_cache
+
+from bot.utils.delivery import classify_delivery_error
+from bot.utils.metrics import registry
+from bot.utils.sqlprofile import sql_profiler
 
 # Настройка логирования
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
-# Настройка базы данных
-DATABASE_URL = "sqlite+aiosqlite:///database.db"
+# Настройка базы данных (DATABASE_URL можно переопределить переменной окружения,
+# например для замеров на синтетической базе)
+DATABASE_URL = os.getenv("DATABASE_URL", "sqlite+aiosqlite:///database.db")
 Base = declarative_base()
 engine = create_async_engine(DATABASE_URL)
 async_session = async_sessionmaker(engine, class_=AsyncSession, expire_on_commit=False)
 
+# Отдельный пул только для чтения под отчеты и аналитику админки. В режиме WAL
+# чтение идет по снимку базы и не мешает записи: тяжелый агрегирующий запрос
+# не задерживает коммиты архивации сообщений. Соединения открываются с mode=ro,
+# а query_only дополнительно запрещает запись на уровне SQLite.
+READ_DATABASE_URL = make_url(DATABASE_URL).set(
+    database=f"file:{make_url(DATABASE_URL).database}",
+    query={"mode": "ro", "uri": "true"}
+)
+read_engine = create_async_engine(READ_DATABASE_URL)
+read_session = async_sessionmaker(read_engine, class_=AsyncSession, expire_on_commit=False)
+
+@event.listens_for(engine.sync_engine, "connect")
+def _enable_wal(dbapi_connection, connection_record):
+    cursor = dbapi_connection.cursor()
+    cursor.execute("PRAGMA journal_mode=WAL")
+    cursor.close()
+
+@event.listens_for(read_engine.sync_engine, "connect")
+def _enable_query_only(dbapi_connection, connection_record):
+    cursor = dbapi_connection.cursor()
+    cursor.execute("PRAGMA query_only=ON")
+    cursor.close()
+
+DB_QUERY_SECONDS = registry.histogram(
+    "bot_db_query_seconds", "Длительность SQL-запросов", ["engine", "operation"]
+)
+DB_ERRORS = registry.counter("bot_db_errors_total", "Ошибки в сессиях базы данных")
+
+def _instrument(sync_engine, engine_name: str):
+    """Замер каждого запроса: время от отправки курсору до получения результата."""
+    @event.listens_for(sync_engine, "before_cursor_execute")
+    def _before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+        # Запросы на одном соединении не вкладываются друг в друга, хватает одного значения
+        conn.info["query_started"] = time.perf_counter()
+
+    @event.listens_for(sync_engine, "after_cursor_execute")
+    def _after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+        started = conn.info.pop("query_started", None)
+        if started is not None:
+            operation = statement.lstrip().split(None, 1)[0].upper() if statement.strip() else "?"
+            elapsed = time.perf_counter() - started
+            DB_QUERY_SECONDS.observe(elapsed, engine=engine_name, operation=operation)
+            sql_profiler.record(statement, elapsed)
+
+_instrument(engine.sync_engine, "write")
+_instrument(read_engine.sync_engine, "read")
+
 # Модели базы данных
 class User(Base):
     __tablename__ = 'users'
 
     id = Column(Integer, primary_key=True, autoincrement=True)
     telegram_id = Column(BigInteger, nullable=False, unique=True)
-    business_bot_active = Column(Boolean, nullable=False, default=False)
-    subscription_end_date = Column(DateTime, nullable=True)
+    business_bot_active = Column(Boolean, nullable=False, default=False, index=True)
+    subscription_end_date = Column(DateTime, nullable=True, index=True)
     active_messages_count = Column(Integer, nullable=False, default=0)
     edited_messages_count = Column(Integer, nullable=False, default=0)
     deleted_messages_count = Column(Integer, nullable=False, default=0)
     channel_index = Column(Integer, nullable=False, default=0)
     is_banned = Column(Boolean, nullable=False, default=False)
     ban_reason = Column(String, nullable=True)
-    username = Column(String, nullable=True)
+    username = Column(String, nullable=True, index=True)
     first_name = Column(String, nullable=True)
     created_at = Column(DateTime, default=datetime.now)
     notifications_enabled = Column(Boolean, default=True)
@@ -52,8 +110,22 @@ class User(Base):
     last_farm_time = Column(DateTime, default=datetime.now)
     module_calc_enabled = Column(Boolean, default=False) #Added
     module_love_enabled = Column(Boolean, default=False) #Added
-
-    __table_args__ = {'extend_existing': True}
+    # Доставка невозможна (бот заблокирован, аккаунт удален, чат не найден):
+    # такие пользователи пропускаются в рассылках и напоминаниях до следующего /start.
+    # Индекс SQLite неявно содержит rowid (id), поэтому он же обслуживает
+    # постраничный обход WHERE is_reachable AND id > ? ORDER BY id.
+    is_reachable = Column(Boolean, nullable=False, default=True, index=True)
+    unreachable_reason = Column(String, nullable=True)
+    # Дата окончания последней истекшей подписки: subscription_end_date при истечении
+    # сбрасывается, а по этой колонке отбираются недавно потерянные подписчики
+    last_subscription_end_date = Column(DateTime, nullable=True, index=True)
+
+    __table_args__ = (
+        # Сегмент рассылок «неактивны с даты»: оценка и страницы получателей
+        # отбираются диапазоном по этому индексу, а не обходом всей таблицы
+        Index("ix_users_is_reachable_last_message_time", "is_reachable", "last_message_time"),
+        {'extend_existing': True},
+    )
 
 
 class Message(Base):
@@ -63,7 +135,7 @@ class Message(Base):
     user_telegram_id = Column(BigInteger, ForeignKey("users.telegram_id"), nullable=False)
     chat_id = Column(BigInteger, nullable=False)
     from_user_id = Column(BigInteger, nullable=False)
-    message_id = Column(BigInteger, nullable=False)
+    message_id = Column(BigInteger, nullable=False, index=True)
     temp_message_id = Column(BigInteger, nullable=False)
 
 class MessageEditHistory(Base):
@@ -71,7 +143,7 @@ class MessageEditHistory(Base):
 
     id = Column(Integer, primary_key=True, autoincrement=True)
     user_telegram_id = Column(BigInteger, ForeignKey("users.telegram_id"), nullable=False)
-    message_id = Column(BigInteger, ForeignKey("messages.message_id"), nullable=False)
+    message_id = Column(BigInteger, ForeignKey("messages.message_id"), nullable=False, index=True)
     chat_id = Column(BigInteger, nullable=False)
     from_user_id = Column(BigInteger, nullable=False)
     temp_message_id = Column(BigInteger, nullable=False)
@@ -82,7 +154,7 @@ class Subscription(Base):
 
     id = Column(Integer, primary_key=True, autoincrement=True)
     user_telegram_id = Column(BigInteger, ForeignKey("users.telegram_id"), nullable=False)
-    end_date = Column(Date, nullable=False)
+    end_date = Column(Date, nullable=False, index=True)
 
 class Settings(Base):
     __tablename__ = 'settings'
@@ -95,9 +167,168 @@ class UserMessageStats(Base):
 
     id = Column(Integer, primary_key=True, autoincrement=True)
     from_user_id = Column(BigInteger, ForeignKey("users.telegram_id"), nullable=False)
-    to_user_id = Column(BigInteger, ForeignKey("users.telegram_id"), nullable=False)
+    to_user_id = Column(BigInteger, ForeignKey("users.telegram_id"), nullable=False, index=True)
     messages_count = Column(Integer, default=0, nullable=False)
 
+    # Одна строка на пару: на этом индексе держится UPSERT в increment_messages_count
+    __table_args__ = (
+        Index('ux_user_message_stats_pair', 'from_user_id', 'to_user_id', unique=True),
+    )
+
+class StatsRollup(Base):
+    __tablename__ = 'stats_rollup'
+
+    name = Column(String, primary_key=True, nullable=False)
+    value = Column(Integer, nullable=False, default=0)
+
+# Временные ряды активности. bucket — unix-время (UTC) начала интервала в секундах:
+# целые числа дешевле сравнивать и округлять до часа/суток прямо в SQL.
+class ActivityHourly(Base):
+    __tablename__ = 'activity_hourly'
+
+    user_telegram_id = Column(BigInteger, primary_key=True)
+    bucket = Column(Integer, primary_key=True, index=True)
+    new_count = Column(Integer, nullable=False, default=0)
+    edited_count = Column(Integer, nullable=False, default=0)
+    deleted_count = Column(Integer, nullable=False, default=0)
+
+class ActivityUserDaily(Base):
+    """Почасовые данные пользователя, прореженные до суток после истечения срока хранения."""
+    __tablename__ = 'activity_user_daily'
+
+    user_telegram_id = Column(BigInteger, primary_key=True)
+    bucket = Column(Integer, primary_key=True)
+    new_count = Column(Integer, nullable=False, default=0)
+    edited_count = Column(Integer, nullable=False, default=0)
+    deleted_count = Column(Integer, nullable=False, default=0)
+
+class ActivityDaily(Base):
+    __tablename__ = 'activity_daily'
+
+    bucket = Column(Integer, primary_key=True)
+    new_count = Column(Integer, nullable=False, default=0)
+    edited_count = Column(Integer, nullable=False, default=0)
+    deleted_count = Column(Integer, nullable=False, default=0)
+
+class Broadcast(Base):
+    """Рассылка с сохраненным прогрессом: после перезапуска продолжается с cursor."""
+    __tablename__ = 'broadcasts'
+
+    id = Column(Integer, primary_key=True, autoincrement=True)
+    text = Column(String, nullable=False)
+    status = Column(String, nullable=False, default="running", index=True)
+    # users.id последнего обработанного пользователя
+    cursor = Column(Integer, nullable=False, default=0)
+    total = Column(Integer, nullable=False, default=0)
+    sent = Column(Integer, nullable=False, default=0)
+    failed = Column(Integer, nullable=False, default=0)
+    admin_chat_id = Column(BigInteger, nullable=False)
+    progress_message_id = Column(BigInteger, nullable=True)
+    # Сегмент аудитории и его параметр (см. BROADCAST_SEGMENTS в bot.services.broadcast)
+    segment = Column(String, nullable=False, default="all")
+    segment_param = Column(String, nullable=True)
+    created_at = Column(DateTime, nullable=False)
+    finished_at = Column(DateTime, nullable=True)
+
+class ChatTask(Base):
+    """Описание длительной задачи в чате (анимации): по нему задача возобновляется после перезапуска."""
+    __tablename__ = 'chat_tasks'
+
+    business_connection_id = Column(String, primary_key=True)
+    chat_id = Column(BigInteger, primary_key=True)
+    kind = Column(String, primary_key=True)
+    owner_id = Column(BigInteger, nullable=False, index=True)
+    # Параметры задачи в JSON
+    params = Column(String, nullable=False, default="{}")
+    created_at = Column(DateTime, nullable=False, default=datetime.now)
+
+BROADCAST_RUNNING = "running"
+BROADCAST_DONE = "done"
+BROADCAST_CANCELLED = "cancelled"
+BROADCAST_FAILED = "failed"
+
+ACTIVITY_HOUR = 3600
+ACTIVITY_DAY = 86400
+ACTIVITY_COLUMNS = ("new_count", "edited_count", "deleted_count")
+
+# Счетчики сводной статистики. Обновляются инкрементально в тех же транзакциях,
+# что и изменения пользователей и подписок, поэтому чтение статистики — O(1).
+STAT_TOTAL_USERS = "total_users"
+STAT_TOTAL_SUBSCRIPTIONS = "total_subscriptions"
+STAT_ACTIVE_BUSINESS_BOTS = "total_users_with_active_business_bot"
+STAT_ACTIVE_MESSAGES = "total_active_messages"
+STAT_EDITED_MESSAGES = "total_edited_messages"
+STAT_DELETED_MESSAGES = "total_deleted_messages"
+STATS_ROLLUP_NAMES = (
+    STAT_TOTAL_USERS,
+    STAT_TOTAL_SUBSCRIPTIONS,
+    STAT_ACTIVE_BUSINESS_BOTS,
+    STAT_ACTIVE_MESSAGES,
+    STAT_EDITED_MESSAGES,
+    STAT_DELETED_MESSAGES,
+)
+
+def _bump_stat(name: str, delta: int = 1):
+    """Запрос на изменение счетчика сводной статистики на delta."""
+    return update(StatsRollup).where(StatsRollup.name == name).values(value=StatsRollup.value + delta)
+
+# Запросы горячего пути (выполняются на каждое бизнес-сообщение) собраны один раз
+# при импорте с именованными параметрами. Конструкция запроса не пересобирается
+# на каждый вызов, ключ кэша вычисляется однажды и запоминается в объекте, а
+# скомпилированный SQL берется из кэша движка; значения передаются словарем
+# параметров в execute. В UPDATE имена параметров с префиксом b_, так как имена
+# колонок зарезервированы SQLAlchemy. Замеры: python -m bot.database.benchmark
+_GET_USER = select(User).where(User.telegram_id == bindparam("telegram_id"))
+_GET_SUBSCRIPTION = select(Subscription).where(Subscription.user_telegram_id == bindparam("telegram_id"))
+_BUMP_STAT = (
+    update(StatsRollup)
+    .where(StatsRollup.name == bindparam("stat_name"))
+    .values(value=StatsRollup.value + bindparam("delta"))
+)
+_INCREASE_ACTIVE_MESSAGES = (
+    update(User)
+    .where(User.telegram_id == bindparam("b_telegram_id"))
+    .values(active_messages_count=User.active_messages_count + 1, last_message_time=bindparam("b_now"))
+)
+_INCREASE_EDITED_MESSAGES = (
+    update(User)
+    .where(User.telegram_id == bindparam("b_telegram_id"))
+    .values(edited_messages_count=User.edited_messages_count + 1)
+)
+_INCREASE_DELETED_MESSAGES = (
+    update(User)
+    .where(User.telegram_id == bindparam("b_telegram_id"))
+    .values(deleted_messages_count=User.deleted_messages_count + 1, last_message_time=bindparam("b_now"))
+    .returning(User.deleted_messages_count)
+)
+_UPDATE_CHANNEL_INDEX = (
+    update(User)
+    .where(User.telegram_id == bindparam("b_telegram_id"))
+    .values(channel_index=bindparam("b_channel_index"))
+)
+_UPDATE_LAST_MESSAGE_TIME = (
+    update(User)
+    .where(User.telegram_id == bindparam("b_telegram_id"))
+    .values(last_message_time=bindparam("b_now"))
+)
+_INCREMENT_PAIR = (
+    sqlite_insert(UserMessageStats)
+    .values(from_user_id=bindparam("from_id"), to_user_id=bindparam("to_id"), messages_count=1)
+    .on_conflict_do_update(
+        index_elements=[UserMessageStats.from_user_id, UserMessageStats.to_user_id],
+        set_={"messages_count": UserMessageStats.messages_count + 1}
+    )
+)
+
+def _counts_as_active_business_bot(user: User) -> bool:
+    """Учитывается ли пользователь в счетчике активных бизнес-ботов."""
+    return bool(
+        user.business_bot_active
+        and not user.is_banned
+        and user.subscription_end_date
+        and user.subscription_end_date > datetime.now()
+    )
+
 # Контекстный менеджер для управления сессиями
 @asynccontextmanager
 async def get_db_session():
@@ -107,6 +338,7 @@ async def get_db_session():
             await session.commit()
         except Exception as e:
             await session.rollback()
+            DB_ERRORS.inc()
             logger.error(f"🔴 Ошибка базы данных: {str(e)}")
             await asyncio.sleep(1)  # Пауза перед повторной попыткой
             try:
@@ -115,19 +347,28 @@ async def get_db_session():
                 logger.critical(f"❌ Критическая ошибка БД: {str(retry_error)}")
                 raise
 
+@asynccontextmanager
+async def get_read_session():
+    """Сессия пула только для чтения: для отчетов, статистики и выгрузок."""
+    async with read_session() as session:
+        yield session
+
 # Инициализация базы данных
 async def init_db():
-    async with engine.begin() as conn:
-        await conn.run_sync(Base.metadata.create_all)
-    await create_default_settings()
+    """
+    Подготовить базу данных к работе.
+
+    Создание таблиц, колонок, индексов и настроек по умолчанию выполняется
+    версионированными миграциями (см. migrate_db), поэтому на актуальной схеме
+    запуск стоит одного чтения таблицы schema_version.
+    """
+    await migrate_db()
 
 # Создание настроек по умолчанию
-async def create_default_settings():
-    async with get_db_session() as session:
-        if await session.scalar(select(Settings).where(Settings.name == "subscription_price")) is None:
-            await session.execute(
-                insert(Settings).values(name="subscription_price", value="30")
-            )
+async def create_default_settings(conn: AsyncConnection):
+    await conn.execute(
+        text("INSERT OR IGNORE INTO settings (name, value) VALUES ('subscription_price', '30')")
+    )
 
 # Операции с пользователями
 async def create_user(telegram_id: int, username: str = None, first_name: str = None, business_bot_active: bool = False) -> User:
@@ -151,6 +392,7 @@ async def create_user(telegram_id: int, username: str = None, first_name: str =
                 online_enabled=True # Модуль онлайн включен по умолчанию
             )
             session.add(user)
+            await session.execute(_bump_stat(STAT_TOTAL_USERS))
             await session.commit()
             return user
     except Exception as e:
@@ -165,7 +407,133 @@ async def get_user(telegram_id: int) -> Optional[User]:
     :return: Объект User или None, если пользователь не найден.
     """
     async with get_db_session() as session:
-        return await session.scalar(select(User).where(User.telegram_id == telegram_id))
+        return await session.scalar(_GET_USER, {"telegram_id": telegram_id})
+
+# Размер страницы при обходе пользователей
+USERS_BATCH_SIZE = 500
+
+@dataclass
+class UserFilter:
+    """
+    Условия отбора пользователей для iter_users.
+
+    None в поле означает, что условие не применяется.
+    """
+    is_banned: Optional[bool] = None
+    active_subscription: Optional[bool] = None
+    business_bot_active: Optional[bool] = None
+    inactive_since: Optional[datetime] = None
+    is_reachable: Optional[bool] = None
+    # Подписка истекла не раньше этой даты и не продлена
+    subscription_expired_since: Optional[datetime] = None
+    # Нет ни действующей, ни сохраненной истекшей подписки. Подписки, истекшие до
+    # миграции 9, дат не сохранили, и такие пользователи тоже сюда попадают
+    never_subscribed: Optional[bool] = None
+
+    def conditions(self) -> List[Any]:
+        conditions = []
+        if self.is_banned is not None:
+            conditions.append(User.is_banned == self.is_banned)
+        if self.active_subscription is not None:
+            active = User.subscription_end_date > datetime.now()
+            conditions.append(
+                active if self.active_subscription
+                else or_(User.subscription_end_date.is_(None), ~active)
+            )
+        if self.business_bot_active is not None:
+            conditions.append(User.business_bot_active == self.business_bot_active)
+        if self.inactive_since is not None:
+            conditions.append(User.last_message_time < self.inactive_since)
+        if self.is_reachable is not None:
+            conditions.append(User.is_reachable == self.is_reachable)
+        if self.subscription_expired_since is not None:
+            conditions.append(User.last_subscription_end_date >= self.subscription_expired_since)
+            conditions.append(User.subscription_end_date.is_(None))
+        if self.never_subscribed is not None:
+            never = and_(User.subscription_end_date.is_(None), User.last_subscription_end_date.is_(None))
+            conditions.append(never if self.never_subscribed else ~never)
+        return conditions
+
+async def iter_user_batches(user_filter: Optional[UserFilter] = None, batch_size: int = USERS_BATCH_SIZE,
+                            after_id: int = 0) -> AsyncIterator[List[User]]:
+    """
+    Обойти пользователей страницами по первичному ключу.
+
+    Каждая страница читается отдельным коротким запросом вида id > последний_id,
+    поэтому в памяти держится не больше batch_size пользователей, а долгое
+    чтение не удерживает базу, пока вызывающий код, например, рассылает сообщения.
+
+    :param user_filter: Условия отбора пользователей.
+    :param batch_size: Количество пользователей на странице.
+    :param after_id: Начать с пользователей, у которых users.id больше этого значения.
+    """
+    user_filter = user_filter or UserFilter()
+    conditions = user_filter.conditions()
+    # Обход по первичному ключу для отбора по дате последнего сообщения пришлось бы
+    # вести через всю таблицу: id + 0 исключает его из плана, и страница берется
+    # диапазоном по индексу ix_users_is_reachable_last_message_time с сортировкой найденного
+    keyset = User.id + 0 if user_filter.inactive_since is not None else User.id
+    last_id = after_id
+    while True:
+        async with get_db_session() as session:
+            result = await session.execute(
+                select(User)
+                .where(keyset > last_id, *conditions)
+                .order_by(User.id)
+                .limit(batch_size)
+            )
+            users = result.scalars().all()
+        if users:
+            yield users
+        if len(users) < batch_size:
+            return
+        last_id = users[-1].id
+
+async def iter_users(user_filter: Optional[UserFilter] = None,
+                     batch_size: int = USERS_BATCH_SIZE) -> AsyncIterator[User]:
+    """
+    Обойти пользователей по одному (страницами по batch_size, см. iter_user_batches).
+
+    :param user_filter: Условия отбора пользователей.
+    :param batch_size: Количество пользователей на странице.
+    """
+    async for users in iter_user_batches(user_filter, batch_size):
+        for user in users:
+            yield user
+
+async def mark_users_unreachable(reasons: Dict[int, str]):
+    """
+    Отметить пользователей, которым невозможно доставить сообщение.
+
+    :param reasons: Telegram ID -> причина (UNREACHABLE_* из bot.utils.delivery).
+    """
+    if not reasons:
+        return
+    async with get_db_session() as session:
+        await session.execute(
+            # Core-таблица: ORM трактует список параметров как обновление по первичному ключу
+            update(User.__table__)
+            .where(User.__table__.c.telegram_id == bindparam("b_telegram_id"))
+            .values(is_reachable=False, unreachable_reason=bindparam("b_reason")),
+            [{"b_telegram_id": telegram_id, "b_reason": reason} for telegram_id, reason in reasons.items()]
+        )
+    logger.info(f"Отмечено недоступных пользователей: {len(reasons)}")
+
+async def mark_user_reachable(telegram_id: int):
+    """Снова включить пользователя в рассылки (например, после /start)."""
+    async with get_db_session() as session:
+        await session.execute(
+            update(User)
+            .where(User.telegram_id == telegram_id, User.is_reachable == False)
+            .values(is_reachable=True, unreachable_reason=None)
+        )
+
+async def count_users(user_filter: Optional[UserFilter] = None) -> int:
+    """Количество пользователей, подходящих под условия."""
+    async with get_read_session() as session:
+        return await session.scalar(
+            select(func.count(User.id)).where(*(user_filter or UserFilter()).conditions())
+        )
 
 async def update_user_business_bot_active(telegram_id: int, business_bot_active: bool):
     """
@@ -175,11 +543,155 @@ async def update_user_business_bot_active(telegram_id: int, business_bot_active:
     :param business_bot_active: Новый статус бизнес-бота.
     """
     async with get_db_session() as session:
-        await session.execute(
-            update(User).where(User.telegram_id == telegram_id).values(business_bot_active=business_bot_active)
+        result = await session.execute(
+            update(User)
+            .where(User.telegram_id == telegram_id, User.business_bot_active != business_bot_active)
+            .values(business_bot_active=business_bot_active)
         )
+        if result.rowcount:
+            # В счетчике учитываются только незаблокированные пользователи с подпиской
+            await session.execute(
+                _bump_stat(STAT_ACTIVE_BUSINESS_BOTS, 1 if business_bot_active else -1)
+                .where(
+                    select(User.id)
+                    .where(
+                        User.telegram_id == telegram_id,
+                        User.is_banned == False,
+                        User.subscription_end_date > datetime.now()
+                    )
+                    .exists()
+                )
+            )
 
 # Операции с сообщениями
+#
+# Сообщения и история правок хранятся в помесячных таблицах-партициях
+# (messages_YYYYMM, message_edit_history_YYYYMM): новые строки пишутся в партицию
+# текущего месяца, поиск идет от новых партиций к старым, а устаревшие месяцы
+# удаляются целиком через DROP TABLE, без построчного DELETE и раздувания индексов.
+# Строки, записанные в исходные таблицы messages и message_edit_history до
+# разбиения, миграция 12 перенесла в партиции, и теперь эти таблицы пустые.
+# id сквозные для всех партиций таблицы: новая партиция создается с AUTOINCREMENT
+# и начинает нумерацию выше максимального id предыдущих.
+# Внешние ключи в партициях не объявляются: SQLite их не проверяет, а ключ истории
+# правок на messages.message_id и так не мог ссылаться на несколько таблиц.
+MESSAGE_RETENTION_MONTHS = 6
+PARTITIONED_TABLES = (Message.__table__, MessageEditHistory.__table__)
+
+_partition_metadata = MetaData()
+_partitions: Dict[str, List[str]] = {}
+# Заранее собранные запросы к партициям: (таблица, вид запроса) -> запрос
+_partition_statements: Dict[Tuple[str, str], Any] = {}
+_partitions_lock = asyncio.Lock()
+
+def _partition_name(base: Table, moment: datetime) -> str:
+    return f"{base.name}_{moment.strftime('%Y%m')}"
+
+def _partition_table(base: Table, name: str) -> Table:
+    """Описание таблицы-партиции с колонками и индексами исходной таблицы."""
+    table = _partition_metadata.tables.get(name)
+    if table is not None:
+        return table
+    table = Table(
+        name,
+        _partition_metadata,
+        *(Column(column.name, column.type, primary_key=column.primary_key, nullable=column.nullable)
+          for column in base.columns),
+        sqlite_autoincrement=True
+    )
+    for index in base.indexes:
+        columns = [column.name for column in index.columns]
+        Index(f"ix_{name}_{'_'.join(columns)}", *(table.c[column] for column in columns), unique=index.unique)
+    return table
+
+def _partition_lookup_stmt(table: Table):
+    key = (table.name, "lookup")
+    stmt = _partition_statements.get(key)
+    if stmt is None:
+        stmt = _partition_statements[key] = (
+            select(table).where(table.c.message_id == bindparam("message_id")).limit(bindparam("limit"))
+        )
+    return stmt
+
+def _partition_insert_stmt(table: Table):
+    key = (table.name, "insert")
+    stmt = _partition_statements.get(key)
+    if stmt is None:
+        stmt = _partition_statements[key] = insert(table)
+    return stmt
+
+async def _get_partitions(base: Table) -> List[str]:
+    """Имена партиций таблицы от новых к старым (загружаются из базы один раз)."""
+    partitions = _partitions.get(base.name)
+    if partitions is None:
+        async with engine.connect() as conn:
+            result = await conn.execute(
+                text("SELECT name FROM sqlite_master WHERE type = 'table' AND name GLOB :pattern"),
+                {"pattern": f"{base.name}_[0-9][0-9][0-9][0-9][0-9][0-9]"}
+            )
+            partitions = _partitions[base.name] = sorted(result.scalars(), reverse=True)
+    return partitions
+
+async def _ensure_partition(base: Table, moment: datetime) -> Table:
+    """Партиция для даты; создается в отдельной транзакции при первом обращении."""
+    name = _partition_name(base, moment)
+    table = _partition_table(base, name)
+    if name in await _get_partitions(base):
+        return table
+    async with _partitions_lock:
+        if name not in _partitions[base.name]:
+            async with engine.begin() as conn:
+                await conn.run_sync(lambda sync_conn: table.create(sync_conn, checkfirst=True))
+                await _seed_partition_ids(conn, table, [base.name, *_partitions[base.name]])
+            _partitions[base.name] = sorted([*_partitions[base.name], name], reverse=True)
+            logger.info(f"Создана партиция {name}")
+    return table
+
+async def _max_id(conn: AsyncConnection, tables: List[str]) -> int:
+    """Наибольший id среди таблиц (0, если строк нет)."""
+    if not tables:
+        return 0
+    union = " UNION ALL ".join(f"SELECT max(id) AS id FROM {name}" for name in tables)
+    return await conn.scalar(text(f"SELECT coalesce(max(id), 0) FROM ({union})"))
+
+async def _seed_partition_ids(conn: AsyncConnection, table: Table, previous: List[str]):
+    """Начать нумерацию новой партиции выше id предыдущих, чтобы id не пересекались."""
+    seq = await _max_id(conn, previous)
+    await conn.execute(
+        text("INSERT INTO sqlite_sequence (name, seq) SELECT :name, :seq "
+             "WHERE NOT EXISTS (SELECT 1 FROM sqlite_sequence WHERE name = :name)"),
+        {"name": table.name, "seq": seq}
+    )
+
+async def get_partition_tables(base: Table) -> List[Table]:
+    """
+    Все таблицы, в которых хранятся строки таблицы base, от старых к новым.
+
+    Для таблиц без разбиения возвращается только сама таблица.
+    """
+    if base not in PARTITIONED_TABLES:
+        return [base]
+    partitions = await _get_partitions(base)
+    return [base, *(_partition_table(base, name) for name in reversed(partitions))]
+
+async def _find_in_partitions(session, base: Table, message_id: int, limit: int = -1) -> List[Any]:
+    """
+    Строки с данным message_id, от новых партиций к старым.
+
+    limit = -1 означает «без ограничения» (так LIMIT трактует SQLite).
+    """
+    rows = []
+    tables = [_partition_table(base, name) for name in await _get_partitions(base)]
+    for table in tables:
+        result = await session.execute(
+            _partition_lookup_stmt(table),
+            {"message_id": message_id, "limit": limit - len(rows) if limit >= 0 else -1}
+        )
+        rows.extend(result.mappings())
+        if 0 <= limit <= len(rows):
+            break
+    return rows
+
 async def create_message(user_telegram_id: int, chat_id: int, from_user_id: int, message_id: int, temp_message_id: int) -> Message:
     """
     Создать новое сообщение.
@@ -191,16 +703,17 @@ async def create_message(user_telegram_id: int, chat_id: int, from_user_id: int,
     :param temp_message_id: Временный ID сообщения.
     :return: Созданное сообщение.
     """
+    values = dict(
+        user_telegram_id=user_telegram_id,
+        chat_id=chat_id,
+        from_user_id=from_user_id,
+        message_id=message_id,
+        temp_message_id=temp_message_id
+    )
+    table = await _ensure_partition(Message.__table__, datetime.now())
     async with get_db_session() as session:
-        message = Message(
-            user_telegram_id=user_telegram_id,
-            chat_id=chat_id,
-            from_user_id=from_user_id,
-            message_id=message_id,
-            temp_message_id=temp_message_id
-        )
-        session.add(message)
-        return message
+        result = await session.execute(_partition_insert_stmt(table), values)
+        return Message(id=result.inserted_primary_key[0], **values)
 
 async def get_message(message_id: int) -> Optional[Message]:
     """
@@ -210,20 +723,99 @@ async def get_message(message_id: int) -> Optional[Message]:
     :return: Объект Message или None, если сообщение не найдено.
     """
     async with get_db_session() as session:
-        return await session.scalar(select(Message).where(Message.message_id == message_id))
+        rows = await _find_in_partitions(session, Message.__table__, message_id, limit=1)
+    return Message(**rows[0]) if rows else None
+
+async def create_message_edit(user_telegram_id: int, chat_id: int, from_user_id: int, message_id: int,
+                              temp_message_id: int, date: Optional[datetime] = None) -> MessageEditHistory:
+    """
+    Сохранить версию отредактированного сообщения.
+
+    :param user_telegram_id: ID пользователя в Telegram.
+    :param chat_id: ID чата.
+    :param from_user_id: ID отправителя.
+    :param message_id: ID сообщения.
+    :param temp_message_id: ID копии версии в канале.
+    :param date: Время правки (по умолчанию текущее).
+    :return: Созданная запись истории.
+    """
+    values = dict(
+        user_telegram_id=user_telegram_id,
+        chat_id=chat_id,
+        from_user_id=from_user_id,
+        message_id=message_id,
+        temp_message_id=temp_message_id,
+        date=date or datetime.now()
+    )
+    table = await _ensure_partition(MessageEditHistory.__table__, values["date"])
+    async with get_db_session() as session:
+        result = await session.execute(_partition_insert_stmt(table), values)
+        return MessageEditHistory(id=result.inserted_primary_key[0], **values)
+
+async def get_message_edits(message_id: int) -> List[MessageEditHistory]:
+    """
+    Получить историю правок сообщения, от новых версий к старым.
+
+    :param message_id: ID сообщения.
+    """
+    async with get_db_session() as session:
+        rows = await _find_in_partitions(session, MessageEditHistory.__table__, message_id)
+    return sorted((MessageEditHistory(**row) for row in rows), key=lambda edit: edit.date, reverse=True)
+
+async def drop_old_message_partitions(keep_months: int = MESSAGE_RETENTION_MONTHS) -> List[str]:
+    """
+    Удалить целиком партиции сообщений старше срока хранения.
+
+    :param keep_months: Сколько последних месяцев хранить, включая текущий.
+    :return: Имена удаленных таблиц.
+    """
+    now = datetime.now()
+    month_index = now.year * 12 + now.month - 1 - (keep_months - 1)
+    oldest_kept = datetime(month_index // 12, month_index % 12 + 1, 1)
+
+    dropped = []
+    async with _partitions_lock:
+        for base in PARTITIONED_TABLES:
+            cutoff = _partition_name(base, oldest_kept)
+            expired = [name for name in await _get_partitions(base) if name < cutoff]
+            if not expired:
+                continue
+            async with engine.begin() as conn:
+                for name in expired:
+                    await conn.execute(text(f"DROP TABLE IF EXISTS {name}"))
+            _partitions[base.name] = [name for name in _partitions[base.name] if name not in expired]
+            for name in expired:
+                _partition_metadata.remove(_partition_table(base, name))
+            dropped.extend(expired)
+    if dropped:
+        logger.info(f"Удалены старые партиции сообщений: {', '.join(dropped)}")
+    return dropped
 
 # Операции с подписками
-async def create_subscription(user_telegram_id: int, end_date: date) -> Subscription:
+async def create_subscription(user_telegram_id: int, end_date: datetime) -> Subscription:
     """
-    Создать новую подписку.
+    Создать новую подписку и обновить дату окончания подписки пользователя.
 
     :param user_telegram_id: ID пользователя в Telegram.
     :param end_date: Дата окончания подписки.
     :return: Созданная подписка.
     """
     async with get_db_session() as session:
+        user = await session.scalar(select(User).where(User.telegram_id == user_telegram_id))
+        was_active_business_bot = user is not None and _counts_as_active_business_bot(user)
+
         subscription = Subscription(user_telegram_id=user_telegram_id, end_date=end_date)
         session.add(subscription)
+        await session.execute(
+            update(User)
+            .where(User.telegram_id == user_telegram_id)
+            .values(subscription_end_date=end_date)
+        )
+
+        await session.execute(_bump_stat(STAT_TOTAL_SUBSCRIPTIONS))
+        if (user is not None and not was_active_business_bot and user.business_bot_active
+                and not user.is_banned and end_date > datetime.now()):
+            await session.execute(_bump_stat(STAT_ACTIVE_BUSINESS_BOTS))
         return subscription
 
 async def get_subscription(user_telegram_id: int) -> Optional[Subscription]:
@@ -234,7 +826,7 @@ async def get_subscription(user_telegram_id: int) -> Optional[Subscription]:
     :return: Объект Subscription или None, если подписка не найдена.
     """
     async with get_db_session() as session:
-        return await session.scalar(select(Subscription).where(Subscription.user_telegram_id == user_telegram_id))
+        return await session.scalar(_GET_SUBSCRIPTION, {"telegram_id": user_telegram_id})
 
 async def delete_subscription(user_telegram_id: int):
     """
@@ -243,41 +835,71 @@ async def delete_subscription(user_telegram_id: int):
     :param user_telegram_id: ID пользователя в Telegram.
     """
     async with get_db_session() as session:
-        await session.execute(delete(Subscription).where(Subscription.user_telegram_id == user_telegram_id))
+        result = await session.execute(delete(Subscription).where(Subscription.user_telegram_id == user_telegram_id))
+        if result.rowcount:
+            await session.execute(_bump_stat(STAT_TOTAL_SUBSCRIPTIONS, -result.rowcount))
 
-async def delete_expired_subscriptions():
+async def delete_expired_subscriptions() -> List[int]:
     """
-    Удаляет истекшие подписки и отправляет уведомления пользователям.
+    Снять истекшие подписки одним set-based UPDATE по индексу subscription_end_date.
+
+    :return: Telegram ID пользователей, у которых подписка истекла.
     """
+    now = datetime.now()
     async with get_db_session() as session:
         try:
-            # Находим пользователей с истекающими подписками
-            expired_users = await session.execute(
-                select(User).where(User.subscription_end_date < datetime.now())
+            expired_business_bots = await session.scalar(
+                select(func.count(User.id)).where(
+                    User.subscription_end_date <= now,
+                    User.business_bot_active == True,
+                    User.is_banned == False
+                )
             )
 
-            for user in expired_users.scalars():
-                # Сбрасываем настройки пользователя
-                await session.execute(
-                    update(User)
-                    .where(User.telegram_id == user.telegram_id)
-                    .values(
-                        subscription_end_date=None,
-                        business_bot_active=False
-                    )
+            # Сбрасываем подписку и бизнес-бота всем истекшим пользователям сразу
+            result = await session.execute(
+                update(User)
+                .where(User.subscription_end_date <= now)
+                .values(
+                    last_subscription_end_date=User.subscription_end_date,
+                    subscription_end_date=None,
+                    business_bot_active=False
                 )
+                .returning(User.telegram_id)
+            )
+            expired_ids = list(result.scalars())
 
             # Удаляем истекшие подписки
-            await session.execute(
-                delete(Subscription).where(Subscription.end_date < datetime.now().date())
+            deleted = await session.execute(
+                delete(Subscription).where(Subscription.end_date < now.date())
             )
+            if expired_business_bots:
+                await session.execute(_bump_stat(STAT_ACTIVE_BUSINESS_BOTS, -expired_business_bots))
+            if deleted.rowcount:
+                await session.execute(_bump_stat(STAT_TOTAL_SUBSCRIPTIONS, -deleted.rowcount))
             await session.commit()
-            logger.info("Expired subscriptions processed successfully.")
+            if expired_ids:
+                logger.info(f"Истекло подписок: {len(expired_ids)}")
+            return expired_ids
         except Exception as e:
             logger.error(f"Error processing expired subscriptions: {e}")
             await session.rollback()
             raise
 
+async def get_upcoming_expiries() -> List[Tuple[datetime, int]]:
+    """
+    Получить даты окончания всех действующих подписок.
+
+    :return: Список пар (дата окончания, Telegram ID), упорядоченный по дате.
+    """
+    async with get_db_session() as session:
+        result = await session.execute(
+            select(User.subscription_end_date, User.telegram_id)
+            .where(User.subscription_end_date.is_not(None))
+            .order_by(User.subscription_end_date)
+        )
+        return [(end_date, telegram_id) for end_date, telegram_id in result]
+
 # Увеличение счетчиков сообщений
 async def increase_active_messages_count(user_telegram_id: int):
     """
@@ -287,14 +909,11 @@ async def increase_active_messages_count(user_telegram_id: int):
     """
     async with get_db_session() as session:
         try:
-            await session.execute(
-                update(User)
-                .where(User.telegram_id == user_telegram_id)
-                .values(
-                    active_messages_count=User.active_messages_count + 1,
-                    last_message_time=datetime.now()
-                )
+            result = await session.execute(
+                _INCREASE_ACTIVE_MESSAGES, {"b_telegram_id": user_telegram_id, "b_now": datetime.now()}
             )
+            if result.rowcount:
+                await session.execute(_BUMP_STAT, {"stat_name": STAT_ACTIVE_MESSAGES, "delta": 1})
             await session.commit()
             logger.info(f"✅ Увеличен счетчик активных сообщений для пользователя {user_telegram_id}")
         except Exception as e:
@@ -309,9 +928,9 @@ async def increase_edited_messages_count(user_telegram_id: int):
     :param user_telegram_id: ID пользователя в Telegram.
     """
     async with get_db_session() as session:
-        await session.execute(
-            update(User).where(User.telegram_id == user_telegram_id).values(edited_messages_count=User.edited_messages_count + 1)
-        )
+        result = await session.execute(_INCREASE_EDITED_MESSAGES, {"b_telegram_id": user_telegram_id})
+        if result.rowcount:
+            await session.execute(_BUMP_STAT, {"stat_name": STAT_EDITED_MESSAGES, "delta": 1})
 
 async def increase_deleted_messages_count(user_telegram_id: int):
     """
@@ -321,26 +940,16 @@ async def increase_deleted_messages_count(user_telegram_id: int):
     """
     async with get_db_session() as session:
         try:
-            # Проверяем существование пользователя
-            user = await session.scalar(select(User).where(User.telegram_id == user_telegram_id))
-            if not user:
+            # Увеличиваем счетчик; RETURNING заодно проверяет существование пользователя
+            new_value = await session.scalar(
+                _INCREASE_DELETED_MESSAGES, {"b_telegram_id": user_telegram_id, "b_now": datetime.now()}
+            )
+            if new_value is None:
                 logger.error(f"❌ Пользователь {user_telegram_id} не найден")
                 return
-
-            # Увеличиваем счетчик
-            await session.execute(
-                update(User)
-                .where(User.telegram_id == user_telegram_id)
-                .values(
-                    deleted_messages_count=User.deleted_messages_count + 1,
-                    last_message_time=datetime.now()
-                )
-            )
+            await session.execute(_BUMP_STAT, {"stat_name": STAT_DELETED_MESSAGES, "delta": 1})
             await session.commit()
-
-            # Проверяем обновленное значение
-            updated_user = await session.scalar(select(User).where(User.telegram_id == user_telegram_id))
-            logger.info(f"✅ Счетчик удаленных сообщений обновлен для пользователя {user_telegram_id}. Новое значение: {updated_user.deleted_messages_count}")
+            logger.info(f"✅ Счетчик удаленных сообщений обновлен для пользователя {user_telegram_id}. Новое значение: {new_value}")
 
         except Exception as e:
             logger.error(f"❌ Ошибка при обновлении счетчика удаленных сообщений: {e}")
@@ -349,99 +958,267 @@ async def increase_deleted_messages_count(user_telegram_id: int):
 
 
 # Статистика
-@alru_cache(maxsize=1, ttl=60)  # Кэш на 60 секунд
+async def _refresh_stats_rollup(session):
+    """
+    Пересчитать все счетчики сводной статистики по исходным таблицам.
+
+    Используется при создании таблицы и для периодической сверки:
+    инкрементальные обновления не учитывают, например, подписки,
+    истекшие между запусками очистки.
+
+    :param session: Сессия или соединение с открытой транзакцией.
+    """
+    now = datetime.now()
+    users = (await session.execute(
+        select(
+            func.count(User.id).filter(User.is_banned == False),
+            func.coalesce(func.sum(User.active_messages_count), 0),
+            func.coalesce(func.sum(User.edited_messages_count), 0),
+            func.coalesce(func.sum(User.deleted_messages_count), 0),
+            func.count(User.id).filter(and_(
+                User.business_bot_active == True,
+                User.subscription_end_date > now,
+                User.is_banned == False
+            ))
+        )
+    )).first()
+    subscriptions = await session.scalar(select(func.count(Subscription.id)))
+
+    values = {
+        STAT_TOTAL_USERS: users[0],
+        STAT_ACTIVE_MESSAGES: users[1],
+        STAT_EDITED_MESSAGES: users[2],
+        STAT_DELETED_MESSAGES: users[3],
+        STAT_ACTIVE_BUSINESS_BOTS: users[4],
+        STAT_TOTAL_SUBSCRIPTIONS: subscriptions or 0,
+    }
+    stmt = sqlite_insert(StatsRollup).values([{"name": name, "value": value} for name, value in values.items()])
+    await session.execute(
+        stmt.on_conflict_do_update(index_elements=[StatsRollup.name], set_={"value": stmt.excluded.value})
+    )
+
+async def reconcile_stats_rollup():
+    """Сверить счетчики сводной статистики с исходными таблицами."""
+    async with get_db_session() as session:
+        await _refresh_stats_rollup(session)
+    logger.info("Сводная статистика пересчитана")
+
+async def get_statistics() -> Dict[str, int]:
+    """
+    Получить все счетчики сводной статистики одним запросом.
+
+    :return: Словарь счетчиков, включая total_messages.
+    """
+    async with get_read_session() as session:
+        result = await session.execute(select(StatsRollup.name, StatsRollup.value))
+        stats = dict.fromkeys(STATS_ROLLUP_NAMES, 0)
+        stats.update({name: value for name, value in result})
+    stats["total_messages"] = (
+        stats[STAT_ACTIVE_MESSAGES] + stats[STAT_EDITED_MESSAGES] + stats[STAT_DELETED_MESSAGES]
+    )
+    return stats
+
+async def _get_stat(name: str) -> int:
+    async with get_read_session() as session:
+        return await session.scalar(select(StatsRollup.value).where(StatsRollup.name == name)) or 0
+
 async def get_total_users() -> int:
     """
-    Получить общее количество уникальных пользователей.
+    Получить общее количество незаблокированных пользователей.
 
     :return: Количество пользователей.
     """
-    async with get_db_session() as session:
-        result = await session.execute(
-            select(func.count(User.telegram_id))
-            .select_from(User)
-            .where(User.is_banned == False)
-        )
-        return result.scalar() or 0
+    return await _get_stat(STAT_TOTAL_USERS)
 
-@alru_cache(maxsize=1)
 async def get_total_subscriptions() -> int:
     """
     Получить общее количество подписок.
 
     :return: Количество подписок.
     """
-    async with get_db_session() as session:
-        result = await session.execute(select(func.count(Subscription.id)))
-        return result.scalar() or 0
+    return await _get_stat(STAT_TOTAL_SUBSCRIPTIONS)
 
-@alru_cache(maxsize=1, ttl=60)  # Кэш на 60 секунд
 async def get_total_messages() -> int:
     """
-    Получить общее количество сообщений из всех каналов.
+    Получить общее количество отслеживаемых сообщений (новых, отредактированных и удаленных).
 
     :return: Количество сообщений.
     """
-    async with get_db_session() as session:
-        try:
-            result = await session.execute(
-                select(
-                    func.sum(User.active_messages_count),
-                    func.sum(User.edited_messages_count),
-                    func.sum(User.deleted_messages_count)
-                )
-                .select_from(User)
-                .where(User.is_banned == False)
-            )
-            active, edited, deleted = result.first()
-            total = (active or 0) + (edited or 0) + (deleted or 0)
-            logger.info(f"Статистика сообщений: активные={active}, отред.={edited}, удал.={deleted}")
-            return total
-        except Exception as e:
-            logger.error(f"Ошибка при подсчете сообщений: {e}")
-            return 0
+    async with get_read_session() as session:
+        return await session.scalar(
+            select(func.sum(StatsRollup.value)).where(StatsRollup.name.in_(
+                (STAT_ACTIVE_MESSAGES, STAT_EDITED_MESSAGES, STAT_DELETED_MESSAGES)
+            ))
+        ) or 0
 
-@alru_cache(maxsize=1)
 async def get_total_edited_messages() -> int:
     """
     Получить общее количество отредактированных сообщений.
 
     :return: Количество отредактированных сообщений.
     """
-    async with get_db_session() as session:
-        result = await session.execute(select(func.sum(User.edited_messages_count)))
-        return result.scalar() or 0
+    return await _get_stat(STAT_EDITED_MESSAGES)
 
-@alru_cache(maxsize=1)
 async def get_total_deleted_messages() -> int:
     """
     Получить общее количество удаленных сообщений.
 
     :return: Количество удаленных сообщений.
     """
-    async with get_db_session() as session:
-        result = await session.execute(select(func.sum(User.deleted_messages_count)))
-        return result.scalar() or 0
+    return await _get_stat(STAT_DELETED_MESSAGES)
 
-@alru_cache(maxsize=1)
 async def get_total_users_with_active_business_bot() -> int:
     """
     Получить количество пользователей с активным бизнес-ботом.
 
     :return: Количество пользователей.
     """
+    return await _get_stat(STAT_ACTIVE_BUSINESS_BOTS)
+
+# Временные ряды активности
+def _activity_upsert(table: Table):
+    """UPSERT, прибавляющий счетчики к уже существующему интервалу."""
+    stmt = sqlite_insert(table)
+    return stmt.on_conflict_do_update(
+        index_elements=[column for column in table.primary_key.columns],
+        set_={name: table.c[name] + stmt.excluded[name] for name in ACTIVITY_COLUMNS}
+    )
+
+async def flush_activity(rows: List[Dict[str, int]]):
+    """
+    Записать накопленные события активности пачкой.
+
+    :param rows: Строки с ключами user_telegram_id, bucket (начало часа)
+        и счетчиками new_count, edited_count, deleted_count.
+    """
+    if not rows:
+        return
+
+    daily: Dict[int, Dict[str, int]] = {}
+    for row in rows:
+        day = row["bucket"] - row["bucket"] % ACTIVITY_DAY
+        totals = daily.setdefault(day, {"bucket": day, **dict.fromkeys(ACTIVITY_COLUMNS, 0)})
+        for name in ACTIVITY_COLUMNS:
+            totals[name] += row[name]
+
     async with get_db_session() as session:
-        result = await session.execute(
-            select(func.count(User.id))
-            .where(and_(
-                User.business_bot_active == True,
-                User.subscription_end_date > datetime.now(),
-                User.is_banned == False
-            ))
+        await session.execute(_activity_upsert(ActivityHourly.__table__), rows)
+        await session.execute(_activity_upsert(ActivityDaily.__table__), list(daily.values()))
+
+async def downsample_activity(hourly_retention_days: int = 7, daily_retention_days: int = 365):
+    """
+    Проредить старые интервалы активности.
+
+    Почасовые данные старше hourly_retention_days сворачиваются в суточные
+    интервалы пользователя, суточные данные старше daily_retention_days удаляются.
+    Граница выравнивается по началу суток, чтобы не разрезать сутки пополам.
+    """
+    now = int(datetime.now().timestamp())
+    hourly_cutoff = now - now % ACTIVITY_DAY - hourly_retention_days * ACTIVITY_DAY
+    daily_cutoff = now - now % ACTIVITY_DAY - daily_retention_days * ACTIVITY_DAY
+
+    hourly = ActivityHourly.__table__
+    day_bucket = (hourly.c.bucket - hourly.c.bucket % ACTIVITY_DAY).label("bucket")
+    folded = (
+        select(
+            hourly.c.user_telegram_id,
+            day_bucket,
+            *[func.sum(hourly.c[name]).label(name) for name in ACTIVITY_COLUMNS]
+        )
+        .where(hourly.c.bucket < hourly_cutoff)
+        .group_by(hourly.c.user_telegram_id, day_bucket)
+    )
+
+    user_daily = ActivityUserDaily.__table__
+    stmt = sqlite_insert(user_daily).from_select(
+        ["user_telegram_id", "bucket", *ACTIVITY_COLUMNS], folded
+    )
+    stmt = stmt.on_conflict_do_update(
+        index_elements=[user_daily.c.user_telegram_id, user_daily.c.bucket],
+        set_={name: user_daily.c[name] + stmt.excluded[name] for name in ACTIVITY_COLUMNS}
+    )
+
+    async with get_db_session() as session:
+        await session.execute(stmt)
+        folded_rows = await session.execute(delete(hourly).where(hourly.c.bucket < hourly_cutoff))
+        await session.execute(delete(user_daily).where(user_daily.c.bucket < daily_cutoff))
+        await session.execute(delete(ActivityDaily).where(ActivityDaily.bucket < daily_cutoff))
+    logger.info(f"Прорежено почасовых интервалов активности: {folded_rows.rowcount}")
+
+def _activity_rows(result) -> List[Dict[str, Any]]:
+    return [
+        {
+            "bucket": datetime.fromtimestamp(row.bucket),
+            "new": row.new_count,
+            "edited": row.edited_count,
+            "deleted": row.deleted_count,
+        }
+        for row in result
+    ]
+
+async def get_user_activity(user_telegram_id: int, since: datetime, daily: bool = False) -> List[Dict[str, Any]]:
+    """
+    Получить ряд активности пользователя.
+
+    :param user_telegram_id: ID пользователя в Telegram.
+    :param since: Начало периода.
+    :param daily: Суточные интервалы вместо почасовых. Включают и прореженные данные.
+    :return: Список интервалов с датой начала и счетчиками new, edited, deleted.
+    """
+    start = int(since.timestamp())
+    hourly = ActivityHourly.__table__
+    if not daily:
+        stmt = (
+            select(hourly.c.bucket, *[hourly.c[name] for name in ACTIVITY_COLUMNS])
+            .where(hourly.c.user_telegram_id == user_telegram_id, hourly.c.bucket >= start)
+            .order_by(hourly.c.bucket)
+        )
+    else:
+        user_daily = ActivityUserDaily.__table__
+        day_bucket = (hourly.c.bucket - hourly.c.bucket % ACTIVITY_DAY).label("bucket")
+        recent = (
+            select(day_bucket, *[hourly.c[name] for name in ACTIVITY_COLUMNS])
+            .where(hourly.c.user_telegram_id == user_telegram_id, hourly.c.bucket >= start)
+        )
+        older = (
+            select(user_daily.c.bucket, *[user_daily.c[name] for name in ACTIVITY_COLUMNS])
+            .where(user_daily.c.user_telegram_id == user_telegram_id, user_daily.c.bucket >= start)
+        )
+        combined = union_all(recent, older).subquery()
+        stmt = (
+            select(combined.c.bucket, *[func.sum(combined.c[name]).label(name) for name in ACTIVITY_COLUMNS])
+            .group_by(combined.c.bucket)
+            .order_by(combined.c.bucket)
+        )
+    async with get_read_session() as session:
+        return _activity_rows(await session.execute(stmt))
+
+async def get_global_activity(since: datetime, hourly: bool = False) -> List[Dict[str, Any]]:
+    """
+    Получить общий ряд активности бота.
+
+    :param since: Начало периода.
+    :param hourly: Почасовые интервалы (сумма по пользователям) вместо суточных.
+    :return: Список интервалов с датой начала и счетчиками new, edited, deleted.
+    """
+    start = int(since.timestamp())
+    if hourly:
+        table = ActivityHourly.__table__
+        stmt = (
+            select(table.c.bucket, *[func.sum(table.c[name]).label(name) for name in ACTIVITY_COLUMNS])
+            .where(table.c.bucket >= start)
+            .group_by(table.c.bucket)
+            .order_by(table.c.bucket)
+        )
+    else:
+        table = ActivityDaily.__table__
+        stmt = (
+            select(table.c.bucket, *[table.c[name] for name in ACTIVITY_COLUMNS])
+            .where(table.c.bucket >= start - start % ACTIVITY_DAY)
+            .order_by(table.c.bucket)
         )
-        count = result.scalar() or 0
-        logger.info(f"Пользователей с активным бизнес-ботом: {count}")
-        return count
+    async with get_read_session() as session:
+        return _activity_rows(await session.execute(stmt))
 
 # Операции с настройками
 async def set_subscription_price(price: float):
@@ -465,86 +1242,290 @@ async def get_subscription_price() -> float:
         result = await session.scalar(select(Settings).where(Settings.name == "subscription_price"))
         return float(result.value) if result else 0.0
 
-# Миграция базы данных
-async def migrate_db():
-    """Добавляет новые колонки в существующие таблицы"""
-    async with engine.begin() as conn:
-        result = await conn.execute(text("PRAGMA table_info(users)"))
-        columns = [col[1] for col in result.fetchall()]
-
-        if 'calc_enabled' not in columns:
-            await conn.execute(text("ALTER TABLE users ADD COLUMN calc_enabled BOOLEAN DEFAULT FALSE"))
-            logger.info("Added calc_enabled column to users table")
-
-        if 'love_enabled' not in columns:
-            await conn.execute(text("ALTER TABLE users ADD COLUMN love_enabled BOOLEAN DEFAULT FALSE"))
-            logger.info("Added love_enabled column to users table")
-
-        if 'channel_index' not in columns:
-            await conn.execute(text("ALTER TABLE users ADD COLUMN channel_index INTEGER DEFAULT 0"))
-            logger.info("Added channel_index column to users table")
-
-        if 'is_banned' not in columns:
-            await conn.execute(text("ALTER TABLE users ADD COLUMN is_banned BOOLEAN DEFAULT FALSE"))
-            logger.info("Added is_banned column to users table")
-
-        if 'ban_reason' not in columns:
-            await conn.execute(text("ALTER TABLE users ADD COLUMN ban_reason TEXT"))
-            logger.info("Added ban_reason column to users table")
-
-        if 'username' not in columns:
-            await conn.execute(text("ALTER TABLE users ADD COLUMN username TEXT"))
-            logger.info("Added username column to users table")
-
-        if 'first_name' not in columns:
-            await conn.execute(text("ALTER TABLE users ADD COLUMN first_name TEXT"))
-            logger.info("Added first_name column to users table")
-
-        if 'subscription_end_date' not in columns:
-            await conn.execute(text("ALTER TABLE users ADD COLUMN subscription_end_date TIMESTAMP"))
-            logger.info("Added subscription_end_date column to users table")
+# Миграции базы данных
+#
+# Каждый шаг миграции — корутина, принимающая соединение, внутри которого уже
+# открыта транзакция. Шаги применяются строго по возрастанию версии, после
+# каждого шага номер версии фиксируется в таблице schema_version в той же
+# транзакции. Шаги должны быть идемпотентными: на новой базе первый шаг
+# создает все таблицы по текущим моделям, и последующие шаги выполняются
+# поверх уже актуальной структуры.
+MigrationStep = Callable[[AsyncConnection], Awaitable[None]]
+MIGRATIONS: List[Tuple[int, str, MigrationStep]] = []
+
+def migration(version: int, description: str):
+    """
+    Зарегистрировать шаг миграции схемы.
 
-        if 'created_at' not in columns:
-            await conn.execute(text("ALTER TABLE users ADD COLUMN created_at TIMESTAMP"))
-            logger.info("Added created_at column to users table")
+    :param version: Номер версии схемы после применения шага.
+    :param description: Краткое описание шага для логов.
+    """
+    def decorator(func: MigrationStep) -> MigrationStep:
+        if any(existing == version for existing, _, _ in MIGRATIONS):
+            raise ValueError(f"Миграция с версией {version} уже зарегистрирована")
+        MIGRATIONS.append((version, description, func))
+        MIGRATIONS.sort(key=lambda item: item[0])
+        return func
+    return decorator
+
+def get_latest_schema_version() -> int:
+    """Последняя известная версия схемы."""
+    return MIGRATIONS[-1][0] if MIGRATIONS else 0
+
+async def get_schema_version(conn: AsyncConnection) -> int:
+    """
+    Получить текущую версию схемы одним запросом.
 
-        if 'notifications_enabled' not in columns:
-            await conn.execute(text("ALTER TABLE users ADD COLUMN notifications_enabled BOOLEAN DEFAULT TRUE"))
-            logger.info("Added notifications_enabled column to users table")
+    :return: Номер версии или 0, если база еще не версионирована.
+    """
+    try:
+        result = await conn.execute(text("SELECT version FROM schema_version WHERE id = 1"))
+    except OperationalError:
+        # Таблицы schema_version еще нет — база создана до версионирования или пустая
+        return 0
+    return result.scalar() or 0
+
+async def _set_schema_version(conn: AsyncConnection, version: int):
+    await conn.execute(text(
+        "CREATE TABLE IF NOT EXISTS schema_version ("
+        "id INTEGER PRIMARY KEY CHECK (id = 1), "
+        "version INTEGER NOT NULL, "
+        "applied_at TIMESTAMP NOT NULL)"
+    ))
+    await conn.execute(
+        text(
+            "INSERT INTO schema_version (id, version, applied_at) VALUES (1, :version, :applied_at) "
+            "ON CONFLICT(id) DO UPDATE SET version = excluded.version, applied_at = excluded.applied_at"
+        ),
+        {"version": version, "applied_at": datetime.now()}
+    )
+
+async def _get_table_columns(conn: AsyncConnection, table_name: str) -> List[str]:
+    result = await conn.execute(text(f"PRAGMA table_info({table_name})"))
+    return [col[1] for col in result.fetchall()]
+
+async def _create_indexes(conn: AsyncConnection, table: Table, columns: Optional[List[str]] = None):
+    """
+    Создать недостающие индексы, объявленные в модели таблицы.
 
-        if 'message_notifications' not in columns:
-            await conn.execute(text("ALTER TABLE users ADD COLUMN message_notifications BOOLEAN DEFAULT TRUE"))
-            logger.info("Added message_notifications column to users table")
+    :param columns: Ограничиться индексами по этим колонкам. Нужно миграциям,
+        после которых в модель добавлялись индексы по еще не созданным колонкам.
+    """
+    for index in table.indexes:
+        if columns is not None and not {column.name for column in index.columns} <= set(columns):
+            continue
+        await conn.run_sync(lambda sync_conn, index=index: index.create(sync_conn, checkfirst=True))
 
-        if 'edit_notifications' not in columns:
-            await conn.execute(text("ALTER TABLE users ADD COLUMN edit_notifications BOOLEAN DEFAULT TRUE"))
-            logger.info("Added edit_notifications column to users table")
+async def _rebuild_table(conn: AsyncConnection, table: Table, copy_select: Optional[str] = None):
+    """
+    Пересоздать таблицу по текущему описанию модели с переносом данных.
 
-        if 'delete_notifications' not in columns:
-            await conn.execute(text("ALTER TABLE users ADD COLUMN delete_notifications BOOLEAN DEFAULT TRUE"))
-            logger.info("Added delete_notifications column to users table")
+    SQLite не умеет менять ограничения существующих колонок через ALTER TABLE,
+    поэтому таблица создается заново под временным именем, данные копируются,
+    старая таблица удаляется, а новая переименовывается и получает индексы.
 
-        if 'last_message_time' not in columns:
-            await conn.execute(text("ALTER TABLE users ADD COLUMN last_message_time TIMESTAMP"))
-            await conn.execute(text("UPDATE users SET last_message_time = CURRENT_TIMESTAMP"))
-            logger.info("Added last_message_time column to users table")
+    :param table: Таблица в том виде, в котором она должна оказаться после миграции.
+    :param copy_select: SELECT для заполнения новой таблицы. По умолчанию
+        копируются все общие колонки старой и новой таблицы.
+    """
+    new_name = f"{table.name}__new"
+    old_columns = await _get_table_columns(conn, table.name)
+    columns = [column.name for column in table.columns if column.name in old_columns]
+
+    await conn.execute(text(f"DROP TABLE IF EXISTS {new_name}"))
+    # Копия нужна в тех же метаданных, чтобы разрешились внешние ключи;
+    # индексы создаются позже под исходными именами
+    new_table = table.to_metadata(table.metadata, name=new_name)
+    new_table.indexes.clear()
+    try:
+        await conn.execute(CreateTable(new_table))
+    finally:
+        table.metadata.remove(new_table)
+
+    column_list = ", ".join(columns)
+    if copy_select is None:
+        copy_select = f"SELECT {column_list} FROM {table.name}"
+    await conn.execute(text(f"INSERT INTO {new_name} ({column_list}) {copy_select}"))
+
+    await conn.execute(text(f"DROP TABLE {table.name}"))
+    await conn.execute(text(f"ALTER TABLE {new_name} RENAME TO {table.name}"))
+    await _create_indexes(conn, table)
+
+# Колонки, которые добавлялись в users уже после первого релиза:
+# (имя, определение, запрос для заполнения существующих строк)
+LEGACY_USER_COLUMNS = [
+    ("calc_enabled", "BOOLEAN DEFAULT FALSE", None),
+    ("love_enabled", "BOOLEAN DEFAULT FALSE", None),
+    ("channel_index", "INTEGER DEFAULT 0", None),
+    ("is_banned", "BOOLEAN DEFAULT FALSE", None),
+    ("ban_reason", "TEXT", None),
+    ("username", "TEXT", None),
+    ("first_name", "TEXT", None),
+    ("subscription_end_date", "TIMESTAMP", None),
+    ("created_at", "TIMESTAMP", None),
+    ("notifications_enabled", "BOOLEAN DEFAULT TRUE", None),
+    ("message_notifications", "BOOLEAN DEFAULT TRUE", None),
+    ("edit_notifications", "BOOLEAN DEFAULT TRUE", None),
+    ("delete_notifications", "BOOLEAN DEFAULT TRUE", None),
+    ("last_message_time", "TIMESTAMP", "UPDATE users SET last_message_time = CURRENT_TIMESTAMP"),
+    ("last_farm_time", "TIMESTAMP", "UPDATE users SET last_farm_time = CURRENT_TIMESTAMP"),
+    ("online_enabled", "BOOLEAN DEFAULT FALSE", None),
+    ("module_calc_enabled", "BOOLEAN DEFAULT FALSE", None),
+    ("module_love_enabled", "BOOLEAN DEFAULT FALSE", None),
+]
+
+@migration(1, "базовая схема, колонки users и настройки по умолчанию")
+async def _migration_initial_schema(conn: AsyncConnection):
+    await conn.run_sync(Base.metadata.create_all)
+
+    columns = await _get_table_columns(conn, "users")
+    for name, definition, backfill in LEGACY_USER_COLUMNS:
+        if name in columns:
+            continue
+        await conn.execute(text(f"ALTER TABLE users ADD COLUMN {name} {definition}"))
+        if backfill:
+            await conn.execute(text(backfill))
+        logger.info(f"Added {name} column to users table")
+
+    await create_default_settings(conn)
+
+@migration(2, "индексы по message_id для поиска сообщений")
+async def _migration_message_indexes(conn: AsyncConnection):
+    await _create_indexes(conn, Message.__table__)
+    await _create_indexes(conn, MessageEditHistory.__table__)
+
+@migration(3, "уникальный индекс пары в user_message_stats со слиянием дублей")
+async def _migration_unique_message_stats_pair(conn: AsyncConnection):
+    # Дубли пар появлялись из-за SELECT + INSERT без ограничения уникальности:
+    # сворачиваем их в одну строку с суммой счетчиков
+    await _rebuild_table(
+        conn,
+        UserMessageStats.__table__,
+        "SELECT MIN(id), from_user_id, to_user_id, SUM(messages_count) "
+        "FROM user_message_stats GROUP BY from_user_id, to_user_id"
+    )
+
+@migration(4, "таблица сводной статистики stats_rollup")
+async def _migration_stats_rollup(conn: AsyncConnection):
+    await conn.run_sync(lambda sync_conn: StatsRollup.__table__.create(sync_conn, checkfirst=True))
+    await _refresh_stats_rollup(conn)
+
+@migration(5, "таблицы временных рядов активности")
+async def _migration_activity_series(conn: AsyncConnection):
+    for model in (ActivityHourly, ActivityUserDaily, ActivityDaily):
+        await conn.run_sync(lambda sync_conn, table=model.__table__: table.create(sync_conn, checkfirst=True))
+        await _create_indexes(conn, model.__table__)
+
+@migration(6, "индексы по датам окончания подписок")
+async def _migration_subscription_end_indexes(conn: AsyncConnection):
+    await _create_indexes(conn, User.__table__, ["subscription_end_date"])
+    await _create_indexes(conn, Subscription.__table__)
+
+@migration(7, "таблица рассылок с сохраненным прогрессом")
+async def _migration_broadcasts(conn: AsyncConnection):
+    await conn.run_sync(lambda sync_conn: Broadcast.__table__.create(sync_conn, checkfirst=True))
+
+@migration(8, "признак недоступности пользователя для рассылок")
+async def _migration_user_reachability(conn: AsyncConnection):
+    columns = await _get_table_columns(conn, "users")
+    if "is_reachable" not in columns:
+        await conn.execute(text("ALTER TABLE users ADD COLUMN is_reachable BOOLEAN NOT NULL DEFAULT 1"))
+    if "unreachable_reason" not in columns:
+        await conn.execute(text("ALTER TABLE users ADD COLUMN unreachable_reason TEXT"))
+    await _create_indexes(conn, User.__table__, ["is_reachable"])
+
+@migration(9, "сегменты аудитории рассылок")
+async def _migration_broadcast_segments(conn: AsyncConnection):
+    columns = await _get_table_columns(conn, "users")
+    if "last_subscription_end_date" not in columns:
+        await conn.execute(text("ALTER TABLE users ADD COLUMN last_subscription_end_date TIMESTAMP"))
+    # Подписки, истекшие до миграции, уже сброшены и дат не сохранили;
+    # заполняем только те, что истекли, но еще не обработаны
+    await conn.execute(text(
+        "UPDATE users SET last_subscription_end_date = subscription_end_date "
+        "WHERE subscription_end_date IS NOT NULL AND subscription_end_date <= :now"
+    ), {"now": datetime.now()})
+    await _create_indexes(conn, User.__table__, ["business_bot_active", "last_subscription_end_date"])
+
+    columns = await _get_table_columns(conn, "broadcasts")
+    if "segment" not in columns:
+        await conn.execute(text("ALTER TABLE broadcasts ADD COLUMN segment TEXT NOT NULL DEFAULT 'all'"))
+    if "segment_param" not in columns:
+        await conn.execute(text("ALTER TABLE broadcasts ADD COLUMN segment_param TEXT"))
+
+@migration(10, "индекс по username для поиска пользователей")
+async def _migration_username_index(conn: AsyncConnection):
+    await _create_indexes(conn, User.__table__, ["username"])
+
+@migration(11, "таблица длительных задач в чатах")
+async def _migration_chat_tasks(conn: AsyncConnection):
+    await conn.run_sync(lambda sync_conn: ChatTask.__table__.create(sync_conn, checkfirst=True))
+
+@migration(12, "сквозные id партиций сообщений и перенос строк из исходных таблиц")
+async def _migration_message_partition_ids(conn: AsyncConnection):
+    for base in PARTITIONED_TABLES:
+        result = await conn.execute(
+            text("SELECT name FROM sqlite_master WHERE type = 'table' AND name GLOB :pattern ORDER BY name"),
+            {"pattern": f"{base.name}_[0-9][0-9][0-9][0-9][0-9][0-9]"}
+        )
+        partitions = list(result.scalars())
+
+        # Партиции нумеровались каждая с 1: сдвигаем их от старых к новым выше
+        # предыдущих. Сначала id делаются отрицательными, чтобы сдвиг внутри
+        # таблицы не задел еще не сдвинутые строки
+        offset = await _max_id(conn, [base.name])
+        for name in partitions:
+            await conn.execute(text(f"UPDATE {name} SET id = -id"))
+            await conn.execute(text(f"UPDATE {name} SET id = :offset - id"), {"offset": offset})
+            offset = max(offset, await _max_id(conn, [name]))
+
+        # Строки исходной таблицы (их id меньше всех партиций) переносятся в
+        # партиции: история правок — по месяцу правки, сообщения, у которых нет
+        # даты, — в самую старую партицию, чтобы удалиться вместе с ней
+        columns = ", ".join(column.name for column in base.columns)
+        # Партиция -> условие отбора строк исходной таблицы
+        targets: Dict[str, str] = {}
+        if "date" in base.columns:
+            result = await conn.execute(text(f"SELECT DISTINCT strftime('%Y%m', date) FROM {base.name}"))
+            targets = {f"{base.name}_{month}": f"WHERE strftime('%Y%m', date) = '{month}'"
+                       for month in result.scalars()}
+        elif await _max_id(conn, [base.name]):
+            targets = {partitions[0] if partitions else _partition_name(base, datetime.now()): ""}
+        for name, condition in targets.items():
+            table = _partition_table(base, name)
+            await conn.run_sync(lambda sync_conn: table.create(sync_conn, checkfirst=True))
+            await conn.execute(text(f"INSERT INTO {name} ({columns}) SELECT {columns} FROM {base.name} {condition}"))
+        await conn.execute(text(f"DELETE FROM {base.name}"))
+    # Список партиций мог измениться: пусть перечитается при первом обращении
+    _partitions.clear()
+
+@migration(13, "индекс по времени последнего сообщения для сегмента неактивных")
+async def _migration_last_message_time_index(conn: AsyncConnection):
+    await _create_indexes(conn, User.__table__, ["is_reachable", "last_message_time"])
 
-        if 'last_farm_time' not in columns:
-            await conn.execute(text("ALTER TABLE users ADD COLUMN last_farm_time TIMESTAMP"))
-            await conn.execute(text("UPDATE users SET last_farm_time = CURRENT_TIMESTAMP"))
-            logger.info("Added last_farm_time column to users table")
+async def migrate_db():
+    """
+    Применить недостающие миграции схемы.
 
-        if 'online_enabled' not in columns:
-            await conn.execute(text("ALTER TABLE users ADD COLUMN online_enabled BOOLEAN DEFAULT FALSE"))
-            logger.info("Added online_enabled column to users table")
+    Если схема уже актуальна, выполняется только чтение версии.
+    Каждый шаг применяется в собственной транзакции вместе с записью новой версии,
+    поэтому прерванная миграция продолжится со следующего незавершенного шага.
+    """
+    async with engine.connect() as conn:
+        current_version = await get_schema_version(conn)
 
-        if 'module_calc_enabled' not in columns:
-            await conn.execute(text("ALTER TABLE users ADD COLUMN module_calc_enabled BOOLEAN DEFAULT FALSE"))
-            logger.info("Added module_calc_enabled column to users table")
+    latest_version = get_latest_schema_version()
+    if current_version >= latest_version:
+        logger.info(f"Схема базы данных актуальна (версия {current_version})")
+        return
 
-        if 'module_love_enabled' not in columns:
-            await conn.execute(text("ALTER TABLE users ADD COLUMN module_love_enabled BOOLEAN DEFAULT FALSE"))
-            logger.info("Added module_love_enabled column to users table")
+    for version, description, step in MIGRATIONS:
+        if version <= current_version:
+            continue
+        async with engine.begin() as conn:
+            await step(conn)
+            await _set_schema_version(conn, version)
+        logger.info(f"✅ Применена миграция {version}: {description}")
 
 
 # Запуск инициализации базы данных
@@ -569,41 +1550,17 @@ async def update_user_channel_index(telegram_id: int, channel_index: int):
     Обновить индекс канала пользователя.
     """
     async with get_db_session() as session:
-        await session.execute(
-            update(User).where(User.telegram_id == telegram_id).values(channel_index=channel_index)
-        )
+        await session.execute(_UPDATE_CHANNEL_INDEX, {"b_telegram_id": telegram_id, "b_channel_index": channel_index})
 
 async def increment_messages_count(from_user_id: int, to_user_id: int):
     """
-    Увеличить счетчик сообщений между пользователями
+    Увеличить счетчик сообщений между пользователями.
+
+    Выполняется одним запросом INSERT ... ON CONFLICT DO UPDATE по уникальному
+    индексу пары, поэтому параллельные сообщения не создают дублей.
     """
     async with get_db_session() as session:
-        stats = await session.scalar(
-            select(UserMessageStats).where(
-                and_(
-                    UserMessageStats.from_user_id == from_user_id,
-                    UserMessageStats.to_user_id == to_user_id
-                )
-            )
-        )
-        if stats:
-            await session.execute(
-                update(UserMessageStats)
-                .where(
-                    and_(
-                        UserMessageStats.from_user_id == from_user_id,
-                        UserMessageStats.to_user_id == to_user_id
-                    )
-                )
-                .values(messages_count=UserMessageStats.messages_count + 1)
-            )
-        else:
-            stats = UserMessageStats(
-                from_user_id=from_user_id,
-                to_user_id=to_user_id,
-                messages_count=1
-            )
-            session.add(stats)
+        await session.execute(_INCREMENT_PAIR, {"from_id": from_user_id, "to_id": to_user_id})
 
 async def get_user_by_username(username: str) -> Optional[User]:
     """
@@ -625,53 +1582,31 @@ async def get_user_by_username(username: str) -> Optional[User]:
             return await session.scalar(
                 select(User).where(User.username == username)
             )
-        stats = await session.scalar(
-            select(UserMessageStats).where(
-                and_(
-                    UserMessageStats.from_user_id == from_user_id,
-                    UserMessageStats.to_user_id == to_user_id
-                )
-            )
-        )
-        if stats:
-            await session.execute(
-                update(UserMessageStats)
-                .where(
-                    and_(
-                        UserMessageStats.from_user_id == from_user_id,
-                        UserMessageStats.to_user_id == to_user_id
-                    )
-                )
-                .values(messages_count=UserMessageStats.messages_count + 1)
-            )
-        else:
-            stats = UserMessageStats(
-                from_user_id=from_user_id,
-                to_user_id=to_user_id,
-                messages_count=1
-            )
-            session.add(stats)
 
 async def get_user_message_stats(user_id: int) -> List[Dict[str, Any]]:
     """
     Получить статистику сообщений пользователя
+
+    Исходящие пары читаются по уникальному индексу (from_user_id, to_user_id),
+    входящие — по индексу to_user_id, вместо полного просмотра таблицы через OR.
     """
-    async with get_db_session() as session:
-        stats = await session.execute(
-            select(UserMessageStats).where(
-                 or_(
-                    UserMessageStats.from_user_id == user_id,
-                    UserMessageStats.to_user_id == user_id
-                )
-            )
+    columns = (UserMessageStats.from_user_id, UserMessageStats.to_user_id, UserMessageStats.messages_count)
+    stmt = union_all(
+        select(*columns).where(UserMessageStats.from_user_id == user_id),
+        select(*columns).where(
+            UserMessageStats.to_user_id == user_id,
+            UserMessageStats.from_user_id != user_id
         )
+    )
+    async with get_read_session() as session:
+        stats = await session.execute(stmt)
         return [
             {
                 'from_user_id': stat.from_user_id,
                 'to_user_id': stat.to_user_id,
                 'messages_count': stat.messages_count
             }
-            for stat in stats.scalars()
+            for stat in stats
         ]
 
 async def ban_user(telegram_id: int, reason: str = "Не указана") -> bool:
@@ -687,15 +1622,20 @@ async def ban_user(telegram_id: int, reason: str = "Не указана") -> boo
         if not user:
             return False
 
+        was_banned = user.is_banned
+        was_active_business_bot = _counts_as_active_business_bot(user)
         await session.execute(
             update(User)
             .where(User.telegram_id == telegram_id)
             .values(
                 is_banned=True,
-                ban_reason=reason,
-                ban_date=datetime.now()
+                ban_reason=reason
             )
         )
+        if not was_banned:
+            await session.execute(_bump_stat(STAT_TOTAL_USERS, -1))
+            if was_active_business_bot:
+                await session.execute(_bump_stat(STAT_ACTIVE_BUSINESS_BOTS, -1))
         return True
 
 async def unban_user(telegram_id: int) -> bool:
@@ -710,51 +1650,219 @@ async def unban_user(telegram_id: int) -> bool:
         if not user:
             return False
 
+        was_banned = user.is_banned
         await session.execute(
             update(User)
             .where(User.telegram_id == telegram_id)
             .values(
                 is_banned=False,
-                ban_reason=None,
-                ban_date=None
+                ban_reason=None
             )
         )
+        if was_banned:
+            await session.execute(_bump_stat(STAT_TOTAL_USERS))
+            # После разбана пользователь снова учитывается, если бизнес-бот активен и подписка действует
+            if (user.business_bot_active and user.subscription_end_date
+                    and user.subscription_end_date > datetime.now()):
+                await session.execute(_bump_stat(STAT_ACTIVE_BUSINESS_BOTS))
         return True
 
-async def broadcast_message(text: str) -> List[int]:
+# Массовые операции администратора. Каждая выполняется одной транзакцией:
+# ошибка откатывает весь файл целиком и пробрасывается вызывающему коду,
+# чтобы отчет не показал успех для неприменённых строк
+BULK_CHUNK_SIZE = 500
+
+def _chunks(values: List[Any], size: int = BULK_CHUNK_SIZE) -> Iterable[List[Any]]:
+    for start in range(0, len(values), size):
+        yield values[start:start + size]
+
+async def resolve_users(telegram_ids: List[int], usernames: List[str]) -> Tuple[Dict[int, User], Dict[str, User]]:
     """
-    Отправка сообщения всем пользователям.
+    Найти пользователей по списку Telegram ID и username пачками по BULK_CHUNK_SIZE.
 
-    :param text: Текст для рассылки
-    :return: Список ID пользователей, которым было отправлено сообщение
+    :param telegram_ids: Telegram ID.
+    :param usernames: Username без @.
+    :return: (найденные по ID, найденные по username).
+    """
+    by_id: Dict[int, User] = {}
+    by_username: Dict[str, User] = {}
+    async with get_read_session() as session:
+        for chunk in _chunks(list(telegram_ids)):
+            for user in (await session.scalars(select(User).where(User.telegram_id.in_(chunk)))):
+                by_id[user.telegram_id] = user
+        for chunk in _chunks(list(usernames)):
+            for user in (await session.scalars(select(User).where(User.username.in_(chunk)))):
+                by_username[user.username] = user
+    return by_id, by_username
+
+async def bulk_create_subscriptions(telegram_ids: List[int], end_date: datetime):
+    """
+    Выдать подписку сразу нескольким пользователям (как create_subscription для каждого).
+
+    :param telegram_ids: Telegram ID существующих пользователей.
+    :param end_date: Дата окончания подписки.
+    """
+    now = datetime.now()
+    async with async_session.begin() as session:
+        for chunk in _chunks(telegram_ids):
+            # Бизнес-боты, которые начнут учитываться как активные после выдачи
+            activated = await session.scalar(
+                select(func.count(User.id)).where(
+                    User.telegram_id.in_(chunk),
+                    User.business_bot_active == True,
+                    User.is_banned == False,
+                    or_(User.subscription_end_date.is_(None), User.subscription_end_date <= now)
+                )
+            ) if end_date > now else 0
+            await session.execute(
+                insert(Subscription),
+                [{"user_telegram_id": telegram_id, "end_date": end_date} for telegram_id in chunk]
+            )
+            await session.execute(
+                update(User).where(User.telegram_id.in_(chunk)).values(subscription_end_date=end_date)
+            )
+            await session.execute(_bump_stat(STAT_TOTAL_SUBSCRIPTIONS, len(chunk)))
+            if activated:
+                await session.execute(_bump_stat(STAT_ACTIVE_BUSINESS_BOTS, activated))
+
+async def bulk_ban_users(telegram_ids: List[int], reason: str = "Не указана") -> List[int]:
+    """
+    Заблокировать нескольких пользователей.
+
+    :return: Telegram ID тех, кто был заблокирован сейчас (остальные уже были в бане).
+    """
+    now = datetime.now()
+    banned: List[int] = []
+    async with async_session.begin() as session:
+        for chunk in _chunks(telegram_ids):
+            active_business_bots = await session.scalar(
+                select(func.count(User.id)).where(
+                    User.telegram_id.in_(chunk),
+                    User.is_banned == False,
+                    User.business_bot_active == True,
+                    User.subscription_end_date > now
+                )
+            )
+            result = await session.execute(
+                update(User)
+                .where(User.telegram_id.in_(chunk), User.is_banned == False)
+                .values(is_banned=True, ban_reason=reason)
+                .returning(User.telegram_id)
+            )
+            changed = list(result.scalars())
+            if changed:
+                await session.execute(_bump_stat(STAT_TOTAL_USERS, -len(changed)))
+            if active_business_bots:
+                await session.execute(_bump_stat(STAT_ACTIVE_BUSINESS_BOTS, -active_business_bots))
+            banned.extend(changed)
+    return banned
+
+async def bulk_unban_users(telegram_ids: List[int]) -> List[int]:
+    """
+    Разблокировать нескольких пользователей.
+
+    :return: Telegram ID тех, кто был разблокирован сейчас (остальные не были в бане).
+    """
+    now = datetime.now()
+    unbanned: List[int] = []
+    async with async_session.begin() as session:
+        for chunk in _chunks(telegram_ids):
+            active_business_bots = await session.scalar(
+                select(func.count(User.id)).where(
+                    User.telegram_id.in_(chunk),
+                    User.is_banned == True,
+                    User.business_bot_active == True,
+                    User.subscription_end_date > now
+                )
+            )
+            result = await session.execute(
+                update(User)
+                .where(User.telegram_id.in_(chunk), User.is_banned == True)
+                .values(is_banned=False, ban_reason=None)
+                .returning(User.telegram_id)
+            )
+            changed = list(result.scalars())
+            if changed:
+                await session.execute(_bump_stat(STAT_TOTAL_USERS, len(changed)))
+            if active_business_bots:
+                await session.execute(_bump_stat(STAT_ACTIVE_BUSINESS_BOTS, active_business_bots))
+            unbanned.extend(changed)
+    return unbanned
+
+# Рассылки
+async def create_broadcast(text: str, admin_chat_id: int, total: int,
+                           segment: str = "all", segment_param: Optional[str] = None) -> Broadcast:
+    """
+    Сохранить новую рассылку.
+
+    :param text: Текст рассылки.
+    :param admin_chat_id: Чат администратора для сообщения о прогрессе.
+    :param total: Ожидаемое количество получателей.
+    :param segment: Сегмент аудитории.
+    :param segment_param: Параметр сегмента (количество дней, дата).
+    :return: Созданная рассылка.
     """
-    sent_to = []
-    failed = []
     async with get_db_session() as session:
-        try:
-            users = await session.execute(select(User).where(User.is_banned == False))
-            for user in users.scalars():
-                try:
-                    # В реальном коде здесь будет отправка сообщения через бота
-                    sent_to.append(user.telegram_id)
-                except Exception as e:
-                    logger.error(f"Ошибка отправки сообщения пользователю {user.telegram_id}: {e}")
-                    failed.append(user.telegram_id)
-
-            logger.info(f"Рассылка завершена. Отправлено: {len(sent_to)}, Ошибок: {len(failed)}")
-            return sent_to
-        except Exception as e:
-            logger.error(f"Ошибка при рассылке сообщений: {e}")
-            raise
+        broadcast = Broadcast(
+            text=text,
+            status=BROADCAST_RUNNING,
+            total=total,
+            segment=segment,
+            segment_param=segment_param,
+            admin_chat_id=admin_chat_id,
+            created_at=datetime.now()
+        )
+        session.add(broadcast)
+        await session.flush()
+        return broadcast
 
-async def get_all_users() -> List[User]:
+async def update_broadcast(broadcast_id: int, **values):
+    """Обновить поля рассылки (прогресс, статус, сообщение о прогрессе)."""
+    async with get_db_session() as session:
+        await session.execute(update(Broadcast).where(Broadcast.id == broadcast_id).values(**values))
+
+async def get_running_broadcasts() -> List[Broadcast]:
+    """Незавершенные рассылки, например прерванные перезапуском бота."""
+    async with get_db_session() as session:
+        result = await session.execute(
+            select(Broadcast).where(Broadcast.status == BROADCAST_RUNNING).order_by(Broadcast.id)
+        )
+        return result.scalars().all()
+
+async def save_chat_task(business_connection_id: str, chat_id: int, kind: str, owner_id: int, params: str = "{}"):
     """
-    Получить список всех пользователей.
+    Сохранить описание задачи в чате (повторное сохранение заменяет прежнее).
 
-    :return: Список всех пользователей
+    :param business_connection_id: ID бизнес-подключения.
+    :param chat_id: ID чата.
+    :param kind: Вид задачи (pin, online...).
+    :param owner_id: Telegram ID владельца подключения.
+    :param params: Параметры задачи в JSON.
     """
     async with get_db_session() as session:
-        result = await session.execute(select(User))
+        stmt = sqlite_insert(ChatTask).values(
+            business_connection_id=business_connection_id, chat_id=chat_id, kind=kind,
+            owner_id=owner_id, params=params, created_at=datetime.now()
+        )
+        await session.execute(stmt.on_conflict_do_update(
+            index_elements=[ChatTask.business_connection_id, ChatTask.chat_id, ChatTask.kind],
+            set_={"owner_id": stmt.excluded.owner_id, "params": stmt.excluded.params,
+                  "created_at": stmt.excluded.created_at}
+        ))
+
+async def delete_chat_task(business_connection_id: str, chat_id: int, kind: str):
+    """Удалить описание задачи в чате."""
+    async with get_db_session() as session:
+        await session.execute(delete(ChatTask).where(
+            ChatTask.business_connection_id == business_connection_id,
+            ChatTask.chat_id == chat_id,
+            ChatTask.kind == kind
+        ))
+
+async def get_chat_tasks() -> List[ChatTask]:
+    """Сохраненные задачи в чатах в порядке запуска."""
+    async with get_read_session() as session:
+        result = await session.execute(select(ChatTask).order_by(ChatTask.created_at))
         return result.scalars().all()
 
 async def update_all_modules(user_id: int, state: bool) -> None:
@@ -772,16 +1880,6 @@ async def update_all_modules(user_id: int, state: bool) -> None:
         )
         await session.commit()
 
-async def get_recent_logs(limit: int = 50) -> List[Dict[str, Any]]:
-    """
-    Получить последние логи действий пользователей
-
-    :param limit: Количество записей
-    :return: Список последних действий
-    """
-    logs = []
-
-    return logs[:limit]
 async def update_all_modules(user_id: int, new_state: bool) -> None:
     """Обновление состояния всех модулей"""
     async with get_db_session() as session:
@@ -797,7 +1895,7 @@ async def update_all_modules(user_id: int, new_state: bool) -> None:
 
 async def get_top_users(limit: int = 10) -> List[Dict[str, Any]]:
     """Получение топа пользователей по разным параметрам"""
-    async with get_db_session() as session:
+    async with get_read_session() as session:
         result = await session.execute(
             select(User)
             .filter(User.active_messages_count > 0)
@@ -820,7 +1918,7 @@ async def get_top_users(limit: int = 10) -> List[Dict[str, Any]]:
 
 async def get_user_stats(telegram_id: int) -> Dict[str, Any]:
     """Получение статистики пользователя"""
-    async with get_db_session() as session:
+    async with get_read_session() as session:
         user = await session.scalar(
             select(User).where(User.telegram_id == telegram_id)
         )
@@ -892,28 +1990,28 @@ async def update_all_modules(telegram_id: int, state: bool) -> bool:
 async def update_last_message_time(user_telegram_id: int):
     """Обновляет время последнего сообщения пользователя"""
     async with get_db_session() as session:
-        await session.execute(
-            update(User)
-            .where(User.telegram_id == user_telegram_id)
-            .values(last_message_time=datetime.now())
-        )
+        await session.execute(_UPDATE_LAST_MESSAGE_TIME, {"b_telegram_id": user_telegram_id, "b_now": datetime.now()})
 
 async def check_inactive_chats(bot: Bot):
     """Проверяет неактивные чаты и отправляет уведомления"""
-    async with get_db_session() as session:
-        users = await session.execute(
-            select(User)
-            .where(User.business_bot_active == True)
-            .where(User.last_message_time < datetime.now() - timedelta(hours=24))
-        )
-        for user in users.scalars():
-            try:
-                await bot.send_message(
-                    user.telegram_id,
-                    "⚠️ Напоминание: В вашем чате нет активности более 24 часов!"
-                )
-            except Exception as e:
-                logger.error(f"Ошибка отправки уведомления: {e}")
+    user_filter = UserFilter(
+        business_bot_active=True,
+        is_reachable=True,
+        inactive_since=datetime.now() - timedelta(hours=24)
+    )
+    unreachable = {}
+    async for user in iter_users(user_filter):
+        try:
+            await bot.send_message(
+                user.telegram_id,
+                "⚠️ Напоминание: В вашем чате нет активности более 24 часов!"
+            )
+        except Exception as e:
+            reason = classify_delivery_error(e)
+            if reason:
+                unreachable[user.telegram_id] = reason
+            logger.error(f"Ошибка отправки уведомления: {e}")
+    await mark_users_unreachable(unreachable)
 
 async def cleanup_database():
     """Нахуярить чистку всей хуйни из базы данных"""
@@ -925,6 +2023,9 @@ async def cleanup_database():
             # Потом удаляем всех пользователей
             await session.execute(delete(User))
 
+            # Обнуляем сводную статистику
+            await _refresh_stats_rollup(session)
+
             await session.commit()
             logger.info("🧹 База данных успешно очищена")
             return True
@@ -1,14 +1,25 @@
 import asyncio
+import html
 from datetime import datetime, timedelta
 from aiogram import Router, F, BaseMiddleware
-from aiogram.filters import Command
-from aiogram.types import Message, TelegramObject
+from aiogram.filters import Command, CommandObject
+from aiogram.types import Message, CallbackQuery, TelegramObject, FSInputFile, BufferedInputFile
 from aiogram.fsm.context import FSMContext
 from aiogram.enums.parse_mode import ParseMode
 import bot.database.database as db
+from bot.services.activity import fill_series, render_sparkline, get_trend
+from bot.services.entitlements import entitlements
+from bot.services.expiry import expiry_engine
+from bot.services.export import export_table, EXPORT_TABLES, EXPORT_FORMATS
+from bot.services.backup import create_backup, list_backups
+from bot.services.broadcast import broadcast_engine, BROADCAST_SEGMENTS, estimate_segment, describe_estimate
+from bot.services.bulk import BULK_MAX_FILE_SIZE, parse_rows, apply_bulk_action, render_report
+from bot.utils.error_aggregator import error_aggregator
+from bot.utils.metrics import registry
+from bot.utils.sqlprofile import sql_profiler, display_shape
+from bot.utils.api_stats import api_accounting
 import logging
 from pydantic import BaseModel, PositiveInt, confloat
-from async_lru import alru_cache  # Импортируем alru_cache
 
 from config import ADMIN_IDS
 
@@ -23,28 +34,33 @@ class GiveSubscriptionRequest(BaseModel):
 class SetPriceRequest(BaseModel):
     price: confloat(gt=0)
 
+ADMIN_ACTIONS = registry.counter("bot_admin_actions_total", "Команды и действия администраторов", ["action"])
+
+def _admin_action(event: TelegramObject) -> str:
+    """Название действия для метрик: команда без аргументов или префикс callback_data."""
+    if isinstance(event, CallbackQuery):
+        return (event.data or "").split("_")[0] + "_callback"
+    text = getattr(event, "text", None) or getattr(event, "caption", None) or ""
+    return text.split(maxsplit=1)[0].split("@")[0] if text.startswith("/") else "text"
+
 # Middleware для проверки прав администратора
 class AdminMiddleware(BaseMiddleware):
     async def __call__(self, handler, event: TelegramObject, data: dict):
         if event.from_user.id not in ADMIN_IDS:
+            ADMIN_ACTIONS.inc(action="denied")
             await event.answer("У вас нет прав администратора.")
             return
+        ADMIN_ACTIONS.inc(action=_admin_action(event))
         return await handler(event, data)
 
 admin_router.message.middleware(AdminMiddleware())
 
-# Кэширование статистики с помощью async_lru
-@alru_cache(maxsize=1)  # Используем alru_cache для асинхронного кэширования
-async def get_cached_statistics():
-    return {
-        "total_users": await db.get_total_users(),
-        "total_subscriptions": await db.get_total_subscriptions(),
-        "total_users_with_active_business_bot": await db.get_total_users_with_active_business_bot(),
-        "total_messages": await db.get_total_messages(),
-        "total_edited_messages": await db.get_total_edited_messages(),
-        "total_deleted_messages": await db.get_total_deleted_messages(),
-        "subscription_price": await db.get_subscription_price(),
-    }
+# Статистика читается из сводной таблицы, которая обновляется при каждой записи,
+# поэтому кэш не нужен и значения всегда актуальны
+async def get_statistics():
+    stats = await db.get_statistics()
+    stats["subscription_price"] = await db.get_subscription_price()
+    return stats
 
 # Генерация текста для админ-панели
 async def generate_admin_panel_text(stats):
@@ -58,9 +74,18 @@ async def generate_admin_panel_text(stats):
 - /price цена - установить цену подписки
 - /ban айди_пользователя причина - заблокировать пользователя
 - /unban айди_пользователя - разблокировать пользователя
+- /bulk give дни | ban причина | unban - подписью к CSV/TXT-файлу со списком ID или username
 - /broadcast текст - отправить сообщение всем пользователям
+- /broadcast_to сегмент[:параметр] текст - рассылка по сегменту аудитории
+- /audience [сегмент[:параметр]] - сегменты и оценка числа получателей
+- /broadcast_cancel номер - остановить рассылку
 - /stats - подробная статистика использования
+- /activity [айди_пользователя] - графики активности
+- /export таблица [jsonl|csv] - выгрузить таблицу файлом
+- /backup - создать резервную копию базы
 - /logs - последние ошибки бота
+- /sqlprofile [reset] - самые дорогие и повторяющиеся SQL-запросы
+- /apistats [reset] - вызовы Bot API по методам и обработчикам
 
 📊 <b>Статистика бота</b>
 - Всего пользователей: {stats['total_users']}
@@ -73,12 +98,12 @@ async def generate_admin_panel_text(stats):
 
 # Хэндлеры
 from aiogram.types import CallbackQuery
-from bot.keyboards.user import admin_keyboard
+from bot.keyboards.user import admin_keyboard, get_broadcast_segments_keyboard
 
 @admin_router.message(F.text == "/admin")
 async def admin_panel(message: Message):
     try:
-        stats = await get_cached_statistics()
+        stats = await get_statistics()
         text = await generate_admin_panel_text(stats)
         await message.answer(text, parse_mode=ParseMode.HTML, reply_markup=admin_keyboard)
     except Exception as e:
@@ -99,7 +124,7 @@ async def give_subscription(message: Message):
             await message.answer("Пользователь не найден.")
             return
 
-        await db.create_subscription(user_telegram_id=request.user_id, end_date=datetime.now() + timedelta(days=request.days))
+        await entitlements.grant(request.user_id, datetime.now() + timedelta(days=request.days))
         await message.answer(f"Подписка выдана пользователю {request.user_id} на {request.days} дней.")
     except ValueError as e:
         await message.answer(f"Некорректные данные: {e}")
@@ -159,12 +184,105 @@ async def unban_user(message: Message):
     except Exception as e:
         await message.answer(f"Ошибка при разблокировке пользователя: {e}")
 
+BULK_USAGE = (
+    "Отправьте CSV или текстовый файл со списком Telegram ID или username (по одному в строке) "
+    "с подписью:\n"
+    "/bulk give количество_дней — выдать подписку\n"
+    "/bulk ban причина — заблокировать\n"
+    "/bulk unban — разблокировать"
+)
+
+@admin_router.message(Command("bulk"))
+async def bulk_command(message: Message, command: CommandObject):
+    if not message.document or not command.args:
+        await message.answer(BULK_USAGE)
+        return
+    if message.document.file_size and message.document.file_size > BULK_MAX_FILE_SIZE:
+        await message.answer(f"Файл слишком большой: не больше {BULK_MAX_FILE_SIZE // 1024} КБ.")
+        return
+    action, _, argument = command.args.strip().partition(" ")
+    try:
+        content = await message.bot.download(message.document)
+        rows = parse_rows(content.read())
+        if not rows:
+            await message.answer("В файле нет ни одной строки с ID или username.")
+            return
+        # Все изменения применяются одной транзакцией: при ошибке не меняется ничего
+        summary = await apply_bulk_action(action.lower(), rows, argument.strip())
+    except ValueError as e:
+        await message.answer(f"❌ {e}\n\n{BULK_USAGE}")
+        return
+    except Exception as e:
+        logger.error(f"Ошибка массовой операции {action}: {e}")
+        await message.answer(f"Ошибка массовой операции, изменения не применены: {e}")
+        return
+
+    lines = [f"✅ Обработано строк: {len(rows)}"]
+    lines.extend(f"- {html.escape(result)}: {count}" for result, count in summary.items())
+    await message.answer_document(
+        BufferedInputFile(render_report(rows), filename=f"bulk_{action.lower()}_report.csv"),
+        caption="\n".join(lines)
+    )
+
+@admin_router.message(Command("broadcast_cancel"))
+async def broadcast_cancel_command(message: Message):
+    try:
+        broadcast_id = int(message.text.split()[1])
+    except (IndexError, ValueError):
+        await message.answer("Используйте формат: /broadcast_cancel номер_рассылки")
+        return
+    if await broadcast_engine.cancel(broadcast_id):
+        await message.answer(f"⛔️ Рассылка #{broadcast_id} остановлена.")
+    else:
+        await message.answer(f"Рассылка #{broadcast_id} не выполняется.")
+
+def _parse_segment(value: str):
+    """Разобрать «сегмент[:параметр]» в пару (сегмент, параметр)."""
+    segment, _, param = value.partition(":")
+    return segment, param or None
+
+@admin_router.message(Command("audience"))
+async def audience_command(message: Message):
+    args = message.text.split(maxsplit=1)
+    if len(args) == 1:
+        lines = ["<b>Сегменты аудитории:</b>"]
+        for name, segment in BROADCAST_SEGMENTS.items():
+            hint = f":параметр ({segment.param_hint})" if segment.param_hint else ""
+            lines.append(f"- <code>{name}{hint}</code> — {segment.title}")
+            if segment.caveat:
+                lines.append(f"  {html.escape(segment.caveat)}")
+        await message.answer("\n".join(lines), parse_mode=ParseMode.HTML)
+        return
+    segment, param = _parse_segment(args[1].strip())
+    try:
+        total = await estimate_segment(segment, param)
+    except ValueError as e:
+        await message.answer(f"❌ {e}")
+        return
+    await message.answer(f"Сегмент {args[1].strip()}\n{describe_estimate(segment, total)}")
+
+@admin_router.message(Command("broadcast_to"))
+async def broadcast_to_command(message: Message):
+    args = message.text.split(maxsplit=2)
+    if len(args) < 3 or not args[2].strip():
+        await message.answer("Используйте формат: /broadcast_to сегмент[:параметр] текст\nСписок сегментов: /audience")
+        return
+    segment, param = _parse_segment(args[1])
+    try:
+        await broadcast_engine.launch(args[2], message.chat.id, segment, param)
+    except ValueError as e:
+        await message.answer(f"❌ {e}")
+    except Exception as e:
+        await message.answer(f"Ошибка при рассылке сообщения: {e}")
+
 @admin_router.message(F.text.startswith("/broadcast"))
 async def broadcast_message(message: Message):
     try:
         text = message.text[len("/broadcast "):]
-        await db.broadcast_message(text)
-        await message.answer("Сообщение успешно разослано всем пользователям.")
+        if not text.strip():
+            await message.answer("Используйте формат: /broadcast текст")
+            return
+        await broadcast_engine.launch(text, message.chat.id)
     except Exception as e:
         await message.answer(f"Ошибка при рассылке сообщения: {e}")
 
@@ -172,7 +290,7 @@ async def broadcast_message(message: Message):
 @admin_router.message(Command("stats"))
 async def detailed_stats(message: Message):
     try:
-        stats = await get_cached_statistics()
+        stats = await get_statistics()
         detailed_stats_text = f"""
         Подробная статистика:
         - Всего пользователей: {stats['total_users']}
@@ -187,14 +305,174 @@ async def detailed_stats(message: Message):
         await message.answer(f"Ошибка при получении статистики: {e}")
 
 
+@admin_router.message(Command("activity"))
+async def activity_chart(message: Message):
+    try:
+        args = message.text.split()
+        now = datetime.now()
+        day_ago = now - timedelta(days=1)
+        month_ago = now - timedelta(days=30)
+
+        if len(args) > 1:
+            user_id = int(args[1])
+            hourly = await db.get_user_activity(user_id, since=day_ago)
+            daily = await db.get_user_activity(user_id, since=month_ago, daily=True)
+            title = f"Активность пользователя {user_id}"
+        else:
+            hourly = await db.get_global_activity(since=day_ago, hourly=True)
+            daily = await db.get_global_activity(since=month_ago)
+            title = "Активность бота"
+
+        lines = [f"📈 <b>{title}</b>", "", "<b>24 часа</b> (новые сообщения по часам):"]
+        lines.append(render_sparkline(fill_series(hourly, day_ago, timedelta(hours=1))))
+        lines.append("")
+        lines.append("<b>30 дней</b> (по суткам):")
+        for key, label in (("new", "📨 Новые"), ("edited", "✏️ Изменённые"), ("deleted", "🗑 Удалённые")):
+            series = fill_series(daily, month_ago, timedelta(days=1), key=key)
+            lines.append(f"{label}: {render_sparkline(series)} Σ {sum(series)}")
+        await message.answer("\n".join(lines), parse_mode=ParseMode.HTML)
+    except ValueError:
+        await message.answer("Используйте формат: /activity [айди_пользователя]")
+    except Exception as e:
+        logger.error(f"Ошибка при построении графика активности: {e}")
+        await message.answer(f"Ошибка при получении активности: {e}")
+
+@admin_router.message(Command("export"))
+async def export_command(message: Message):
+    args = message.text.split()
+    if len(args) not in (2, 3) or args[1] not in EXPORT_TABLES or (len(args) == 3 and args[2] not in EXPORT_FORMATS):
+        await message.answer(
+            f"Используйте формат: /export таблица [{'|'.join(EXPORT_FORMATS)}]\n"
+            f"Таблицы: {', '.join(EXPORT_TABLES)}"
+        )
+        return
+
+    table_name = args[1]
+    fmt = args[2] if len(args) == 3 else EXPORT_FORMATS[0]
+    path = None
+    try:
+        await message.answer(f"⏳ Выгружаю {table_name}...")
+        path = await export_table(table_name, fmt)
+        await message.answer_document(FSInputFile(path), caption=f"📦 {table_name} ({fmt}, gzip)")
+    except Exception as e:
+        logger.error(f"Ошибка при выгрузке {table_name}: {e}")
+        await message.answer(f"Ошибка при выгрузке: {e}")
+    finally:
+        if path is not None:
+            path.unlink(missing_ok=True)
+
+@admin_router.message(Command("backup"))
+async def backup_command(message: Message):
+    try:
+        await message.answer("⏳ Создаю резервную копию базы...")
+        path = await create_backup()
+        backups = list_backups()
+        await message.answer(
+            f"💾 Резервная копия создана: <code>{path}</code>\n"
+            f"Размер: {path.stat().st_size / 1024:.1f} КБ\n"
+            f"Всего копий: {len(backups)}",
+            parse_mode=ParseMode.HTML
+        )
+    except Exception as e:
+        logger.error(f"Ошибка при создании резервной копии: {e}")
+        await message.answer(f"Ошибка при создании резервной копии: {e}")
+
+# Ограничение длины, чтобы список ошибок поместился в одно сообщение Telegram
+LOGS_LIMIT = 15
+LOGS_MESSAGE_LENGTH = 200
+
 @admin_router.message(Command("logs"))
 async def show_logs(message: Message):
     try:
-        logs = await db.get_recent_logs() # Assumed function in db.py
-        log_message = "\n".join(logs) or "Нет записей в логах."
-        await message.answer(f"Последние ошибки бота:\n{log_message}")
+        groups = error_aggregator.recent(LOGS_LIMIT)
+        if not groups:
+            await message.answer("Нет записей в логах.")
+            return
+        lines = [f"<b>Последние ошибки бота</b> (всего записей: {error_aggregator.total})"]
+        for group in groups:
+            text = group.message
+            if len(text) > LOGS_MESSAGE_LENGTH:
+                text = text[:LOGS_MESSAGE_LENGTH] + "…"
+            lines.append(
+                f"\n<b>×{group.count}</b> {group.last_seen:%d.%m %H:%M:%S} "
+                f"(впервые {group.first_seen:%d.%m %H:%M:%S}) <code>{html.escape(group.logger)}</code>\n"
+                f"{html.escape(text)}"
+            )
+        await message.answer("\n".join(lines), parse_mode=ParseMode.HTML)
     except Exception as e:
         await message.answer(f"Ошибка при получении логов: {e}")
+
+SQLPROFILE_LIMIT = 6
+SQLPROFILE_SHAPE_LENGTH = 150
+
+def _short_shape(shape: str) -> str:
+    shape = display_shape(shape)
+    if len(shape) > SQLPROFILE_SHAPE_LENGTH:
+        shape = shape[:SQLPROFILE_SHAPE_LENGTH] + "…"
+    return html.escape(shape)
+
+@admin_router.message(Command("sqlprofile"))
+async def show_sql_profile(message: Message, command: CommandObject):
+    try:
+        if (command.args or "").strip() == "reset":
+            sql_profiler.reset()
+            await message.answer("Статистика SQL-запросов сброшена.")
+            return
+        statements = sql_profiler.top_statements(SQLPROFILE_LIMIT)
+        if not statements:
+            await message.answer("Запросов к базе еще не было.")
+            return
+        lines = [f"<b>SQL-профиль</b> с {sql_profiler.started:%d.%m %H:%M:%S}", "", "<b>Самые дорогие запросы:</b>"]
+        for stats in statements:
+            lines.append(
+                f"{stats.total_seconds:.2f} с, ×{stats.count}, среднее {stats.total_seconds / stats.count * 1000:.1f} мс, "
+                f"макс. {stats.max_seconds * 1000:.1f} мс\n<code>{_short_shape(stats.shape)}</code>"
+            )
+        lines += ["", "<b>Запросов на апдейт по обработчикам:</b>"]
+        for name, updates, queries in sql_profiler.handlers()[:SQLPROFILE_LIMIT]:
+            lines.append(f"<code>{html.escape(name)}</code>: {queries / updates:.1f} (апдейтов {updates})")
+        repeats = sql_profiler.repeats(SQLPROFILE_LIMIT)
+        lines += ["", f"<b>Повторы одного запроса за апдейт (от {sql_profiler.repeat_threshold} раз):</b>"]
+        if not repeats:
+            lines.append("не найдено")
+        for incident in repeats:
+            lines.append(
+                f"<code>{html.escape(incident.handler)}</code>: в {incident.updates} апд., до ×{incident.max_repeats} "
+                f"({incident.last_seen:%d.%m %H:%M})\n<code>{_short_shape(incident.shape)}</code>"
+            )
+        await message.answer("\n".join(lines), parse_mode=ParseMode.HTML)
+    except Exception as e:
+        await message.answer(f"Ошибка при получении SQL-профиля: {e}")
+
+APISTATS_LIMIT = 10
+
+@admin_router.message(Command("apistats"))
+async def show_api_stats(message: Message, command: CommandObject):
+    try:
+        if (command.args or "").strip() == "reset":
+            api_accounting.reset()
+            await message.answer("Статистика вызовов Bot API сброшена.")
+            return
+        methods = api_accounting.methods()
+        if not methods:
+            await message.answer("Вызовов Bot API еще не было.")
+            return
+        lines = [f"<b>Вызовы Bot API</b> с {api_accounting.started:%d.%m %H:%M:%S}", "", "<b>По методам:</b>"]
+        for stats in methods[:APISTATS_LIMIT]:
+            line = (f"<code>{stats.method}</code>: ×{stats.calls}, ошибок {stats.errors}, flood wait {stats.flood_waits}, "
+                    f"среднее {stats.total_seconds / stats.calls * 1000:.0f} мс, макс. {stats.max_seconds * 1000:.0f} мс")
+            if stats.last_error:
+                line += f"\n  последняя ошибка: {html.escape(stats.last_error[:LOGS_MESSAGE_LENGTH])}"
+            lines.append(line)
+        lines += ["", "<b>Обработчик → метод:</b>"]
+        for handler, method, calls, errors in api_accounting.pairs(APISTATS_LIMIT):
+            lines.append(f"<code>{html.escape(handler)}</code> → <code>{method}</code>: ×{calls}, ошибок {errors}")
+        lines += ["", "<b>Вызовов на апдейт:</b>"]
+        for handler, updates, calls in api_accounting.handlers()[:APISTATS_LIMIT]:
+            lines.append(f"<code>{html.escape(handler)}</code>: {calls / updates:.1f} (апдейтов {updates})")
+        await message.answer("\n".join(lines), parse_mode=ParseMode.HTML)
+    except Exception as e:
+        await message.answer(f"Ошибка при получении статистики Bot API: {e}")
 # Callback handlers
 @admin_router.callback_query(F.data == "admin_stats")
 async def admin_stats_callback(callback: CallbackQuery):
@@ -210,6 +488,7 @@ from aiogram.fsm.state import State, StatesGroup
 
 class AdminStates(StatesGroup):
     waiting_for_broadcast = State()
+    waiting_for_broadcast_param = State()
     waiting_for_price = State()
     waiting_for_give_username = State()
     waiting_for_give_days = State()
@@ -217,43 +496,51 @@ class AdminStates(StatesGroup):
     waiting_for_unban = State()
 
 @admin_router.callback_query(F.data == "admin_broadcast")
-async def admin_broadcast_callback(callback: CallbackQuery, state: FSMContext):
+async def admin_broadcast_callback(callback: CallbackQuery):
     await callback.answer()
-    await callback.message.answer("Введите текст для рассылки:")
+    await callback.message.answer(
+        "Выберите аудиторию рассылки:",
+        reply_markup=get_broadcast_segments_keyboard(
+            {name: segment.title for name, segment in BROADCAST_SEGMENTS.items()}
+        )
+    )
+
+async def _ask_broadcast_text(message: Message, state: FSMContext, segment: str, param=None):
+    """Показать оценку числа получателей и запросить текст рассылки."""
+    total = await estimate_segment(segment, param)
+    await state.update_data(segment=segment, segment_param=param)
     await state.set_state(AdminStates.waiting_for_broadcast)
+    await message.answer(f"{describe_estimate(segment, total)}\nВведите текст для рассылки:")
+
+@admin_router.callback_query(F.data.startswith("broadcast_segment_"))
+async def broadcast_segment_callback(callback: CallbackQuery, state: FSMContext):
+    await callback.answer()
+    segment = callback.data[len("broadcast_segment_"):]
+    if segment not in BROADCAST_SEGMENTS:
+        await callback.message.answer("Неизвестный сегмент.")
+        return
+    if BROADCAST_SEGMENTS[segment].param_hint:
+        await state.update_data(segment=segment)
+        await state.set_state(AdminStates.waiting_for_broadcast_param)
+        await callback.message.answer(f"Введите параметр сегмента: {BROADCAST_SEGMENTS[segment].param_hint}")
+        return
+    await _ask_broadcast_text(callback.message, state, segment)
+
+@admin_router.message(AdminStates.waiting_for_broadcast_param)
+async def process_broadcast_param(message: Message, state: FSMContext):
+    data = await state.get_data()
+    try:
+        await _ask_broadcast_text(message, state, data.get("segment", "all"), message.text.strip())
+    except ValueError as e:
+        await message.answer(f"❌ {e}. Попробуйте еще раз:")
 
 @admin_router.message(AdminStates.waiting_for_broadcast)
 async def process_broadcast_text(message: Message, state: FSMContext):
     try:
-        users = await db.get_all_users()
-        if not users:
-            await message.answer("Нет пользователей для рассылки.")
-            await state.clear()
-            return
-
-        sent_count = 0
-        failed_count = 0
-
-        for user in users:
-            # Пропускаем только заблокированных
-            if user.is_banned:
-                continue
-            try:
-                await message.bot.send_message(
-                    chat_id=user.telegram_id,
-                    text=message.text,
-                    disable_web_page_preview=True
-                )
-                sent_count += 1
-                await asyncio.sleep(0.05)  # Небольшая задержка между отправками
-            except Exception as e:
-                failed_count += 1
-                logger.error(f"Ошибка отправки пользователю {user.telegram_id}: {str(e)}")
-
-        await message.answer(
-            f"Рассылка завершена\n"
-            f"✅ Успешно: {sent_count}\n"
-            f"❌ Ошибок: {failed_count}"
+        data = await state.get_data()
+        # Рассылка идет в фоне, прогресс обновляется в отдельном сообщении
+        await broadcast_engine.launch(
+            message.text, message.chat.id, data.get("segment", "all"), data.get("segment_param")
         )
     except Exception as e:
         logger.error(f"Ошибка при рассылке: {str(e)}")
@@ -303,17 +590,7 @@ async def process_give_days(message: Message, state: FSMContext):
         user = await db.get_user(user_id)
         if user:
             end_date = datetime.now() + timedelta(days=days)
-            await db.create_subscription(
-                user_telegram_id=user_id,
-                end_date=end_date
-            )
-            # Обновляем дату в таблице users
-            async with db.get_db_session() as session:
-                await session.execute(
-                    update(User)
-                    .where(User.telegram_id == user.telegram_id)
-                    .values(subscription_end_date=end_date)
-                )
+            await entitlements.grant(user_id, end_date)
             await message.answer(f"✅ Подписка выдана пользователю ID:{user_id} на {days} дней")
         else:
             await message.answer("Пользователь не найден")
@@ -412,15 +689,7 @@ async def process_give_days(message: Message, state: FSMContext):
         user = await db.get_user_by_username(username)
         if user:
             end_date = datetime.now() + timedelta(days=days)
-            await db.create_subscription(user_telegram_id=user.telegram_id, 
-                                      end_date=end_date)
-            # Обновляем дату в таблице users
-            async with db.get_db_session() as session:
-                await session.execute(
-                    update(User)
-                    .where(User.telegram_id == user.telegram_id)
-                    .values(subscription_end_date=end_date)
-                )
+            await entitlements.grant(user.telegram_id, end_date)
             await message.answer(f"✅ Подписка выдана пользователю {username} на {days} дней")
         else:
             await message.answer("Пользователь не найден")
@@ -522,19 +791,22 @@ async def cleanup_database_handler(message: Message):
     try:
         result = await db.cleanup_database()
         if result:
+            # Подписки удалены в обход сервиса: кэш прав и куча окончаний
+            # иначе пропускали бы бывших владельцев до перезапуска
+            await entitlements.reload()
+            await expiry_engine.reload()
             await message.answer("✅ Заебись! База данных очищена нахуй!")
         else:
             await message.answer("❌ Бля, что-то пошло по пизде при очистке...")
     except Exception as e:
         await message.answer(f"❌ Пиздец какой-то: {str(e)}")
 
-from sqlalchemy.sql.expression import update
-from bot.database.database import User
 async def send_stats_message():
     """Отправка статистики в чат"""
     try:
         from main import bot  # Импортируем глобальный экземпляр бота
-        stats = await get_cached_statistics()
+        stats = await get_statistics()
+        trend = await get_trend(hours=24)
         stats_text = f"""
 📊 <b>Статистика бота</b>
 
@@ -543,6 +815,9 @@ async def send_stats_message():
 ✏️ Отредактировано: {stats['total_edited_messages']}
 🗑 Удалено: {stats['total_deleted_messages']}
 
+📈 <b>За 24 часа:</b> +{trend['new']} новых, {trend['edited']} изм., {trend['deleted']} удал.
+{trend['sparkline']}
+
 <i>Последнее обновление: {datetime.now().strftime('%H:%M:%S')}</i>
 """
         await bot.send_message(chat_id=-1002425437738, text=stats_text, parse_mode=ParseMode.HTML)
@@ -15,6 +15,12 @@ from apscheduler.schedulers.asyncio import AsyncIOScheduler # Added import for s
 import bot.database.database as db
 import bot.assets.texts as texts
 import bot.keyboards.user as kb
+from bot.services.activity import record_activity, EVENT_NEW, EVENT_DELETED
+from bot.services.animations import animation_engine, Animation, Frame, FRAME_NOTICE, FRAME_REPLACE
+from bot.services.entitlements import entitlements
+from bot.services.tasks import task_registry, ChatUnavailableError, TaskLimitError
+from bot.utils.delivery import classify_delivery_error, UNREACHABLE_BLOCKED, UNREACHABLE_DEACTIVATED
+from bot.utils.metrics import registry
 
 # Настройка логирования
 logging.basicConfig(level=logging.INFO)
@@ -22,6 +28,17 @@ logger = logging.getLogger(__name__)
 
 business_router = Router()
 
+BUSINESS_EVENTS = registry.counter("bot_business_events_total", "Входящие бизнес-события", ["kind"])
+ARCHIVE_SENDS = registry.counter(
+    "bot_archive_sends_total", "Копирование бизнес-сообщений в архивные каналы", ["result"]
+)
+DELETION_REPLAYS = registry.counter(
+    "bot_deletion_replays_total", "Пересылка удаленных сообщений владельцу", ["result"]
+)
+DELETION_PROBE_FAILURES = registry.counter(
+    "bot_deletion_probe_failures_total", "Неудачные попытки найти удаленное сообщение в архивном канале"
+)
+
 # Регулярное выражение для проверки математических выражений
 math_expression_pattern = re.compile(r'^Кальк [\d+\-*/(). ]+$')
 
@@ -69,36 +86,34 @@ async def handle_math_expression(message: Message):
         logger.error(f"Ошибка при вычислении выражения: {e}")
         await calc_message.edit_text("❌ Ошибка при вычислении выражения")
 
+# Кадры анимаций: последовательности описываются данными, а показывает их animation_engine
+LOVE_FRAMES = [Frame("Я")] + [
+    Frame(text, 1) for text in ["Я хочу", "Я хочу сказать", "Я хочу сказать, что", "Я хочу сказать, что я",
+                                "Я хочу сказать, что я люблю", "Я хочу сказать, что я люблю тебя 💖"]
+]
+
+def love1_frames():
+    original_text = "1234567890"
+    target_text = "ЯЛюблюТебя"
+    yield Frame(original_text)
+    for i in range(len(target_text)):
+        yield Frame(target_text[:i + 1] + original_text[i + 1:], 0.10)
+
+SECRET_FRAMES = [Frame("🤫")] + [
+    Frame(f"{emoji} Я хочу сказать тебе кое-что...", 1) for emoji in ["🤫", "🤔", "🤭", "😏", "😌", "🥰"]
+] + [Frame("Ты самый охуенный человек на свете! 💖")]
+
 async def handle_love_command(message: Message):
     """Обработка команды 'love'."""
-    sent_message = await message.answer("Я")
-    texts = ["Я хочу", "Я хочу сказать", "Я хочу сказать, что", "Я хочу сказать, что я", "Я хочу сказать, что я люблю", "Я хочу сказать, что я люблю тебя 💖"]
-    for text in texts:
-        await asyncio.sleep(1)
-        await sent_message.edit_text(text)
+    animation_engine.start_for(message, LOVE_FRAMES, kind="love")
 
 async def handle_love1_command(message: Message):
     """Обработка команды 'love1'."""
-    original_text = "1234567890"
-    target_text = "ЯЛюблюТебя"
-    sent_message = await message.answer(original_text)
-    for i in range(len(target_text)):
-        new_text = target_text[:i + 1] + original_text[i + 1:]
-        await asyncio.sleep(0.10)
-        await sent_message.edit_text(new_text)
+    animation_engine.start_for(message, love1_frames(), kind="love1")
 
 async def handle_secret_command(message: Message):
     """Обработка команды 'Secret'."""
-    emojis = ["🤫", "🤔", "🤭", "😏", "😌", "🥰"]
-    text = "Я хочу сказать тебе кое-что..."
-    sent_message = await message.answer("🤫")
-
-    for emoji in emojis:
-        await asyncio.sleep(1)
-        await sent_message.edit_text(f"{emoji} {text}")
-
-    final_text = "Ты самый охуенный человек на свете! 💖"
-    await sent_message.edit_text(final_text)
+    animation_engine.start_for(message, SECRET_FRAMES, kind="secret")
 
 async def handle_sexy_command(message: Message):
     """Обработка команды 'sexy'."""
@@ -108,45 +123,36 @@ async def handle_sexy_command(message: Message):
         await asyncio.sleep(1)
         await sent_message.edit_text(text)
 
-# Словарь для хранения тасков Pin
-pin_tasks = {}
-
-async def send_hearts(message: Message, chat_id: int):
-    """Отправка и редактирование сердечек."""
+def hearts_frames():
+    """Бесконечная смена сердечек: каждый цвет растет от одного до десяти."""
+    hearts = ["❤️", "🧡", "💛", "💚", "💙", "💜", "🤎", "🖤", "🤍", "💝"]
+    yield Frame("❤️")
+    while True:
+        for heart_color in hearts:
+            for heart_count in range(1, 11):
+                yield Frame(heart_color * heart_count, 1)
+
+def send_hearts(bot: Bot, chat_id: int, connection_id: str, params: dict) -> Animation:
+    """Запуск сердечек в чате."""
+    return animation_engine.start(
+        bot, chat_id, hearts_frames(), kind="pin", connection_id=connection_id,
+        cancel_text="💔 Pin остановлен", error_text="❌ Произошла ошибка",
+    )
+
+async def start_chat_task(message: Message, kind: str, owner_id: int, **params):
+    """Запустить задачу реестра в чате сообщения; об отказе сообщить в чат."""
     try:
-        hearts = ["❤️", "🧡", "💛", "💚", "💙", "💜", "🤎", "🖤", "🤍", "💝"]
-        sent_message = await message.answer("❤️")
-        last_text = "❤️"
-
-        while True:
-            for heart_color in hearts:
-                heart_count = 1
-                while heart_count <= 10:
-                    try:
-                        await asyncio.sleep(1)
-                        new_text = heart_color * heart_count
-                        if new_text != last_text:
-                            await sent_message.edit_text(new_text)
-                            last_text = new_text
-                        heart_count += 1
-                    except Exception as e:
-                        logger.error(f"Ошибка при редактировании сердечка: {e}")
-                        continue
-    except asyncio.CancelledError:
-        await message.answer("💔 Pin остановлен")
-        raise
-    except Exception as e:
-        logger.error(f"Ошибка в send_hearts: {e}")
-        await message.answer("❌ Произошла ошибка")
-    finally:
-        if chat_id in pin_tasks:
-            del pin_tasks[chat_id]
+        await task_registry.start(kind, message.bot, message.chat.id, message.business_connection_id,
+                                  owner_id, params)
+    except (TaskLimitError, ChatUnavailableError) as e:
+        await message.answer(f"❌ {e}")
 
 
 
 @business_router.business_connection()
 async def business_connection(event: BusinessConnection):
     """Обработка подключения бизнес-бота."""
+    BUSINESS_EVENTS.inc(kind="connection_enabled" if event.is_enabled else "connection_disabled")
     try:
         if event.is_enabled:
             user = await db.get_user(telegram_id=event.user.id)
@@ -183,9 +189,13 @@ async def business_connection(event: BusinessConnection):
                     parse_mode=ParseMode.HTML
                 )
             except Exception as send_error:
-                if "bot was blocked by the user" in str(send_error):
+                # В этом блоке есть и отправка в канал, поэтому учитываем только
+                # ошибки, однозначно относящиеся к пользователю
+                reason = classify_delivery_error(send_error)
+                if reason in (UNREACHABLE_BLOCKED, UNREACHABLE_DEACTIVATED):
                     await db.update_user_business_bot_active(telegram_id=event.user.id, business_bot_active=False)
-                    logger.warning(f"User {event.user.id} blocked the bot")
+                    await db.mark_users_unreachable({event.user.id: reason})
+                    logger.warning(f"User {event.user.id} is unreachable: {reason}")
                 else:
                     raise send_error
         else:
@@ -215,7 +225,12 @@ async def business_connection(event: BusinessConnection):
                     parse_mode=ParseMode.HTML
                 )
             except Exception as send_error:
-                if "bot was blocked by the user" not in str(send_error):
+                # В этом блоке есть и отправка в канал, поэтому учитываем только
+                # ошибки, однозначно относящиеся к пользователю
+                reason = classify_delivery_error(send_error)
+                if reason in (UNREACHABLE_BLOCKED, UNREACHABLE_DEACTIVATED):
+                    await db.mark_users_unreachable({event.user.id: reason})
+                else:
                     raise send_error
     except Exception as e:
         logger.error(f"Ошибка при обработке бизнес-подключения: {e}")
@@ -223,21 +238,21 @@ async def business_connection(event: BusinessConnection):
 @business_router.business_message()
 async def business_message(message: Message):
     """Обработка бизнес-сообщений."""
+    BUSINESS_EVENTS.inc(kind="message")
     try:
         # Получаем информацию о подключении
         connection = await message.bot.get_business_connection(message.business_connection_id)
-        user = await db.get_user(telegram_id=connection.user.id)
 
-        # Проверяем подписку
-        if not user or not user.subscription_end_date or user.subscription_end_date < datetime.now():
+        # Проверяем подписку по кэшу, без запроса к базе
+        if not entitlements.is_entitled(connection.user.id):
             await message.answer("❌ Твоя подписка закончилась!\n\nНажми на кнопку '💳 Купить подписку' чтобы продолжить пользоваться ботом.")
             return
 
-        # Логируем каждое входящее сообщение
+        # Логируем каждое входящее сообщение (без текста: переписка владельцев в логи не пишется)
         logger.info(
             f"📨 Новое сообщение:"
             f"\n👤 От: {message.from_user.first_name} ({message.from_user.id})"
-            f"\n💭 Текст: {message.text if message.text else '[медиа]'}"
+            f"\n💭 Текст: {f'{len(message.text)} симв.' if message.text else '[медиа]'}"
             f"\n🕒 Время: {datetime.now().strftime('%H:%M:%S')}"
         )
 
@@ -396,6 +411,7 @@ async def business_message(message: Message):
                 f"\n📨 Канал: {target_channel}"
                 #f"\n⏱ Время обработки: {(datetime.now() - datetime.strptime(message_time, '%H:%M:%S')).total_seconds():.2f} сек"
             )
+            ARCHIVE_SENDS.inc(result="ok")
 
         except Exception as e:
             logger.error(f"Ошибка при пересылке сообщения: {str(e)}")
@@ -405,7 +421,9 @@ async def business_message(message: Message):
                     chat_id=CHANNELS['text'][0],
                     parse_mode=ParseMode.HTML
                 )
+                ARCHIVE_SENDS.inc(result="fallback")
             except Exception as backup_error:
+                ARCHIVE_SENDS.inc(result="failed")
                 if "This type of message can't be copied" in str(backup_error):
                     await message.answer("⚠️ Это сообщение нельзя переслать из-за ограничений Telegram")
                 else:
@@ -421,28 +439,24 @@ async def business_message(message: Message):
             f"\n👥 Кому: {connection.user.first_name} ({connection.user.id})"
             f"\n📝 ID оригинального сообщения: {message.message_id}"
             f"\n📨 ID нового сообщения: {message_new.message_id}"
-            f"\n💬 Текст: {message.text if message.text else '[медиа]'}"
+            f"\n💬 Текст: {f'{len(message.text)} симв.' if message.text else '[медиа]'}"
             f"\n📨 Канал отправки: {target_channel}"
             f"\n⏰ Время отправки: {datetime.now().strftime('%H:%M:%S')}"
             f"\n🔄 Статус пользователя: {'Активен' if user.business_bot_active else 'Неактивен'}"
             f"\n💳 Подписка: {'Активна' if user.subscription_end_date and user.subscription_end_date > datetime.now() else 'Неактивна'}"
         )
         await db.increase_active_messages_count(user_telegram_id=connection.user.id)
+        await record_activity(connection.user.id, EVENT_NEW)
         await db.increment_messages_count(from_user_id=message.from_user.id, to_user_id=connection.user.id)
 
         # Обработка специальных команд с проверкой состояния модулей
         if message.text:
             # Проверка на команду "Онлайн+"
             if message.text.strip() == "Онлайн+":
-                chat_id = message.chat.id
-                if chat_id in online_tasks:
-                    # Если задача уже существует, останавливаем её
-                    online_tasks[chat_id].cancel()
-                    del online_tasks[chat_id]
-                else:
-                    # Создаем новую задачу для отправки статуса
-                    task = asyncio.create_task(send_online_status(message, chat_id, connection))
-                    online_tasks[chat_id] = task
+                # Если задача уже существует, останавливаем её, иначе запускаем (если команду дал владелец)
+                stopped = task_registry.stop(message.business_connection_id, message.chat.id, "online")
+                if not stopped and message.from_user.id == connection.user.id:
+                    await start_chat_task(message, "online", connection.user.id)
                 return
 
             if math_expression_pattern.match(message.text):
@@ -456,12 +470,8 @@ async def business_message(message: Message):
                     return
 
                 if message.text.strip().lower() == "pin":
-                    chat_id = message.chat.id
-                    if chat_id in pin_tasks:
-                        pin_tasks[chat_id].cancel()
-                        del pin_tasks[chat_id]
-                    task = asyncio.create_task(send_hearts(message, chat_id))
-                    pin_tasks[chat_id] = task
+                    # Новый pin заменяет запущенный в этом чате
+                    await start_chat_task(message, "pin", connection.user.id)
                 elif message.text.strip().lower() == "love":
                     await handle_love_command(message)
                 elif message.text.strip().lower() == "love1":
@@ -476,12 +486,7 @@ async def business_message(message: Message):
                         if target_number <= 0 or target_number > 100:
                             await message.answer("❌ Число должно быть от 1 до 100")
                             return
-                        chat_id = message.chat.id
-                        if chat_id in spam_tasks:
-                            spam_tasks[chat_id].cancel()
-                            del spam_tasks[chat_id]
-                        task = asyncio.create_task(send_spam(message, chat_id, target_number))
-                        spam_tasks[chat_id] = task
+                        await start_chat_task(message, "spam", connection.user.id, target_number=target_number)
                     except ValueError:
                         await message.answer("❌ Неверный формат числа")
 
@@ -492,12 +497,12 @@ async def business_message(message: Message):
 @business_router.deleted_business_messages()
 async def deleted_business_messages(event: BusinessMessagesDeleted):
     """Обработка удаленных бизнес-сообщений."""
+    BUSINESS_EVENTS.inc(kind="deleted")
     try:
         connection = await event.bot.get_business_connection(event.business_connection_id)
 
-        # Проверяем подписку и что сообщение предназначено этому пользователю
-        user = await db.get_user(telegram_id=connection.user.id)
-        if not user or not user.subscription_end_date or user.subscription_end_date < datetime.now():
+        # Проверяем подписку по кэшу, без запроса к базе
+        if not entitlements.is_entitled(connection.user.id):
             return
 
         # Проверяем, что уведомление предназначено для этого пользователя
@@ -527,11 +532,13 @@ async def deleted_business_messages(event: BusinessMessagesDeleted):
             return
 
         logger.info(f"✅ Бизнес-подключение получено для пользователя {connection.user.id}")
+        user = await db.get_user(telegram_id=connection.user.id)
 
         # Обрабатываем только валидные сообщения для этого пользователя
         for message_old in messages_to_process:
             if message_old and message_old.user_telegram_id == connection.user.id:
                     await db.increase_deleted_messages_count(user_telegram_id=connection.user.id)
+                    await record_activity(connection.user.id, EVENT_DELETED)
                     current_time = datetime.now().strftime("%H:%M:%S")
                     username = event.chat.username if event.chat.username else event.chat.first_name
                     user_link = f'<a href="tg://user?id={event.chat.id}">{username}</a>'
@@ -585,8 +592,10 @@ async def deleted_business_messages(event: BusinessMessagesDeleted):
                                     )
                                     break
                                 except Exception:
+                                    DELETION_PROBE_FAILURES.inc()
                                     continue
 
+                            DELETION_REPLAYS.inc(result="replayed" if message_found else "unavailable")
                             if not message_found:
                                 # Отправляем только одно уведомление, если сообщение не найдено
                                 text = f"🗑 {user_link} удалил для тебя сообщение\n⏰ Время удаления: {current_time}\n⚠️ Оригинальное сообщение недоступно"
@@ -597,6 +606,7 @@ async def deleted_business_messages(event: BusinessMessagesDeleted):
                                 )
 
                         except Exception as e:
+                            DELETION_REPLAYS.inc(result="error")
                             logger.error(f"Не удалось переслать удаленное сообщение: {e}")
                             # Отправляем уведомление об ошибке только если не удалось отправить сообщение
                             text = f"🗑 {user_link} удалил для тебя сообщение\n⏰ Время удаления: {current_time}"
@@ -618,94 +628,43 @@ async def check_inactive_chats(bot: Bot): # Placeholder function
 
 from config import BOT_TOKEN, HISTORY_GROUP_ID
 
-# Словарь для хранения тасков онлайн-статуса
-online_tasks = {}
-
-async def send_online_status(message: Message, chat_id: int, connection=None):
-    """Отправка статуса онлайн"""
-    try:
-        # Проверяем владельца
-        if connection and message.from_user.id != connection.user.id:
-            return
-
-        await message.answer("✅ Онлайн статус активирован")
-        last_message = None
-        while True:
-            try:
-                # Сначала удаляем предыдущее сообщение
-                if last_message:
-                    try:
-                        await last_message.delete()
-                    except Exception:
-                        pass
-
-                # Делаем небольшую паузу после удаления
-                await asyncio.sleep(0.5)
-
-                # Отправляем новое сообщение
-                moscow_tz = datetime.now(pytz.timezone('Europe/Moscow'))
-                current_time = moscow_tz.strftime("%H:%M:%S")
-                formatted_message = f"📱 Онлайн | ⏰ {current_time} МСК"
-                last_message = await message.answer(text=formatted_message)
-
-                # Ждем перед следующей итерацией
-                # Рандомная задержка от 5 до 10 секунд
-                await asyncio.sleep(random.uniform(5, 10))
-            except asyncio.CancelledError:
-                await message.answer("❌ Онлайн статус деактивирован")
-                raise
-            except Exception as e:
-                logger.error(f"Ошибка отправки онлайн статуса: {e}")
-                await message.answer("❌ Ошибка отправки статуса")
-                raise
-    except Exception as e:
-        logger.error(f"Ошибка в send_online_status: {e}")
-    finally:
-        if chat_id in online_tasks:
-            del online_tasks[chat_id]
-
-# Словарь для хранения тасков спама
-spam_tasks = {}
-
-async def send_spam(message: Message, chat_id: int, target_number: int = 100):
-    """Отправка спама с увеличивающимися числами"""
-    try:
-        await message.answer("✅ Спам активирован")
-        counter = 1
-        last_message = None
-
-        while counter <= target_number:
-            try:
-                # Удаляем предыдущее сообщение
-                if last_message:
-                    try:
-                        await last_message.delete()
-                    except Exception:
-                        pass
-
-                # Делаем паузу после удаления
-                await asyncio.sleep(0.05)
-
-                # Отправляем новое сообщение
-                moscow_tz = datetime.now(pytz.timezone('Europe/Moscow'))
-                current_time = moscow_tz.strftime("%H:%M:%S")
-                last_message = await message.answer(f"💣 Спам {counter} | ⏰ {current_time} МСК")
-                counter += 1
-
-                # Ждем перед следующей отправкой
-                await asyncio.sleep(0.05)
-
-            except asyncio.CancelledError:
-                await message.answer("❌ Спам остановлен")
-                raise
-
-    except Exception as e:
-        logger.error(f"Ошибка в send_spam: {e}")
-        await message.answer("❌ Произошла ошибка при спаме")
-    finally:
-        if chat_id in spam_tasks:
-            del spam_tasks[chat_id]
-        await message.answer("✅ Спам завершен")
+def _moscow_time() -> str:
+    return datetime.now(pytz.timezone('Europe/Moscow')).strftime("%H:%M:%S")
+
+def online_frames():
+    """Сообщение со статусом онлайн, которое пересылается заново каждые 5–10 секунд."""
+    yield Frame("✅ Онлайн статус активирован", mode=FRAME_NOTICE)
+    delay = 0.5
+    while True:
+        yield Frame(lambda: f"📱 Онлайн | ⏰ {_moscow_time()} МСК", delay, FRAME_REPLACE)
+        # Рандомная задержка от 5 до 10 секунд
+        delay = random.uniform(5, 10)
+
+def send_online_status(bot: Bot, chat_id: int, connection_id: str, params: dict) -> Animation:
+    """Запуск статуса онлайн в чате."""
+    return animation_engine.start(
+        bot, chat_id, online_frames(), kind="online", connection_id=connection_id,
+        cancel_text="❌ Онлайн статус деактивирован", error_text="❌ Ошибка отправки статуса",
+    )
+
+def spam_frames(target_number: int):
+    """Сообщения с растущим счетчиком, каждое следующее заменяет предыдущее."""
+    yield Frame("✅ Спам активирован", mode=FRAME_NOTICE)
+    for counter in range(1, target_number + 1):
+        yield Frame(lambda counter=counter: f"💣 Спам {counter} | ⏰ {_moscow_time()} МСК", 0.1, FRAME_REPLACE)
+
+def send_spam(bot: Bot, chat_id: int, connection_id: str, params: dict) -> Animation:
+    """Запуск спама с увеличивающимися числами"""
+    return animation_engine.start(
+        bot, chat_id, spam_frames(params.get("target_number", 100)), kind="spam", connection_id=connection_id,
+        cancel_text="❌ Спам остановлен", error_text="❌ Произошла ошибка при спаме",
+        finish_text="✅ Спам завершен",
+    )
+
+# Виды длительных задач; pin и онлайн-статус возобновляются после перезапуска
+task_registry.register_kind("pin", send_hearts)
+task_registry.register_kind("online", send_online_status)
+task_registry.register_kind("spam", send_spam, resumable=False)
 
 @business_router.message(lambda message: message.text and (message.text.lower() in {"онлайн+", "онлайн-", "стоп"} or message.text.lower().startswith("спам")))
 async def handle_online_status(message: Message):
@@ -719,26 +678,17 @@ async def handle_online_status(message: Message):
         if not connection or message.from_user.id != connection.user.id:
             return
 
-        # Проверяем подписку
-        user = await db.get_user(telegram_id=connection.user.id)
-        if not user or not user.subscription_end_date or user.subscription_end_date < datetime.now():
+        # Проверяем подписку по кэшу, без запроса к базе
+        if not entitlements.is_entitled(connection.user.id):
             await message.answer("❌ Твоя подписка закончилась!\n\nНажми на кнопку '💳 Купить подписку' чтобы продолжить пользоваться ботом.")
             return
 
         if command == "онлайн+":
-            # Отменяем существующую задачу, если есть
-            if chat_id in online_tasks:
-                online_tasks[chat_id].cancel()
-                del online_tasks[chat_id]
-
-            # Создаем новую задачу
-            task = asyncio.create_task(send_online_status(message, chat_id))
-            online_tasks[chat_id] = task
+            # Новая задача заменяет запущенную в этом чате
+            await start_chat_task(message, "online", connection.user.id)
 
         elif command == "онлайн-":
-            if chat_id in online_tasks:
-                online_tasks[chat_id].cancel()
-                del online_tasks[chat_id]
+            if task_registry.stop(message.business_connection_id, chat_id, "online"):
                 await message.answer("❌ Онлайн статус деактивирован")
             else:
                 await message.answer("❌ Онлайн статус не был активирован")
@@ -755,14 +705,8 @@ async def handle_online_status(message: Message):
                     await message.answer("❌ Неверный формат числа")
                     return
 
-                # Отменяем существующую задачу спама
-                if chat_id in spam_tasks:
-                    spam_tasks[chat_id].cancel()
-                    del spam_tasks[chat_id]
-
-                # Создаем новую задачу спама
-                task = asyncio.create_task(send_spam(message, chat_id, target_number))
-                spam_tasks[chat_id] = task
+                # Новый спам заменяет запущенный в этом чате
+                await start_chat_task(message, "spam", connection.user.id, target_number=target_number)
 
             except Exception as e:
                 logger.error(f"Ошибка при запуске спама: {e}")
@@ -770,9 +714,7 @@ async def handle_online_status(message: Message):
 
         elif command == "стоп":
             # Останавливаем спам если он активен
-            if chat_id in spam_tasks:
-                spam_tasks[chat_id].cancel()
-                del spam_tasks[chat_id]
+            if task_registry.stop(message.business_connection_id, chat_id, "spam"):
                 await message.answer("❌ Спам остановлен")
 
     except Exception as e:
@@ -11,9 +11,14 @@ from bot.assets.texts import Texts
 logger = colorlog.getLogger('bot')
 from bot.database import database as db
 from bot.keyboards import user as kb
+from bot.services.entitlements import entitlements
+from bot.utils.metrics import registry
 
 user_router = Router()
 
+USER_STARTS = registry.counter("bot_user_starts_total", "Команды /start", ["kind"])
+SUBSCRIPTIONS_PAID = registry.counter("bot_subscriptions_paid_total", "Оплаченные подписки")
+
 async def check_channel_sub(user_id: int, bot) -> bool:
     """Проверка подписки на канал"""
     try:
@@ -36,9 +41,11 @@ async def start_command(message: Message):
                 ]
             )
             await message.answer("❌ Для использования бота необходимо подписаться на канал!", reply_markup=keyboard)
+            USER_STARTS.inc(kind="not_subscribed_to_channel")
             return
 
         user = await db.get_user(message.from_user.id)
+        USER_STARTS.inc(kind="returning" if user else "new")
         if not user:
             await db.create_user(
                 telegram_id=message.from_user.id,
@@ -47,6 +54,9 @@ async def start_command(message: Message):
             )
             await message.answer(Texts.START_NOT_CONNECTED, reply_markup=kb.start_connection_keyboard)
         else:
+            if not user.is_reachable:
+                # Пользователь снова доступен: возвращаем его в рассылки и напоминания
+                await db.mark_user_reachable(message.from_user.id)
             await message.answer(
                 Texts.START_CONNECTED if user.business_bot_active else Texts.START_CONNECTED_NEW,
                 reply_markup=kb.start_connection_keyboard
@@ -212,23 +222,12 @@ async def check_payment_callback(callback: CallbackQuery):
     try:
         invoice_id = int(callback.data.replace("check_payment_", ""))
         from bot.services.payments import check_payment
-        from sqlalchemy import update
-        from bot.database.database import User
 
         if await check_payment(invoice_id):
             # Платеж успешен
             end_date = datetime.now() + timedelta(days=30)
-            await db.create_subscription(
-                user_telegram_id=callback.from_user.id,
-                end_date=end_date
-            )
-            # Обновляем дату окончания подписки в таблице users
-            async with db.get_db_session() as session:
-                await session.execute(
-                    update(User)
-                    .where(User.telegram_id == callback.from_user.id)
-                    .values(subscription_end_date=end_date)
-                )
+            await entitlements.grant(callback.from_user.id, end_date)
+            SUBSCRIPTIONS_PAID.inc()
             await callback.message.edit_text("🎉 Оплата прошла успешно! Подписка активирована на 30 дней.")
         else:
             await callback.answer("❌ Оплата еще не поступила. Попробуйте позже.", show_alert=True)
@@ -288,10 +287,8 @@ async def check_payment_status(message: Message, invoice_id: int):
     while attempt < max_attempts:
         if await check_payment(invoice_id):
             # Платеж успешен
-            await db.create_subscription(
-                user_telegram_id=message.from_user.id,
-                end_date=datetime.now() + timedelta(days=30)
-            )
+            await entitlements.grant(message.from_user.id, datetime.now() + timedelta(days=30))
+            SUBSCRIPTIONS_PAID.inc()
             await message.answer("🎉 Оплата прошла успешно! Подписка активирована на 30 дней.")
             await delete_invoice(invoice_id)
             return
@@ -88,6 +88,15 @@ admin_keyboard = InlineKeyboardMarkup(
     ]
 )
 
+def get_broadcast_segments_keyboard(segments: dict) -> InlineKeyboardMarkup:
+    """Выбор сегмента аудитории рассылки: segments — имя сегмента -> название."""
+    return InlineKeyboardMarkup(
+        inline_keyboard=[
+            [InlineKeyboardButton(text=title, callback_data=f"broadcast_segment_{name}")]
+            for name, title in segments.items()
+        ] + [[InlineKeyboardButton(text="❌ Отменить", callback_data="close")]]
+    )
+
 def get_ban_keyboard(user_id: int):
     return InlineKeyboardMarkup(
         inline_keyboard=[
@@ -0,0 +1,124 @@
+import logging
+from datetime import datetime, timedelta
+from typing import Dict, List, Tuple
+
+import bot.database.database as db
+
+# Настройка логирования
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+EVENT_NEW = "new_count"
+EVENT_EDITED = "edited_count"
+EVENT_DELETED = "deleted_count"
+
+# Сброс буфера раньше расписания, если накопилось слишком много интервалов
+MAX_BUFFERED_BUCKETS = 5000
+
+SPARKLINE_BLOCKS = "▁▂▃▄▅▆▇█"
+
+
+class ActivityBuffer:
+    """
+    Буфер событий активности.
+
+    Обработчики сообщений только увеличивают счетчики в памяти, а в базу они
+    попадают одной пачкой UPSERT-ов при сбросе (по расписанию или при
+    переполнении буфера), без лишних запросов на каждое сообщение.
+    """
+
+    def __init__(self):
+        self._buckets: Dict[Tuple[int, int], Dict[str, int]] = {}
+
+    def record(self, user_telegram_id: int, event: str, count: int = 1):
+        """
+        Учесть событие активности пользователя.
+
+        :param user_telegram_id: ID владельца бизнес-подключения.
+        :param event: EVENT_NEW, EVENT_EDITED или EVENT_DELETED.
+        :param count: Количество событий.
+        """
+        now = int(datetime.now().timestamp())
+        key = (user_telegram_id, now - now % db.ACTIVITY_HOUR)
+        counters = self._buckets.get(key)
+        if counters is None:
+            counters = self._buckets[key] = dict.fromkeys(db.ACTIVITY_COLUMNS, 0)
+        counters[event] += count
+
+    @property
+    def needs_flush(self) -> bool:
+        return len(self._buckets) >= MAX_BUFFERED_BUCKETS
+
+    async def flush(self):
+        """Записать накопленные события в базу."""
+        if not self._buckets:
+            return
+        buckets, self._buckets = self._buckets, {}
+        rows = [
+            {"user_telegram_id": user_telegram_id, "bucket": bucket, **counters}
+            for (user_telegram_id, bucket), counters in buckets.items()
+        ]
+        try:
+            await db.flush_activity(rows)
+        except Exception as e:
+            logger.error(f"Ошибка при записи активности: {e}")
+            # Возвращаем события в буфер, чтобы не потерять их до следующего сброса
+            for (user_telegram_id, bucket), counters in buckets.items():
+                merged = self._buckets.setdefault((user_telegram_id, bucket), dict.fromkeys(db.ACTIVITY_COLUMNS, 0))
+                for name, value in counters.items():
+                    merged[name] += value
+
+
+activity_buffer = ActivityBuffer()
+
+
+async def record_activity(user_telegram_id: int, event: str, count: int = 1):
+    """Учесть событие и сбросить буфер, если он переполнен."""
+    activity_buffer.record(user_telegram_id, event, count)
+    if activity_buffer.needs_flush:
+        await activity_buffer.flush()
+
+
+def fill_series(rows: List[dict], since: datetime, step: timedelta, key: str = "new") -> List[int]:
+    """
+    Превратить разреженный ряд из базы в плотный список значений.
+
+    Интервалы без событий в базе отсутствуют, для графика они заполняются нулями.
+    """
+    step_seconds = int(step.total_seconds())
+    start = int(since.timestamp())
+    start -= start % step_seconds
+    now = int(datetime.now().timestamp())
+    values = [0] * ((now - start) // step_seconds + 1)
+    for row in rows:
+        index = (int(row["bucket"].timestamp()) - start) // step_seconds
+        if 0 <= index < len(values):
+            values[index] += row[key]
+    return values
+
+
+def render_sparkline(values: List[int]) -> str:
+    """Нарисовать ряд значений блоками Unicode."""
+    if not values:
+        return ""
+    peak = max(values)
+    if peak == 0:
+        return SPARKLINE_BLOCKS[0] * len(values)
+    last = len(SPARKLINE_BLOCKS) - 1
+    return "".join(SPARKLINE_BLOCKS[round(value / peak * last)] for value in values)
+
+
+async def get_trend(hours: int = 24) -> Dict[str, object]:
+    """
+    Тренд общей активности за последние часы для отчетов.
+
+    :return: Суммы событий за период и спарклайн новых сообщений по часам.
+    """
+    since = datetime.now() - timedelta(hours=hours)
+    rows = await db.get_global_activity(since, hourly=True)
+    return {
+        "new": sum(row["new"] for row in rows),
+        "edited": sum(row["edited"] for row in rows),
+        "deleted": sum(row["deleted"] for row in rows),
+        "sparkline": render_sparkline(fill_series(rows, since, timedelta(hours=1))),
+    }
@@ -0,0 +1,351 @@
+import asyncio
+import logging
+import math
+import os
+import time
+from collections import deque
+from dataclasses import dataclass
+from typing import Callable, Deque, Iterable, Iterator, List, Optional, Set, Union
+
+from aiogram import Bot
+from aiogram.types import Message
+
+from bot.services.circuit import task_breaker, Verdict, TASK_FAILURE_CHAT, TASK_FAILURE_CONNECTION
+from bot.utils.metrics import registry
+from bot.utils.tracing import detached_context
+
+# Настройка логирования
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+# Шаг колеса таймеров: задержки кадров округляются вверх до целого числа шагов
+ANIMATION_TICK = 0.05
+# Число ячеек колеса; задержки длиннее оборота колеса ждут нужное число оборотов
+WHEEL_SLOTS = 1024
+# Общий бюджет вызовов Bot API в секунду на все анимации всех чатов (кадр-замена
+# стоит два вызова: удаление и отправка)
+ANIMATION_FPS = float(os.getenv("ANIMATION_FPS", "25"))
+
+# Режимы кадра
+FRAME_EDIT = "edit"        # изменить текст сообщения анимации (первый кадр отправляет его)
+FRAME_REPLACE = "replace"  # удалить сообщение анимации и отправить новое
+FRAME_NOTICE = "notice"    # отдельное сообщение, которое анимация не трогает
+
+ANIMATION_FRAMES = registry.counter(
+    "bot_animation_frames_total", "Кадры анимаций в чатах", ["kind", "result"]
+)
+ANIMATION_LAG = registry.histogram(
+    "bot_animation_frame_lag_seconds", "Задержка кадра относительно расписания из-за бюджета кадров",
+    buckets=(0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0),
+)
+ANIMATIONS_ACTIVE = registry.gauge("bot_animations_active", "Количество активных анимаций")
+
+
+@dataclass(frozen=True)
+class Frame:
+    """
+    Кадр анимации.
+
+    :param text: Текст кадра или функция, которая вернет его в момент показа
+        (например, текущее время).
+    :param delay: Пауза перед кадром в секундах.
+    :param mode: FRAME_EDIT, FRAME_REPLACE или FRAME_NOTICE.
+    """
+    text: Union[str, Callable[[], str]]
+    delay: float = 0.0
+    mode: str = FRAME_EDIT
+
+    def render(self) -> str:
+        return self.text() if callable(self.text) else self.text
+
+
+class Animation:
+    """
+    Запущенная анимация в одном чате.
+
+    Кадры берутся из итератора по одному, поэтому последовательность может быть
+    бесконечной (генератор). Следующий кадр планируется только после того, как
+    показан предыдущий, и кадры одной анимации никогда не накладываются.
+    """
+
+    def __init__(self, engine: "AnimationEngine", kind: str, bot: Bot, chat_id: int, connection_id: Optional[str],
+                 frames: Iterator[Frame], cancel_text: Optional[str], error_text: Optional[str],
+                 finish_text: Optional[str]):
+        self.engine = engine
+        self.kind = kind
+        self.bot = bot
+        self.chat_id = chat_id
+        self.connection_id = connection_id
+        self.frames = frames
+        self.cancel_text = cancel_text
+        self.error_text = error_text
+        self.finish_text = finish_text
+        # Сообщение, которое анимация редактирует, и его текущий текст
+        self.current: Optional[Message] = None
+        self.current_text: Optional[str] = None
+        self.frame: Optional[Frame] = None
+        self.due = 0.0
+        self.rounds = 0
+        self.cancelled = False
+        self.finished = False
+        self._callbacks: List[Callable[["Animation"], None]] = []
+        # Кадры показываются в контексте запустившего обработчика без трейса его
+        # апдейта: вызовы Bot API учитываются под именем обработчика (см. bot/utils/api_stats.py)
+        self.context = detached_context()
+
+    async def send(self, text: str) -> Message:
+        """Отправить сообщение в чат анимации (от имени владельца, если это бизнес-чат)."""
+        return await self.bot.send_message(self.chat_id, text, business_connection_id=self.connection_id)
+
+    def done(self) -> bool:
+        return self.finished
+
+    def cancel(self):
+        """Остановить анимацию; в чат отправляется cancel_text."""
+        self.engine.cancel(self)
+
+    def add_done_callback(self, callback: Callable[["Animation"], None]):
+        """Вызвать callback(animation) после завершения или отмены."""
+        if self.finished:
+            callback(self)
+        else:
+            self._callbacks.append(callback)
+
+
+class AnimationEngine:
+    """
+    Движок анимаций в чатах.
+
+    Вместо отдельного таска с циклом asyncio.sleep на каждую анимацию один
+    таск крутит колесо таймеров: анимация кладется в ячейку, соответствующую
+    времени ее следующего кадра, и на каждом шаге колеса срабатывает одна
+    ячейка. Сработавшие кадры встают в общую очередь, из которой выходит не
+    больше ANIMATION_FPS вызовов Bot API в секунду на все чаты, поэтому тысячи
+    анимаций не дают одновременных всплесков edit_text. Колесо работает,
+    только пока есть активные анимации.
+    """
+
+    def __init__(self, tick: float = ANIMATION_TICK, slots: int = WHEEL_SLOTS, fps: float = ANIMATION_FPS):
+        self.tick = tick
+        self.fps = fps
+        self._wheel: List[List[Animation]] = [[] for _ in range(slots)]
+        self._cursor = 0
+        self._ready: Deque[Animation] = deque()
+        self._active: Set[Animation] = set()
+        self._renders: Set[asyncio.Task] = set()
+        self._driver: Optional[asyncio.Task] = None
+        # Токены бюджета вызовов Bot API; запас не больше двух шагов, чтобы не было
+        # всплесков, но не меньше самого дорогого кадра (замена — два вызова)
+        self._max_tokens = max(2.0, 2 * fps * tick)
+        self._tokens = self._max_tokens
+        ANIMATIONS_ACTIVE.set_function(lambda: len(self._active))
+
+    def start(self, bot: Bot, chat_id: int, frames: Iterable[Frame], kind: str,
+              connection_id: Optional[str] = None, cancel_text: Optional[str] = None,
+              error_text: Optional[str] = None, finish_text: Optional[str] = None) -> Animation:
+        """
+        Запустить анимацию в чате.
+
+        :param bot: Бот, от имени которого идут вызовы Bot API.
+        :param chat_id: ID чата.
+        :param frames: Последовательность кадров, может быть бесконечной.
+        :param kind: Вид анимации для метрик (pin, love, online...).
+        :param connection_id: ID бизнес-подключения, если чат бизнес-чат владельца.
+        :param cancel_text: Сообщение при отмене.
+        :param error_text: Сообщение, если анимация остановлена ошибкой.
+        :param finish_text: Сообщение после завершения по любой причине.
+        :return: Анимация; cancel() останавливает ее. Если предохранитель чата
+            разомкнут (см. bot/services/circuit.py), анимация сразу завершена.
+        """
+        animation = Animation(self, kind, bot, chat_id, connection_id, iter(frames),
+                              cancel_text, error_text, finish_text)
+        if task_breaker.is_open(animation.connection_id, animation.chat_id):
+            logger.info(f"Анимация {kind} в чате {animation.chat_id} не запущена: чат недоступен")
+            self._finish(animation, notify=False)
+            return animation
+        self._active.add(animation)
+        self._advance(animation)
+        if self._driver is None or self._driver.done():
+            self._driver = asyncio.create_task(self._run())
+        return animation
+
+    def start_for(self, message: Message, frames: Iterable[Frame], kind: str, **options) -> Animation:
+        """Запустить анимацию в чате сообщения (параметры — как у start)."""
+        return self.start(message.bot, message.chat.id, frames, kind,
+                          connection_id=message.business_connection_id, **options)
+
+    def cancel(self, animation: Animation):
+        """Отменить анимацию. Кадр, который уже отправляется, досылается, следующих не будет."""
+        if animation.finished or animation.cancelled:
+            return
+        animation.cancelled = True
+        self._finish(animation, animation.cancel_text)
+
+    def active(self, kind: Optional[str] = None) -> int:
+        """Количество активных анимаций (всех или одного вида)."""
+        return sum(1 for animation in self._active if kind is None or animation.kind == kind)
+
+    async def stop(self):
+        """Остановить движок без сообщений в чаты (выключение бота)."""
+        tasks = list(self._renders)
+        if self._driver:
+            tasks.append(self._driver)
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+        self._driver = None
+        self._active.clear()
+        self._ready.clear()
+        for slot in self._wheel:
+            slot.clear()
+
+    def _advance(self, animation: Animation, min_delay: float = 0.0):
+        """
+        Взять следующий кадр и положить анимацию в ячейку колеса.
+
+        :param min_delay: Пауза не меньше этой (после временной ошибки).
+        """
+        animation.frame = next(animation.frames, None)
+        if animation.frame is None:
+            self._finish(animation)
+            return
+        ticks = max(1, math.ceil(max(animation.frame.delay, min_delay) / self.tick))
+        animation.due = time.monotonic() + ticks * self.tick
+        animation.rounds = (ticks - 1) // len(self._wheel)
+        self._wheel[(self._cursor + ticks) % len(self._wheel)].append(animation)
+
+    def _finish(self, animation: Animation, text: Optional[str] = None, notify: bool = True):
+        """
+        Завершить анимацию и вызвать обработчики завершения.
+
+        :param text: Сообщение о причине (отмена, ошибка).
+        :param notify: Отправлять ли сообщения в чат; не нужно, если чат недоступен.
+        """
+        if animation.finished:
+            return
+        animation.finished = True
+        self._active.discard(animation)
+        if not any(other.chat_id == animation.chat_id and other.connection_id == animation.connection_id
+                   for other in self._active):
+            # Последняя анимация чата: иначе счетчики ошибок копились бы по всем чатам
+            task_breaker.forget(animation.connection_id, animation.chat_id)
+        for notice in (text, animation.finish_text):
+            if notice and notify:
+                self._spawn(animation, self._notify(animation, notice))
+        for callback in animation._callbacks:
+            try:
+                callback(animation)
+            except Exception as e:
+                logger.error(f"Ошибка обработчика завершения анимации: {e}")
+        animation._callbacks.clear()
+
+    def _spawn(self, animation: Animation, coroutine):
+        task = asyncio.create_task(coroutine, context=animation.context)
+        self._renders.add(task)
+        task.add_done_callback(self._renders.discard)
+
+    async def _notify(self, animation: Animation, text: str):
+        try:
+            await animation.send(text)
+        except Exception as e:
+            logger.error(f"Ошибка отправки сообщения анимации {animation.kind}: {e}")
+
+    async def _run(self):
+        next_tick = time.monotonic()
+        while self._active:
+            now = time.monotonic()
+            # Если шаг затянулся, проворачиваем колесо на все пропущенные ячейки
+            while next_tick <= now:
+                self._turn()
+                next_tick += self.tick
+                self._tokens = min(self._max_tokens, self._tokens + self.fps * self.tick)
+            self._dispatch()
+            await asyncio.sleep(max(0.0, next_tick - time.monotonic()))
+
+    def _turn(self):
+        self._cursor = (self._cursor + 1) % len(self._wheel)
+        slot = self._wheel[self._cursor]
+        if not slot:
+            return
+        waiting = []
+        for animation in slot:
+            if animation.finished:
+                continue
+            if animation.rounds:
+                animation.rounds -= 1
+                waiting.append(animation)
+            else:
+                self._ready.append(animation)
+        self._wheel[self._cursor] = waiting
+
+    def _dispatch(self):
+        while self._ready:
+            animation = self._ready[0]
+            if animation.finished:
+                self._ready.popleft()
+                continue
+            cost = self._cost(animation)
+            if self._tokens < cost:
+                break
+            self._ready.popleft()
+            self._tokens -= cost
+            ANIMATION_LAG.observe(max(0.0, time.monotonic() - animation.due))
+            self._spawn(animation, self._render(animation))
+
+    @staticmethod
+    def _cost(animation: Animation) -> int:
+        """Сколько вызовов Bot API сделает кадр: замена сообщения — удаление и отправка."""
+        if animation.frame.mode == FRAME_REPLACE and animation.current is not None:
+            return 2
+        return 1
+
+    async def _render(self, animation: Animation):
+        frame = animation.frame
+        try:
+            text = frame.render()
+            if frame.mode == FRAME_NOTICE:
+                await animation.send(text)
+            elif frame.mode == FRAME_REPLACE or animation.current is None:
+                if animation.current is not None:
+                    try:
+                        await animation.current.delete()
+                    except Exception:
+                        pass
+                animation.current = await animation.send(text)
+                animation.current_text = text
+            elif text != animation.current_text:
+                # Telegram отвечает ошибкой на правку без изменений, такие кадры пропускаются
+                await animation.current.edit_text(text)
+                animation.current_text = text
+            ANIMATION_FRAMES.inc(kind=animation.kind, result="ok")
+            task_breaker.success(animation.connection_id, animation.chat_id)
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            ANIMATION_FRAMES.inc(kind=animation.kind, result="error")
+            verdict = task_breaker.failure(animation.connection_id, animation.chat_id, e)
+            if verdict.stop:
+                self._stop_failed(animation, verdict)
+                return
+            logger.warning(f"Ошибка кадра анимации {animation.kind} в чате {animation.chat_id}, "
+                           f"повтор через {verdict.delay:.1f} с: {e}")
+            if not animation.finished:
+                self._advance(animation, verdict.delay)
+            return
+        if not animation.finished:
+            self._advance(animation)
+
+    def _stop_failed(self, animation: Animation, verdict: Verdict):
+        """Остановить анимацию после ошибки, а при недоступном чате — все анимации чата или подключения."""
+        if verdict.scope not in (TASK_FAILURE_CHAT, TASK_FAILURE_CONNECTION):
+            self._finish(animation, animation.error_text)
+            return
+        for other in list(self._active):
+            if other.connection_id != animation.connection_id:
+                continue
+            if verdict.scope == TASK_FAILURE_CHAT and other.chat_id != animation.chat_id:
+                continue
+            self._finish(other, notify=False)
+
+
+animation_engine = AnimationEngine()
@@ -0,0 +1,190 @@
+import argparse
+import asyncio
+import gzip
+import logging
+import shutil
+import sqlite3
+import time
+from datetime import datetime
+from pathlib import Path
+from typing import List, Optional
+
+import bot.database.database as db
+
+# Настройка логирования
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+BACKUP_DIR = Path("backups")
+BACKUP_KEEP = 7
+
+# Копия снимается одним VACUUM INTO на соединении только для чтения: в режиме WAL
+# это один согласованный снимок, и читатель не блокирует запись бота. Пошаговое
+# копирование (sqlite3.backup) начинается заново после каждой записи из другого
+# соединения и на активном боте может не закончиться никогда
+BACKUP_TIMEOUT = 600
+# Как часто (в инструкциях виртуальной машины SQLite) проверяется время копирования
+BACKUP_PROGRESS_STEP = 10000
+
+BACKUP_PATTERN = "backup_*.db.gz"
+
+
+def _database_path() -> Path:
+    return Path(db.engine.url.database)
+
+
+def _backup_to_file(source_path: Path, target_path: Path, timeout: float):
+    source = sqlite3.connect(f"file:{source_path}?mode=ro", uri=True)
+    deadline = time.monotonic() + timeout
+    # Ненулевой ответ обработчика прерывает VACUUM INTO с ошибкой interrupted
+    source.set_progress_handler(lambda: time.monotonic() > deadline, BACKUP_PROGRESS_STEP)
+    try:
+        try:
+            source.execute("VACUUM INTO ?", (str(target_path),))
+        except sqlite3.OperationalError as e:
+            if time.monotonic() > deadline:
+                raise TimeoutError(f"Резервное копирование не уложилось в {timeout:.0f} с") from e
+            raise
+    finally:
+        source.close()
+
+    target = sqlite3.connect(target_path)
+    try:
+        result = target.execute("PRAGMA quick_check").fetchone()[0]
+        if result != "ok":
+            raise RuntimeError(f"Копия базы повреждена: {result}")
+    finally:
+        target.close()
+
+
+def _compress(source_path: Path, target_path: Path):
+    with open(source_path, "rb") as src, gzip.open(target_path, "wb", compresslevel=6) as dst:
+        shutil.copyfileobj(src, dst, length=1024 * 1024)
+
+
+def list_backups(directory: Path = BACKUP_DIR) -> List[Path]:
+    """Список резервных копий, от новых к старым."""
+    if not directory.exists():
+        return []
+    return sorted(directory.glob(BACKUP_PATTERN), reverse=True)
+
+
+def _rotate(directory: Path, keep: int) -> List[Path]:
+    removed = list_backups(directory)[keep:]
+    for path in removed:
+        path.unlink(missing_ok=True)
+    return removed
+
+
+async def create_backup(directory: Path = BACKUP_DIR, keep: int = BACKUP_KEEP,
+                        timeout: float = BACKUP_TIMEOUT) -> Path:
+    """
+    Создать сжатую резервную копию базы без остановки бота.
+
+    Копия снимается командой VACUUM INTO с отдельного соединения только для
+    чтения: она видит один снимок базы, а запись бота в WAL идет параллельно.
+    Копирование и сжатие выполняются в отдельном потоке и не занимают event loop.
+
+    :param directory: Каталог для резервных копий.
+    :param keep: Сколько последних копий хранить.
+    :param timeout: Предельное время копирования в секундах; копия дольше прерывается.
+    :return: Путь к созданной копии.
+    """
+    directory.mkdir(parents=True, exist_ok=True)
+    name = f"backup_{datetime.now().strftime('%Y%m%d_%H%M%S')}.db"
+    raw_path = directory / f"{name}.tmp"
+    path = directory / f"{name}.gz"
+
+    started = datetime.now()
+    try:
+        await asyncio.to_thread(_backup_to_file, _database_path(), raw_path, timeout)
+        await asyncio.to_thread(_compress, raw_path, path)
+    except TimeoutError as e:
+        path.unlink(missing_ok=True)
+        logger.error(f"⏱ {e}, копия {path} не создана")
+        raise
+    except Exception:
+        path.unlink(missing_ok=True)
+        raise
+    finally:
+        raw_path.unlink(missing_ok=True)
+
+    removed = _rotate(directory, keep)
+    elapsed = (datetime.now() - started).total_seconds()
+    logger.info(f"Резервная копия создана: {path} ({path.stat().st_size} байт, {elapsed:.1f} с), "
+                f"удалено старых: {len(removed)}")
+    return path
+
+
+def restore_backup(backup_path: Path, database_path: Optional[Path] = None) -> Path:
+    """
+    Восстановить базу из резервной копии.
+
+    Выполняется только при остановленном боте. Текущая база не удаляется,
+    а сохраняется рядом с суффиксом .before-restore.
+
+    :param backup_path: Путь к сжатой резервной копии.
+    :param database_path: Путь к файлу базы (по умолчанию — база бота).
+    :return: Путь к сохраненной предыдущей версии базы.
+    """
+    database_path = database_path or _database_path()
+    raw_path = database_path.with_name(f"{database_path.name}.restore")
+    with gzip.open(backup_path, "rb") as src, open(raw_path, "wb") as dst:
+        shutil.copyfileobj(src, dst, length=1024 * 1024)
+
+    conn = sqlite3.connect(raw_path)
+    try:
+        result = conn.execute("PRAGMA integrity_check").fetchone()[0]
+    finally:
+        conn.close()
+    if result != "ok":
+        raw_path.unlink(missing_ok=True)
+        raise RuntimeError(f"Резервная копия повреждена: {result}")
+
+    previous_path = database_path.with_name(f"{database_path.name}.before-restore")
+    if database_path.exists():
+        database_path.replace(previous_path)
+    # Журналы WAL/rollback относятся к старой базе и не должны применяться к восстановленной
+    for suffix in ("-wal", "-shm", "-journal"):
+        database_path.with_name(database_path.name + suffix).unlink(missing_ok=True)
+    raw_path.replace(database_path)
+    logger.info(f"База восстановлена из {backup_path}, предыдущая версия: {previous_path}")
+    return previous_path
+
+
+async def _run_cli_backup(directory: Path, keep: int):
+    # Копия должна быть в актуальной схеме, как и у бота, иначе restore вернет устаревшую базу
+    await db.init_db()
+    print(await create_backup(directory, keep))
+    await db.engine.dispose()
+
+
+def main(argv: Optional[List[str]] = None):
+    parser = argparse.ArgumentParser(description="Резервное копирование базы данных бота")
+    parser.add_argument("--dir", type=Path, default=BACKUP_DIR, help="Каталог резервных копий")
+    commands = parser.add_subparsers(dest="command", required=True)
+    create = commands.add_parser("create", help="Создать резервную копию")
+    create.add_argument("--keep", type=int, default=BACKUP_KEEP, help="Сколько последних копий хранить")
+    commands.add_parser("list", help="Показать резервные копии")
+    restore = commands.add_parser("restore", help="Восстановить базу (бот должен быть остановлен)")
+    restore.add_argument("backup", nargs="?", type=Path, help="Файл копии (по умолчанию — последняя)")
+    args = parser.parse_args(argv)
+
+    if args.command == "create":
+        asyncio.run(_run_cli_backup(args.dir, args.keep))
+    elif args.command == "list":
+        for path in list_backups(args.dir):
+            print(f"{path}\t{path.stat().st_size}")
+    else:
+        backup_path = args.backup
+        if backup_path is None:
+            backups = list_backups(args.dir)
+            if not backups:
+                parser.error(f"В каталоге {args.dir} нет резервных копий")
+            backup_path = backups[0]
+        restore_backup(backup_path)
+        print(f"Восстановлено из {backup_path}")
+
+
+if __name__ == "__main__":
+    main()
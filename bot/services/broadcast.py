@@ -0,0 +1,372 @@
+import asyncio
+import dataclasses
+import itertools
+import logging
+from dataclasses import dataclass
+from datetime import datetime, timedelta
+from typing import Callable, Dict, List, Optional
+
+from aiogram import Bot
+from aiogram.exceptions import TelegramBadRequest, TelegramRetryAfter
+
+import bot.database.database as db
+from bot.utils.delivery import classify_delivery_error
+
+# Настройка логирования
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+# Bot API допускает около 30 сообщений в секунду в разные чаты; держимся с запасом
+BROADCAST_RATE = 25
+BROADCAST_CONCURRENCY = 25
+BROADCAST_BATCH_SIZE = 500
+MAX_SEND_ATTEMPTS = 3
+
+# Сбой страницы (база, сеть) повторяется с паузой BROADCAST_RETRY_BASE * 2^n секунд,
+# после BROADCAST_MAX_RETRIES сбоев подряд рассылка помечается как прерванная
+BROADCAST_MAX_RETRIES = 5
+BROADCAST_RETRY_BASE = 5.0
+
+# Сообщение о прогрессе редактируется не чаще, чем раз в PROGRESS_INTERVAL секунд
+PROGRESS_INTERVAL = 3.0
+
+BROADCAST_AUDIENCE = db.UserFilter(is_banned=False, is_reachable=True)
+
+
+@dataclass(frozen=True)
+class Segment:
+    """
+    Сегмент аудитории рассылки.
+
+    build получает параметр сегмента (строку от администратора или None) и время
+    создания рассылки и возвращает условия отбора поверх BROADCAST_AUDIENCE.
+    Относительные параметры («истекла за N дней») считаются от времени создания,
+    поэтому рассылка, продолженная после перезапуска, не меняет аудиторию.
+    """
+    title: str
+    build: Callable[[Optional[str], datetime], db.UserFilter]
+    # Подсказка для параметра; None — сегмент без параметра
+    param_hint: Optional[str] = None
+    # Оговорка о составе сегмента, которую администратор видит до рассылки
+    caveat: Optional[str] = None
+
+
+def _audience(**conditions) -> db.UserFilter:
+    return dataclasses.replace(BROADCAST_AUDIENCE, **conditions)
+
+
+def _parse_days(param: Optional[str]) -> int:
+    try:
+        days = int(param)
+    except (TypeError, ValueError):
+        raise ValueError("Укажите количество дней целым числом")
+    if days <= 0:
+        raise ValueError("Количество дней должно быть положительным")
+    return days
+
+
+def _parse_date(param: Optional[str]) -> datetime:
+    try:
+        return datetime.strptime(param or "", "%Y-%m-%d")
+    except ValueError:
+        raise ValueError("Укажите дату в формате ГГГГ-ММ-ДД")
+
+
+# Каждый сегмент — одно условие по индексированной колонке users, поэтому
+# оценка размера и постраничный обход не требуют полного просмотра таблицы
+BROADCAST_SEGMENTS: Dict[str, Segment] = {
+    "all": Segment("Все пользователи", lambda param, now: _audience()),
+    "active": Segment(
+        "Действующие подписчики",
+        lambda param, now: _audience(active_subscription=True)
+    ),
+    "expired": Segment(
+        "Подписка истекла за N дней",
+        lambda param, now: _audience(subscription_expired_since=now - timedelta(days=_parse_days(param))),
+        param_hint="количество дней, например 7"
+    ),
+    "never": Segment(
+        "Без подписки (включая истекшие до обновления)",
+        lambda param, now: _audience(never_subscribed=True),
+        # До миграции 9 истекшая подписка стирала и строку subscriptions, и дату
+        # окончания, поэтому таких пользователей не отличить от не подписывавшихся
+        caveat="⚠️ В сегмент попадают и пользователи, чья подписка истекла до обновления бота "
+               "с сегментами рассылок: даты тех подписок не сохранились"
+    ),
+    "business": Segment(
+        "Подключен бизнес-бот",
+        lambda param, now: _audience(business_bot_active=True)
+    ),
+    "inactive": Segment(
+        "Неактивны с даты",
+        lambda param, now: _audience(inactive_since=_parse_date(param)),
+        param_hint="дата в формате ГГГГ-ММ-ДД"
+    ),
+}
+
+
+def resolve_segment(segment: str, param: Optional[str] = None,
+                    now: Optional[datetime] = None) -> db.UserFilter:
+    """
+    Условия отбора получателей для сегмента.
+
+    :param segment: Имя сегмента из BROADCAST_SEGMENTS.
+    :param param: Параметр сегмента, если он нужен.
+    :param now: Время, от которого считаются относительные параметры.
+    :raises ValueError: Неизвестный сегмент или неверный параметр.
+    """
+    if segment not in BROADCAST_SEGMENTS:
+        raise ValueError(f"Неизвестный сегмент: {segment}. Доступны: {', '.join(BROADCAST_SEGMENTS)}")
+    return BROADCAST_SEGMENTS[segment].build(param, now or datetime.now())
+
+
+async def estimate_segment(segment: str, param: Optional[str] = None) -> int:
+    """Оценка числа получателей сегмента перед запуском рассылки."""
+    return await db.count_users(resolve_segment(segment, param))
+
+
+def describe_estimate(segment: str, total: int) -> str:
+    """Текст оценки числа получателей с оговоркой сегмента, если она есть."""
+    text = f"👥 Получателей: {total}"
+    caveat = BROADCAST_SEGMENTS[segment].caveat
+    return f"{text}\n{caveat}" if caveat else text
+
+
+class RateLimiter:
+    """
+    Равномерный ограничитель частоты: не больше rate вызовов в секунду.
+
+    Общий для всех параллельных отправок, поэтому глобальный лимит соблюдается
+    независимо от числа одновременных запросов. pause() сдвигает следующий слот,
+    когда Telegram просит подождать (RetryAfter).
+    """
+
+    def __init__(self, rate: float):
+        self._interval = 1 / rate
+        self._next_slot = 0.0
+        self._lock = asyncio.Lock()
+
+    async def wait(self):
+        loop = asyncio.get_running_loop()
+        async with self._lock:
+            now = loop.time()
+            delay = self._next_slot - now
+            self._next_slot = max(now, self._next_slot) + self._interval
+        if delay > 0:
+            await asyncio.sleep(delay)
+
+    def pause(self, seconds: float):
+        loop = asyncio.get_running_loop()
+        self._next_slot = max(self._next_slot, loop.time() + seconds)
+
+
+class BroadcastEngine:
+    """
+    Фоновые рассылки с сохраненным прогрессом.
+
+    Получатели читаются страницами по users.id, внутри страницы сообщения
+    отправляются параллельно (не больше BROADCAST_CONCURRENCY одновременно)
+    через общий ограничитель частоты. После каждой страницы в базе сохраняются
+    курсор и счетчики, а при остановке — курсор по уже обработанной части
+    страницы, поэтому после перезапуска рассылка продолжается с места остановки.
+    """
+
+    def __init__(self):
+        self._bot: Optional[Bot] = None
+        self._tasks: Dict[int, asyncio.Task] = {}
+        # Рассылки выполняющихся задач: их счетчики нужны для итогового сообщения при отмене
+        self._broadcasts: Dict[int, db.Broadcast] = {}
+        self._limiter = RateLimiter(BROADCAST_RATE)
+        self._semaphore = asyncio.Semaphore(BROADCAST_CONCURRENCY)
+
+    async def start(self, bot: Bot):
+        """Продолжить рассылки, прерванные остановкой бота."""
+        self._bot = bot
+        for broadcast in await db.get_running_broadcasts():
+            logger.info(f"Продолжение рассылки #{broadcast.id} с пользователя {broadcast.cursor}")
+            self._spawn(broadcast)
+
+    async def stop(self):
+        """Остановить рассылки без изменения статуса: после запуска они продолжатся."""
+        tasks = list(self._tasks.values())
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+        self._tasks.clear()
+        self._broadcasts.clear()
+
+    async def launch(self, text: str, admin_chat_id: int, segment: str = "all",
+                     segment_param: Optional[str] = None) -> db.Broadcast:
+        """
+        Запустить новую рассылку.
+
+        :param text: Текст рассылки.
+        :param admin_chat_id: Чат администратора для сообщения о прогрессе.
+        :param segment: Сегмент аудитории из BROADCAST_SEGMENTS.
+        :param segment_param: Параметр сегмента, если он нужен.
+        :return: Созданная рассылка.
+        :raises ValueError: Неизвестный сегмент или неверный параметр.
+        """
+        total = await db.count_users(resolve_segment(segment, segment_param))
+        broadcast = await db.create_broadcast(text, admin_chat_id, total, segment, segment_param)
+        progress = await self._bot.send_message(admin_chat_id, self._progress_text(broadcast))
+        broadcast.progress_message_id = progress.message_id
+        await db.update_broadcast(broadcast.id, progress_message_id=progress.message_id)
+        self._spawn(broadcast)
+        return broadcast
+
+    async def cancel(self, broadcast_id: int) -> bool:
+        """Отменить рассылку. Возвращает False, если она не выполняется."""
+        task = self._tasks.pop(broadcast_id, None)
+        if task is None:
+            return False
+        task.cancel()
+        await asyncio.gather(task, return_exceptions=True)
+        await db.update_broadcast(broadcast_id, status=db.BROADCAST_CANCELLED, finished_at=datetime.now())
+        broadcast = self._broadcasts.pop(broadcast_id, None)
+        if broadcast is not None:
+            broadcast.status = db.BROADCAST_CANCELLED
+            await self._report(broadcast)
+        return True
+
+    @property
+    def active(self) -> int:
+        return len(self._tasks)
+
+    def _spawn(self, broadcast: db.Broadcast):
+        task = asyncio.create_task(self._run(broadcast))
+        self._tasks[broadcast.id] = task
+        self._broadcasts[broadcast.id] = broadcast
+        task.add_done_callback(lambda done: self._forget(broadcast.id, done))
+
+    def _forget(self, broadcast_id: int, task: asyncio.Task):
+        if self._tasks.get(broadcast_id) is task:
+            del self._tasks[broadcast_id]
+            del self._broadcasts[broadcast_id]
+
+    async def _run(self, broadcast: db.Broadcast):
+        failures = 0
+        while True:
+            try:
+                await self._deliver(broadcast)
+                break
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                failures += 1
+                if failures > BROADCAST_MAX_RETRIES:
+                    logger.error(f"Рассылка #{broadcast.id} прервана после {BROADCAST_MAX_RETRIES} повторов: {e}")
+                    await self._fail(broadcast, e)
+                    return
+                delay = BROADCAST_RETRY_BASE * 2 ** (failures - 1)
+                logger.warning(f"Ошибка в рассылке #{broadcast.id}, повтор {failures} через {delay:.0f} с: {e}")
+                await self._report(broadcast, f"⚠️ Сбой: {e}\nПовтор {failures}/{BROADCAST_MAX_RETRIES} через {delay:.0f} с")
+                await asyncio.sleep(delay)
+
+        broadcast.status = db.BROADCAST_DONE
+        await db.update_broadcast(broadcast.id, status=db.BROADCAST_DONE, finished_at=datetime.now())
+        await self._report(broadcast)
+        logger.info(f"Рассылка #{broadcast.id} завершена. Отправлено: {broadcast.sent}, ошибок: {broadcast.failed}")
+
+    async def _deliver(self, broadcast: db.Broadcast):
+        """Разослать оставшимся получателям, начиная с сохраненного курсора."""
+        loop = asyncio.get_running_loop()
+        last_report = loop.time()
+        audience = resolve_segment(broadcast.segment, broadcast.segment_param, broadcast.created_at)
+        async for users in db.iter_user_batches(audience, BROADCAST_BATCH_SIZE, after_id=broadcast.cursor):
+            sends = [asyncio.ensure_future(self._send(broadcast.text, user.telegram_id)) for user in users]
+            try:
+                results = await asyncio.gather(*sends)
+            except asyncio.CancelledError:
+                # При остановке сохраняем непрерывный префикс уже обработанных
+                # получателей, чтобы после перезапуска не отправлять им повторно
+                finished = list(itertools.takewhile(lambda send: send.done() and not send.cancelled(), sends))
+                if finished:
+                    await self._advance(broadcast, users[:len(finished)], [send.result() for send in finished])
+                raise
+            await self._advance(broadcast, users, results)
+            if loop.time() - last_report >= PROGRESS_INTERVAL:
+                last_report = loop.time()
+                await self._report(broadcast)
+
+    async def _fail(self, broadcast: db.Broadcast, error: Exception):
+        """Пометить рассылку прерванной: сама она больше не продолжится."""
+        broadcast.status = db.BROADCAST_FAILED
+        try:
+            await db.update_broadcast(broadcast.id, status=db.BROADCAST_FAILED, finished_at=datetime.now())
+        except Exception as e:
+            # Статус остается running: рассылка продолжится после перезапуска
+            logger.error(f"Не удалось сохранить статус рассылки #{broadcast.id}: {e}")
+        await self._report(broadcast, f"❌ Ошибка: {error}")
+
+    async def _advance(self, broadcast: db.Broadcast, users: List[db.User], errors: List[Optional[Exception]]):
+        """Учесть обработанных получателей, отметить недоступных и сохранить курсор."""
+        unreachable = {}
+        for user, error in zip(users, errors):
+            if error is None:
+                broadcast.sent += 1
+                continue
+            broadcast.failed += 1
+            reason = classify_delivery_error(error)
+            if reason:
+                unreachable[user.telegram_id] = reason
+        broadcast.cursor = users[-1].id
+        await db.mark_users_unreachable(unreachable)
+        await db.update_broadcast(broadcast.id, cursor=broadcast.cursor, sent=broadcast.sent, failed=broadcast.failed)
+
+    async def _send(self, text: str, chat_id: int) -> Optional[Exception]:
+        """Отправить сообщение; возвращает None при успехе или ошибку отправки."""
+        async with self._semaphore:
+            error = None
+            for _ in range(MAX_SEND_ATTEMPTS):
+                await self._limiter.wait()
+                try:
+                    await self._bot.send_message(chat_id=chat_id, text=text, disable_web_page_preview=True)
+                    return None
+                except TelegramRetryAfter as e:
+                    logger.warning(f"Лимит Bot API при рассылке, пауза {e.retry_after} с")
+                    self._limiter.pause(e.retry_after)
+                    error = e
+                except Exception as e:
+                    logger.error(f"Ошибка отправки пользователю {chat_id}: {e}")
+                    return e
+            return error
+
+    def _progress_text(self, broadcast: db.Broadcast, note: Optional[str] = None) -> str:
+        status = {
+            db.BROADCAST_RUNNING: "⏳ выполняется",
+            db.BROADCAST_DONE: "✅ завершена",
+            db.BROADCAST_CANCELLED: "⛔️ отменена",
+            db.BROADCAST_FAILED: "❌ прервана",
+        }.get(broadcast.status, broadcast.status)
+        processed = broadcast.sent + broadcast.failed
+        segment = BROADCAST_SEGMENTS.get(broadcast.segment)
+        audience = segment.title if segment else broadcast.segment
+        if broadcast.segment_param:
+            audience += f" ({broadcast.segment_param})"
+        text = (
+            f"📣 Рассылка #{broadcast.id}: {status}\n"
+            f"Аудитория: {audience}\n"
+            f"Обработано: {processed} из {broadcast.total}\n"
+            f"✅ Успешно: {broadcast.sent}\n"
+            f"❌ Ошибок: {broadcast.failed}"
+        )
+        return f"{text}\n\n{note}" if note else text
+
+    async def _report(self, broadcast: db.Broadcast, note: Optional[str] = None):
+        if not broadcast.progress_message_id:
+            return
+        try:
+            await self._bot.edit_message_text(
+                text=self._progress_text(broadcast, note),
+                chat_id=broadcast.admin_chat_id,
+                message_id=broadcast.progress_message_id
+            )
+        except TelegramBadRequest as e:
+            if "message is not modified" not in str(e):
+                logger.warning(f"Не удалось обновить прогресс рассылки #{broadcast.id}: {e}")
+        except Exception as e:
+            logger.warning(f"Не удалось обновить прогресс рассылки #{broadcast.id}: {e}")
+
+
+broadcast_engine = BroadcastEngine()
@@ -0,0 +1,147 @@
+import csv
+import io
+import logging
+import re
+from dataclasses import dataclass
+from datetime import datetime, timedelta
+from typing import Dict, List, Optional
+
+import bot.database.database as db
+from bot.services.entitlements import entitlements
+
+# Настройка логирования
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+BULK_ACTIONS = ("give", "ban", "unban")
+# Ограничение размера загружаемого файла
+BULK_MAX_FILE_SIZE = 2 * 1024 * 1024
+
+# Правила Telegram для username: 5–32 символа, латиница, цифры и подчеркивание
+_USERNAME = re.compile(r"^@?([A-Za-z][A-Za-z0-9_]{4,31})$")
+_HEADERS = {"id", "user_id", "telegram_id", "username", "user"}
+
+# Результаты строк
+RESULT_INVALID = "некорректное значение"
+RESULT_DUPLICATE = "повтор строки"
+RESULT_NOT_FOUND = "пользователь не найден"
+
+
+@dataclass
+class BulkRow:
+    """Строка файла и результат ее обработки."""
+    line: int
+    value: str
+    telegram_id: Optional[int] = None
+    result: str = ""
+
+
+def parse_rows(content: bytes) -> List[BulkRow]:
+    """
+    Разобрать CSV или текстовый файл: из каждой строки берется первое непустое поле.
+
+    Поле — Telegram ID или username (с @ или без). Строка заголовка и пустые
+    строки пропускаются.
+
+    :param content: Содержимое файла.
+    :return: Строки файла в исходном порядке.
+    """
+    text = content.decode("utf-8-sig", errors="replace")
+    try:
+        dialect = csv.Sniffer().sniff(text[:4096], delimiters=",;\t")
+    except csv.Error:
+        dialect = csv.excel
+    rows = []
+    for line, cells in enumerate(csv.reader(io.StringIO(text), dialect), 1):
+        value = next((cell.strip() for cell in cells if cell.strip()), "")
+        if not value or (line == 1 and value.lower() in _HEADERS):
+            continue
+        rows.append(BulkRow(line, value))
+    return rows
+
+
+async def _resolve(rows: List[BulkRow]):
+    """Найти пользователей для всех строк пачками запросов и пометить повторы."""
+    telegram_ids, usernames = set(), set()
+    for row in rows:
+        if row.value.lstrip("-").isdigit():
+            telegram_ids.add(int(row.value))
+        elif _USERNAME.match(row.value):
+            usernames.add(_USERNAME.match(row.value).group(1))
+        else:
+            row.result = RESULT_INVALID
+
+    by_id, by_username = await db.resolve_users(list(telegram_ids), list(usernames))
+    seen = set()
+    for row in rows:
+        if row.result:
+            continue
+        if row.value.lstrip("-").isdigit():
+            user = by_id.get(int(row.value))
+        else:
+            user = by_username.get(_USERNAME.match(row.value).group(1))
+        if user is None:
+            row.result = RESULT_NOT_FOUND
+        elif user.telegram_id in seen:
+            row.telegram_id = user.telegram_id
+            row.result = RESULT_DUPLICATE
+        else:
+            row.telegram_id = user.telegram_id
+            seen.add(user.telegram_id)
+
+
+async def apply_bulk_action(action: str, rows: List[BulkRow], argument: str = "") -> Dict[str, int]:
+    """
+    Применить действие ко всем найденным пользователям одной транзакцией.
+
+    :param action: give — выдать подписку на argument дней, ban — заблокировать
+        с причиной argument, unban — разблокировать.
+    :param rows: Строки из parse_rows; в них записывается результат.
+    :param argument: Параметр действия.
+    :return: Количество строк по результатам.
+    :raises ValueError: Неизвестное действие или неверный параметр.
+    """
+    if action not in BULK_ACTIONS:
+        raise ValueError(f"Неизвестное действие: {action}. Доступны: {', '.join(BULK_ACTIONS)}")
+    if action == "give":
+        try:
+            days = int(argument)
+        except ValueError:
+            raise ValueError("Укажите количество дней подписки целым числом")
+        if days <= 0:
+            raise ValueError("Количество дней должно быть положительным")
+
+    await _resolve(rows)
+    targets = [row for row in rows if row.telegram_id is not None and not row.result]
+    telegram_ids = [row.telegram_id for row in targets]
+
+    if action == "give":
+        end_date = datetime.now() + timedelta(days=days)
+        if telegram_ids:
+            await entitlements.grant_many(telegram_ids, end_date)
+        for row in targets:
+            row.result = f"подписка до {end_date:%d.%m.%Y %H:%M}"
+    elif action == "ban":
+        changed = set(await db.bulk_ban_users(telegram_ids, argument or "Не указана")) if telegram_ids else set()
+        for row in targets:
+            row.result = "заблокирован" if row.telegram_id in changed else "уже заблокирован"
+    else:
+        changed = set(await db.bulk_unban_users(telegram_ids)) if telegram_ids else set()
+        for row in targets:
+            row.result = "разблокирован" if row.telegram_id in changed else "не был заблокирован"
+
+    summary: Dict[str, int] = {}
+    for row in rows:
+        summary[row.result] = summary.get(row.result, 0) + 1
+    logger.info(f"Массовое действие {action}: строк {len(rows)}, применено к {len(telegram_ids)}")
+    return summary
+
+
+def render_report(rows: List[BulkRow]) -> bytes:
+    """Отчет по строкам в CSV: номер строки, значение, Telegram ID, результат."""
+    buffer = io.StringIO()
+    writer = csv.writer(buffer)
+    writer.writerow(["line", "value", "telegram_id", "result"])
+    for row in rows:
+        writer.writerow([row.line, row.value, row.telegram_id or "", row.result])
+    return buffer.getvalue().encode("utf-8-sig")
@@ -0,0 +1,142 @@
+import logging
+import time
+from dataclasses import dataclass
+from typing import Dict, Optional, Tuple
+
+from aiogram.exceptions import TelegramRetryAfter
+
+from bot.utils.delivery import (classify_task_error, TASK_FAILURE_CHAT, TASK_FAILURE_CONNECTION,
+                                TASK_FAILURE_MESSAGE)
+from bot.utils.metrics import registry
+
+# Настройка логирования
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+# Сколько временных ошибок подряд допускается, прежде чем задача в чате остановится
+CIRCUIT_FAILURE_THRESHOLD = 5
+# Пауза после временной ошибки удваивается: 1, 2, 4... секунды, но не больше максимума
+CIRCUIT_BACKOFF_BASE = 1.0
+CIRCUIT_BACKOFF_MAX = 60.0
+# Сколько секунд после срабатывания в чате (или подключении) не запускаются новые задачи
+CIRCUIT_OPEN_SECONDS = 600
+
+# Остановка из-за серии временных ошибок
+TASK_FAILURE_REPEATED = "repeated"
+
+# Ключ цепи: (ID бизнес-подключения, ID чата); ID чата None — цепь всего подключения
+CircuitKey = Tuple[Optional[str], Optional[int]]
+
+CIRCUIT_TRIPS = registry.counter(
+    "bot_circuit_trips_total", "Остановки задач в чатах из-за ошибок Bot API", ["scope"]
+)
+CIRCUITS_OPEN = registry.gauge("bot_circuits_open", "Чаты и подключения, в которых задачи временно не запускаются")
+
+
+@dataclass(frozen=True)
+class Verdict:
+    """
+    Решение после ошибки задачи.
+
+    :param stop: Остановить задачу.
+    :param scope: Область постоянной ошибки (TASK_FAILURE_*) или None для временной.
+    :param delay: Пауза перед следующей попыткой, если задача продолжается.
+    """
+    stop: bool
+    scope: Optional[str] = None
+    delay: float = 0.0
+
+
+class CircuitBreaker:
+    """
+    Предохранитель длительных задач в чатах.
+
+    Постоянная ошибка (чат или подключение недоступны, сообщение удалено)
+    сразу останавливает задачу, а для чата или подключения цепь размыкается на
+    CIRCUIT_OPEN_SECONDS: новые задачи там не запускаются. Временные ошибки
+    отодвигают следующую попытку с экспоненциальной паузой, а после
+    CIRCUIT_FAILURE_THRESHOLD ошибок подряд задача тоже останавливается.
+    """
+
+    def __init__(self, failure_threshold: int = CIRCUIT_FAILURE_THRESHOLD,
+                 backoff_base: float = CIRCUIT_BACKOFF_BASE, backoff_max: float = CIRCUIT_BACKOFF_MAX,
+                 open_seconds: float = CIRCUIT_OPEN_SECONDS):
+        self.failure_threshold = failure_threshold
+        self.backoff_base = backoff_base
+        self.backoff_max = backoff_max
+        self.open_seconds = open_seconds
+        # Временные ошибки подряд по чатам
+        self._failures: Dict[CircuitKey, int] = {}
+        # Разомкнутые цепи: ключ -> время (monotonic), до которого задачи не запускаются
+        self._open: Dict[CircuitKey, float] = {}
+        CIRCUITS_OPEN.set_function(self.open_count)
+
+    def is_open(self, connection_id: Optional[str], chat_id: int) -> bool:
+        """Разомкнута ли цепь чата или всего его подключения."""
+        now = time.monotonic()
+        for key in ((connection_id, None), (connection_id, chat_id)):
+            until = self._open.get(key)
+            if until is None:
+                continue
+            if until > now:
+                return True
+            del self._open[key]
+        return False
+
+    def open_count(self) -> int:
+        now = time.monotonic()
+        return sum(1 for until in self._open.values() if until > now)
+
+    def success(self, connection_id: Optional[str], chat_id: int):
+        """Вызов прошел: счетчик ошибок подряд сбрасывается."""
+        if self._failures:
+            self._failures.pop((connection_id, chat_id), None)
+
+    def forget(self, connection_id: Optional[str], chat_id: int):
+        """Задач в чате больше нет: счетчик ошибок подряд не нужен (разомкнутая цепь остается)."""
+        self._failures.pop((connection_id, chat_id), None)
+
+    def failure(self, connection_id: Optional[str], chat_id: int, error: BaseException) -> Verdict:
+        """
+        Учесть ошибку задачи и решить, что с ней делать.
+
+        :param connection_id: ID бизнес-подключения (None для обычного чата).
+        :param chat_id: ID чата.
+        :param error: Исключение вызова Bot API.
+        """
+        key = (connection_id, chat_id)
+        scope = classify_task_error(error)
+        if scope == TASK_FAILURE_CONNECTION and connection_id is not None:
+            self._trip((connection_id, None), scope, error)
+            return Verdict(True, scope)
+        if scope in (TASK_FAILURE_CHAT, TASK_FAILURE_CONNECTION):
+            self._trip(key, TASK_FAILURE_CHAT, error)
+            return Verdict(True, TASK_FAILURE_CHAT)
+        if scope == TASK_FAILURE_MESSAGE:
+            self._failures.pop(key, None)
+            CIRCUIT_TRIPS.inc(scope=scope)
+            return Verdict(True, scope)
+
+        failures = self._failures.get(key, 0) + 1
+        if failures >= self.failure_threshold:
+            self._trip(key, TASK_FAILURE_REPEATED, error)
+            return Verdict(True, TASK_FAILURE_REPEATED)
+        self._failures[key] = failures
+        delay = min(self.backoff_base * 2 ** (failures - 1), self.backoff_max)
+        if isinstance(error, TelegramRetryAfter):
+            delay = max(delay, error.retry_after)
+        return Verdict(False, None, delay)
+
+    def _trip(self, key: CircuitKey, scope: str, error: BaseException):
+        now = time.monotonic()
+        self._failures.pop(key, None)
+        # Срабатывания редки, поэтому истекшие цепи можно вычищать прямо здесь
+        self._open = {open_key: until for open_key, until in self._open.items() if until > now}
+        self._open[key] = now + self.open_seconds
+        CIRCUIT_TRIPS.inc(scope=scope)
+        connection_id, chat_id = key
+        target = f"чат {chat_id}" if chat_id is not None else "подключение"
+        logger.warning(f"⛔ Задачи остановлены ({scope}): {target}, подключение {connection_id}: {error}")
+
+
+task_breaker = CircuitBreaker()
@@ -0,0 +1,101 @@
+import asyncio
+import logging
+from datetime import datetime
+from typing import AsyncIterator, Dict, Iterable, List, Optional
+
+import bot.database.database as db
+from bot.services.expiry import expiry_engine
+
+# Настройка логирования
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+
+class EntitlementService:
+    """
+    Кэш прав доступа владельцев бизнес-подключений.
+
+    Хранит в памяти даты окончания действующих подписок и отвечает на вопрос
+    «есть ли у владельца подписка прямо сейчас» за O(1), без запроса к базе на
+    каждое бизнес-сообщение. Кэш загружается при старте и обновляется всеми
+    путями выдачи и окончания подписки: оплатой, /give и движком окончания.
+    """
+
+    def __init__(self):
+        self._expiries: Dict[int, datetime] = {}
+        self._streams: List[asyncio.Queue] = []
+
+    async def start(self):
+        """Загрузить действующие подписки и подписаться на движок окончания."""
+        self._expiries = {telegram_id: end_date for end_date, telegram_id in await db.get_upcoming_expiries()}
+        expiry_engine.add_listener(self.revoke)
+        logger.info(f"Кэш подписок загружен: {len(self._expiries)}")
+
+    async def reload(self):
+        """
+        Перезагрузить кэш из базы (после /cleanup_db и других массовых изменений
+        в обход сервиса). Владельцы, которых больше нет в базе, проходят через
+        revoke, поэтому подписчики потока окончаний останавливают их задачи.
+        """
+        current = {telegram_id: end_date for end_date, telegram_id in await db.get_upcoming_expiries()}
+        self.revoke([telegram_id for telegram_id in self._expiries if telegram_id not in current])
+        self._expiries = current
+        logger.info(f"Кэш подписок перезагружен: {len(self._expiries)}")
+
+    def is_entitled(self, telegram_id: int) -> bool:
+        """Действует ли подписка пользователя прямо сейчас."""
+        end_date = self._expiries.get(telegram_id)
+        return end_date is not None and end_date > datetime.now()
+
+    def expires_at(self, telegram_id: int) -> Optional[datetime]:
+        """Дата окончания подписки пользователя или None."""
+        return self._expiries.get(telegram_id)
+
+    async def grant(self, telegram_id: int, end_date: datetime):
+        """
+        Выдать подписку: запись в базу, кэш и расписание движка окончания.
+
+        :param telegram_id: ID пользователя в Telegram.
+        :param end_date: Дата окончания подписки.
+        """
+        await db.create_subscription(user_telegram_id=telegram_id, end_date=end_date)
+        self._expiries[telegram_id] = end_date
+        expiry_engine.schedule(telegram_id, end_date)
+
+    async def grant_many(self, telegram_ids: List[int], end_date: datetime):
+        """
+        Выдать подписку нескольким пользователям одной транзакцией.
+
+        :param telegram_ids: Telegram ID пользователей.
+        :param end_date: Дата окончания подписки.
+        """
+        await db.bulk_create_subscriptions(telegram_ids, end_date)
+        for telegram_id in telegram_ids:
+            self._expiries[telegram_id] = end_date
+            expiry_engine.schedule(telegram_id, end_date)
+
+    def revoke(self, telegram_ids: Iterable[int]):
+        """Убрать пользователей из кэша и оповестить подписчиков потока окончаний."""
+        for telegram_id in telegram_ids:
+            if self._expiries.pop(telegram_id, None) is None:
+                continue
+            for stream in self._streams:
+                stream.put_nowait(telegram_id)
+
+    async def expirations(self) -> AsyncIterator[int]:
+        """
+        Поток Telegram ID пользователей, у которых закончилась подписка.
+
+        Каждый потребитель получает собственную очередь, поэтому компонентам
+        не нужно опрашивать базу, чтобы узнать об окончании подписки.
+        """
+        stream: asyncio.Queue = asyncio.Queue()
+        self._streams.append(stream)
+        try:
+            while True:
+                yield await stream.get()
+        finally:
+            self._streams.remove(stream)
+
+
+entitlements = EntitlementService()
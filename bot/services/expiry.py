@@ -0,0 +1,143 @@
+import asyncio
+import heapq
+import logging
+from datetime import datetime
+from typing import Callable, List, Optional, Tuple
+
+from aiogram import Bot
+
+import bot.database.database as db
+from bot.assets.texts import Texts
+from bot.utils.delivery import classify_delivery_error
+
+# Настройка логирования
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+# Страховочная проверка: даже без запланированных окончаний движок просыпается
+# не реже раза в час и проверяет базу (на случай подписок, выданных в обход движка)
+MAX_SLEEP_SECONDS = 3600
+
+# Уведомления об окончании подписки отправляются пачками, чтобы не упереться в лимиты Bot API
+NOTIFY_BATCH_SIZE = 25
+NOTIFY_BATCH_PAUSE = 1.0
+
+
+class SubscriptionExpiryEngine:
+    """
+    Движок окончания подписок.
+
+    Держит min-heap дат окончания и спит ровно до ближайшей из них. При
+    пробуждении снимает все истекшие подписки одним set-based UPDATE и
+    уведомляет пользователей пачками. Устаревшие записи в куче (подписку
+    продлили) безопасны: UPDATE опирается на дату в базе, а не на кучу.
+    """
+
+    def __init__(self):
+        self._heap: List[Tuple[datetime, int]] = []
+        self._wakeup = asyncio.Event()
+        self._task: Optional[asyncio.Task] = None
+        self._bot: Optional[Bot] = None
+        self._listeners: List[Callable[[List[int]], None]] = []
+
+    async def start(self, bot: Bot):
+        """Загрузить даты окончания подписок и запустить движок."""
+        self._bot = bot
+        self._heap = await db.get_upcoming_expiries()
+        heapq.heapify(self._heap)
+        self._task = asyncio.create_task(self._run())
+        logger.info(f"Движок подписок запущен, отслеживается подписок: {len(self._heap)}")
+
+    async def reload(self):
+        """Пересобрать кучу дат окончания из базы (после массовых изменений подписок)."""
+        self._heap = await db.get_upcoming_expiries()
+        heapq.heapify(self._heap)
+        self._wakeup.set()
+        logger.info(f"Движок подписок перезагружен, отслеживается подписок: {len(self._heap)}")
+
+    async def stop(self):
+        if self._task:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+
+    def add_listener(self, listener: Callable[[List[int]], None]):
+        """Зарегистрировать обработчик, получающий Telegram ID истекших подписок."""
+        self._listeners.append(listener)
+
+    def schedule(self, telegram_id: int, end_date: datetime):
+        """
+        Учесть новую дату окончания подписки.
+
+        :param telegram_id: ID пользователя в Telegram.
+        :param end_date: Дата окончания подписки.
+        """
+        is_earliest = not self._heap or end_date < self._heap[0][0]
+        heapq.heappush(self._heap, (end_date, telegram_id))
+        if is_earliest:
+            # Новая ближайшая дата — пересчитываем время сна
+            self._wakeup.set()
+
+    def _seconds_until_next(self) -> float:
+        if not self._heap:
+            return MAX_SLEEP_SECONDS
+        delay = (self._heap[0][0] - datetime.now()).total_seconds()
+        return min(max(delay, 0), MAX_SLEEP_SECONDS)
+
+    async def _run(self):
+        while True:
+            timed_out = False
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), timeout=self._seconds_until_next())
+            except asyncio.TimeoutError:
+                timed_out = True
+            self._wakeup.clear()
+
+            now = datetime.now()
+            due = False
+            while self._heap and self._heap[0][0] <= now:
+                heapq.heappop(self._heap)
+                due = True
+            if not due and not timed_out:
+                # Проснулись из-за новой ближайшей даты, истекать пока нечему
+                continue
+
+            try:
+                await self.expire_due()
+            except Exception as e:
+                logger.error(f"Ошибка при обработке истекших подписок: {e}")
+
+    async def expire_due(self) -> List[int]:
+        """Снять истекшие подписки и уведомить пользователей."""
+        expired_ids = await db.delete_expired_subscriptions()
+        if expired_ids:
+            for listener in self._listeners:
+                listener(expired_ids)
+            await self._notify(expired_ids)
+        return expired_ids
+
+    async def _notify(self, telegram_ids: List[int]):
+        if self._bot is None:
+            return
+        unreachable = {}
+        for start in range(0, len(telegram_ids), NOTIFY_BATCH_SIZE):
+            batch = telegram_ids[start:start + NOTIFY_BATCH_SIZE]
+            results = await asyncio.gather(
+                *(self._bot.send_message(telegram_id, Texts.SUBSCRIPTION_ENDED) for telegram_id in batch),
+                return_exceptions=True
+            )
+            for telegram_id, result in zip(batch, results):
+                if isinstance(result, Exception):
+                    logger.warning(f"Не удалось уведомить {telegram_id} об окончании подписки: {result}")
+                    reason = classify_delivery_error(result)
+                    if reason:
+                        unreachable[telegram_id] = reason
+            if start + NOTIFY_BATCH_SIZE < len(telegram_ids):
+                await asyncio.sleep(NOTIFY_BATCH_PAUSE)
+        await db.mark_users_unreachable(unreachable)
+
+
+expiry_engine = SubscriptionExpiryEngine()
@@ -0,0 +1,138 @@
+import argparse
+import asyncio
+import csv
+import gzip
+import io
+import json
+import logging
+from datetime import date, datetime
+from pathlib import Path
+from typing import Any, Dict, List, Optional
+
+from sqlalchemy import Table, select
+
+import bot.database.database as db
+
+# Настройка логирования
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+EXPORT_DIR = Path("exports")
+EXPORT_FORMATS = ("jsonl", "csv")
+
+# Размер пачки строк, которые читаются из курсора и сжимаются за один раз
+EXPORT_CHUNK_SIZE = 1000
+
+EXPORT_TABLES: Dict[str, Table] = {
+    "users": db.User.__table__,
+    "messages": db.Message.__table__,
+    "user_message_stats": db.UserMessageStats.__table__,
+    "subscriptions": db.Subscription.__table__,
+}
+
+
+def _json_default(value: Any):
+    if isinstance(value, (datetime, date)):
+        return value.isoformat()
+    return str(value)
+
+
+class _ExportWriter:
+    """Пишет строки в сжатый gzip-файл в формате JSONL или CSV."""
+
+    def __init__(self, path: Path, fmt: str, columns: List[str]):
+        self._file = gzip.open(path, "wt", encoding="utf-8", newline="")
+        self._fmt = fmt
+        self._columns = columns
+        self._csv = None
+        if fmt == "csv":
+            self._csv = csv.writer(self._file)
+            self._csv.writerow(columns)
+
+    def write_rows(self, rows: List[tuple]):
+        if self._csv is not None:
+            self._csv.writerows(
+                [value.isoformat() if isinstance(value, (datetime, date)) else value for value in row]
+                for row in rows
+            )
+            return
+        buffer = io.StringIO()
+        for row in rows:
+            buffer.write(json.dumps(dict(zip(self._columns, row)), ensure_ascii=False, default=_json_default))
+            buffer.write("\n")
+        self._file.write(buffer.getvalue())
+
+    def close(self):
+        self._file.close()
+
+
+async def export_table(table_name: str, fmt: str = "jsonl", directory: Path = EXPORT_DIR,
+                       chunk_size: int = EXPORT_CHUNK_SIZE) -> Path:
+    """
+    Выгрузить таблицу в сжатый файл.
+
+    Строки читаются из пула только для чтения серверным курсором (stream)
+    пачками по chunk_size и сразу дописываются в файл, поэтому потребление
+    памяти не зависит от размера таблицы, а выгрузка не мешает записи.
+    Сжатие выполняется в отдельном потоке, чтобы не блокировать event loop.
+    Для таблиц с помесячными партициями выгружаются все партиции в один файл.
+
+    :param table_name: Имя таблицы из EXPORT_TABLES.
+    :param fmt: Формат файла: jsonl или csv.
+    :param directory: Каталог для файла выгрузки.
+    :param chunk_size: Количество строк в одной пачке.
+    :return: Путь к созданному файлу.
+    """
+    if table_name not in EXPORT_TABLES:
+        raise ValueError(f"Неизвестная таблица: {table_name}. Доступны: {', '.join(EXPORT_TABLES)}")
+    if fmt not in EXPORT_FORMATS:
+        raise ValueError(f"Неизвестный формат: {fmt}. Доступны: {', '.join(EXPORT_FORMATS)}")
+
+    table = EXPORT_TABLES[table_name]
+    directory.mkdir(parents=True, exist_ok=True)
+    path = directory / f"{table_name}_{datetime.now().strftime('%Y%m%d_%H%M%S')}.{fmt}.gz"
+    columns = [column.name for column in table.columns]
+    sources = await db.get_partition_tables(table)
+
+    writer = _ExportWriter(path, fmt, columns)
+    total = 0
+    try:
+        async with db.read_engine.connect() as conn:
+            for source in sources:
+                stmt = select(*(source.c[name] for name in columns)).order_by(*source.primary_key.columns)
+                result = await conn.stream(stmt.execution_options(yield_per=chunk_size))
+                async for rows in result.partitions(chunk_size):
+                    await asyncio.to_thread(writer.write_rows, [tuple(row) for row in rows])
+                    total += len(rows)
+    except Exception:
+        writer.close()
+        path.unlink(missing_ok=True)
+        raise
+    await asyncio.to_thread(writer.close)
+
+    logger.info(f"Выгружено строк из {table_name}: {total} -> {path}")
+    return path
+
+
+async def _run_cli(tables: List[str], fmt: str, directory: Path, chunk_size: int):
+    # Без бота миграции никто не применит, а выгрузка опирается на колонки ORM
+    await db.init_db()
+    for table_name in tables:
+        path = await export_table(table_name, fmt, directory, chunk_size)
+        print(path)
+    await db.engine.dispose()
+
+
+def main(argv: Optional[List[str]] = None):
+    parser = argparse.ArgumentParser(description="Выгрузка таблиц базы данных в сжатые JSONL/CSV файлы")
+    parser.add_argument("tables", nargs="*", default=list(EXPORT_TABLES),
+                        help=f"Таблицы для выгрузки (по умолчанию все): {', '.join(EXPORT_TABLES)}")
+    parser.add_argument("--format", choices=EXPORT_FORMATS, default="jsonl", dest="fmt")
+    parser.add_argument("--output", type=Path, default=EXPORT_DIR, help="Каталог для файлов выгрузки")
+    parser.add_argument("--chunk-size", type=int, default=EXPORT_CHUNK_SIZE)
+    args = parser.parse_args(argv)
+    asyncio.run(_run_cli(args.tables, args.fmt, args.output, args.chunk_size))
+
+
+if __name__ == "__main__":
+    main()
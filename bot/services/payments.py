@@ -1,6 +1,7 @@
 import logging
 from aiocryptopay import AioCryptoPay, Networks
 from config import CRYPTO_PAY_API_TOKEN
+from bot.utils.metrics import registry
 
 # Настройка логирования
 logging.basicConfig(level=logging.INFO)
@@ -9,26 +10,32 @@ logger = logging.getLogger(__name__)
 # Инициализация CryptoPay
 crypto = AioCryptoPay(CRYPTO_PAY_API_TOKEN, network=Networks.MAIN_NET)
 
+PAYMENT_CALLS = registry.counter("bot_payment_calls_total", "Вызовы CryptoPay", ["operation", "result"])
+PAYMENT_SECONDS = registry.histogram("bot_payment_call_seconds", "Длительность вызовов CryptoPay", ["operation"])
+
 async def create_invoice(amount: float, user_id: int, bot_username: str) -> dict:
     """Create payment invoice"""
     try:
-        invoice = await crypto.create_invoice(
-            asset='USDT',
-            amount=amount,
-            description=f"Подписка на бизнес-бота для пользователя {user_id}",
-            hidden_message="Спасибо за оплату! Подписка активирована.",
-            paid_btn_name="openBot",
-            paid_btn_url=f"https://t.me/{bot_username}",
-            allow_comments=True,
-            allow_anonymous=True,
-            expires_in=3600
-        )
+        with PAYMENT_SECONDS.time(operation="create_invoice"):
+            invoice = await crypto.create_invoice(
+                asset='USDT',
+                amount=amount,
+                description=f"Подписка на бизнес-бота для пользователя {user_id}",
+                hidden_message="Спасибо за оплату! Подписка активирована.",
+                paid_btn_name="openBot",
+                paid_btn_url=f"https://t.me/{bot_username}",
+                allow_comments=True,
+                allow_anonymous=True,
+                expires_in=3600
+            )
+        PAYMENT_CALLS.inc(operation="create_invoice", result="ok")
         logger.info(f"Создан инвойс {invoice.invoice_id} для пользователя {user_id}")
         return {
             "invoice_id": invoice.invoice_id,
             "pay_url": invoice.bot_invoice_url
         }
     except Exception as e:
+        PAYMENT_CALLS.inc(operation="create_invoice", result="error")
         logger.error(f"Ошибка при создании инвойса: {e}")
         return {
             "invoice_id": None,
@@ -38,11 +45,14 @@ async def create_invoice(amount: float, user_id: int, bot_username: str) -> dict
 async def check_payment(invoice_id: int) -> bool:
     """Check payment status"""
     try:
-        invoice = await crypto.get_invoices(invoice_ids=invoice_id)
+        with PAYMENT_SECONDS.time(operation="check_payment"):
+            invoice = await crypto.get_invoices(invoice_ids=invoice_id)
         if not invoice:
+            PAYMENT_CALLS.inc(operation="check_payment", result="not_found")
             logger.error(f"Инвойс {invoice_id} не найден")
             return False
 
+        PAYMENT_CALLS.inc(operation="check_payment", result=invoice.status)
         if invoice.status in ["paid", "confirmed"]:
             logger.info(f"Инвойс {invoice_id} оплачен")
             return True
@@ -53,16 +63,20 @@ async def check_payment(invoice_id: int) -> bool:
             logger.info(f"Инвойс {invoice_id} не оплачен (статус: {invoice.status})")
             return False
     except Exception as e:
+        PAYMENT_CALLS.inc(operation="check_payment", result="error")
         logger.error(f"Ошибка при проверке оплаты инвойса {invoice_id}: {e}")
         return False
 
 async def delete_invoice(invoice_id: int) -> bool:
     """Delete invoice"""
     try:
-        await crypto.delete_invoice(invoice_id)
+        with PAYMENT_SECONDS.time(operation="delete_invoice"):
+            await crypto.delete_invoice(invoice_id)
+        PAYMENT_CALLS.inc(operation="delete_invoice", result="ok")
         logger.info(f"Инвойс {invoice_id} удален")
         return True
     except Exception as e:
+        PAYMENT_CALLS.inc(operation="delete_invoice", result="error")
         logger.error(f"Ошибка при удалении инвойса {invoice_id}: {e}")
         return False
 
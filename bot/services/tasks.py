@@ -0,0 +1,214 @@
+import asyncio
+import json
+import logging
+import os
+from dataclasses import dataclass
+from typing import Any, Callable, Dict, Optional, Set, Tuple
+
+from aiogram import Bot
+
+import bot.database.database as db
+from bot.services.animations import Animation
+from bot.services.circuit import task_breaker
+from bot.services.entitlements import entitlements
+from bot.utils.metrics import registry
+
+# Настройка логирования
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+# Ограничения на число одновременно работающих задач
+MAX_TASKS_PER_OWNER = int(os.getenv("MAX_TASKS_PER_OWNER", "10"))
+MAX_TASKS_TOTAL = int(os.getenv("MAX_TASKS_TOTAL", "2000"))
+
+# Ключ задачи: (ID бизнес-подключения, ID чата, вид задачи). Одинаковые ID
+# собеседников у разных владельцев не пересекаются, так как подключения разные
+TaskKey = Tuple[str, int, str]
+
+# Запуск задачи: (бот, ID чата, ID бизнес-подключения, параметры) -> анимация
+TaskStarter = Callable[[Bot, int, str, Dict[str, Any]], Animation]
+
+TASKS = registry.gauge("bot_tasks", "Количество запущенных фоновых тасков", ["kind"])
+TASK_OWNERS = registry.gauge("bot_task_owners", "Владельцы подключений с запущенными тасками")
+TASK_REJECTIONS = registry.counter("bot_task_rejections_total", "Таски, не запущенные из-за ограничений", ["reason"])
+
+
+class TaskLimitError(ValueError):
+    """Превышено ограничение на число задач; текст можно показать пользователю."""
+
+
+class ChatUnavailableError(ValueError):
+    """Предохранитель чата разомкнут, задача не запущена; текст можно показать пользователю."""
+
+
+@dataclass(frozen=True)
+class TaskKind:
+    """
+    Вид задачи.
+
+    :param name: Имя вида (pin, online, spam).
+    :param start: Функция запуска анимации.
+    :param resumable: Сохранять ли описание задачи для возобновления после перезапуска;
+        короткие конечные задачи (спам) не возобновляются, чтобы не повторяться.
+    """
+    name: str
+    start: TaskStarter
+    resumable: bool = True
+
+
+class TaskRegistry:
+    """
+    Реестр длительных задач в чатах бизнес-подключений.
+
+    В каждом чате подключения работает не больше одной задачи каждого вида:
+    новая задача с тем же ключом заменяет старую. Реестр ограничивает число
+    задач на владельца и в целом, сохраняет описания возобновляемых задач в
+    таблицу chat_tasks и останавливает задачи владельца, когда у него
+    заканчивается подписка.
+    """
+
+    def __init__(self, max_per_owner: int = MAX_TASKS_PER_OWNER, max_total: int = MAX_TASKS_TOTAL):
+        self.max_per_owner = max_per_owner
+        self.max_total = max_total
+        self._kinds: Dict[str, TaskKind] = {}
+        self._tasks: Dict[TaskKey, Animation] = {}
+        self._owners: Dict[TaskKey, int] = {}
+        self._pending: Set[asyncio.Task] = set()
+        TASK_OWNERS.set_function(lambda: len(set(self._owners.values())))
+
+    def register_kind(self, name: str, start: TaskStarter, resumable: bool = True):
+        """Зарегистрировать вид задачи."""
+        self._kinds[name] = TaskKind(name, start, resumable)
+        TASKS.set_function(lambda: self.count(kind=name), kind=name)
+
+    def is_running(self, connection_id: str, chat_id: int, kind: str) -> bool:
+        return (connection_id, chat_id, kind) in self._tasks
+
+    def count(self, kind: Optional[str] = None, owner_id: Optional[int] = None) -> int:
+        """Количество задач (всех, одного вида или одного владельца)."""
+        return sum(1 for key, owner in self._owners.items()
+                   if (kind is None or key[2] == kind) and (owner_id is None or owner == owner_id))
+
+    def counts(self) -> Dict[str, int]:
+        """Количество задач по видам."""
+        return {name: self.count(kind=name) for name in self._kinds}
+
+    async def start(self, kind: str, bot: Bot, chat_id: int, connection_id: str, owner_id: int,
+                    params: Optional[Dict[str, Any]] = None) -> Animation:
+        """
+        Запустить задачу в чате, заменив задачу того же вида в этом чате.
+
+        :param kind: Вид задачи.
+        :param bot: Бот.
+        :param chat_id: ID чата.
+        :param connection_id: ID бизнес-подключения.
+        :param owner_id: Telegram ID владельца подключения.
+        :param params: Параметры задачи (сохраняются для возобновления).
+        :return: Запущенная анимация.
+        :raises TaskLimitError: Превышено ограничение на число задач.
+        :raises ChatUnavailableError: Задачи в чате временно не запускаются после ошибок Bot API.
+        """
+        task_kind = self._kinds[kind]
+        key = (connection_id, chat_id, kind)
+        params = params or {}
+        if task_breaker.is_open(connection_id, chat_id):
+            TASK_REJECTIONS.inc(reason="circuit")
+            raise ChatUnavailableError("Задачи в этом чате временно не запускаются: Telegram отклонял "
+                                       "их сообщения. Попробуйте позже")
+        previous = self._tasks.get(key)
+        if previous is None:
+            if self.count(owner_id=owner_id) >= self.max_per_owner:
+                TASK_REJECTIONS.inc(reason="owner")
+                raise TaskLimitError(f"Запущено слишком много задач, максимум {self.max_per_owner}. "
+                                     f"Остановите одну из них и попробуйте снова")
+            if len(self._tasks) >= self.max_total:
+                TASK_REJECTIONS.inc(reason="total")
+                raise TaskLimitError("Бот сейчас перегружен задачами, попробуйте позже")
+
+        animation = task_kind.start(bot, chat_id, connection_id, params)
+        if animation.done():
+            # Анимация завершилась, не начавшись (например, пустая последовательность кадров)
+            return animation
+        self._tasks[key] = animation
+        self._owners[key] = owner_id
+        animation.add_done_callback(lambda done: self._forget(key, done))
+        # Старая задача отменяется после замены в реестре, чтобы ее завершение
+        # не удалило описание новой
+        if previous is not None:
+            previous.cancel()
+        if task_kind.resumable:
+            await db.save_chat_task(connection_id, chat_id, kind, owner_id, json.dumps(params))
+        return animation
+
+    def stop(self, connection_id: str, chat_id: int, kind: str) -> bool:
+        """
+        Остановить задачу.
+
+        :return: True, если задача была запущена.
+        """
+        animation = self._tasks.get((connection_id, chat_id, kind))
+        if animation is None:
+            return False
+        animation.cancel()
+        return True
+
+    def stop_owner(self, owner_id: int) -> int:
+        """Остановить все задачи владельца. Возвращает их количество."""
+        keys = [key for key, owner in self._owners.items() if owner == owner_id]
+        for key in keys:
+            self._tasks[key].cancel()
+        return len(keys)
+
+    def _forget(self, key: TaskKey, animation: Animation):
+        if self._tasks.get(key) is not animation:
+            # Задачу уже заменила новая с тем же ключом
+            return
+        del self._tasks[key]
+        del self._owners[key]
+        if self._kinds[key[2]].resumable:
+            task = asyncio.create_task(db.delete_chat_task(*key))
+            self._pending.add(task)
+            task.add_done_callback(self._pending.discard)
+
+    async def resume(self, bot: Bot):
+        """Возобновить задачи, сохраненные до перезапуска."""
+        resumed = 0
+        for descriptor in await db.get_chat_tasks():
+            key = (descriptor.business_connection_id, descriptor.chat_id, descriptor.kind)
+            task_kind = self._kinds.get(descriptor.kind)
+            if task_kind is None or not task_kind.resumable or not entitlements.is_entitled(descriptor.owner_id):
+                await db.delete_chat_task(*key)
+                continue
+            try:
+                animation = await self.start(descriptor.kind, bot, descriptor.chat_id,
+                                             descriptor.business_connection_id, descriptor.owner_id,
+                                             json.loads(descriptor.params or "{}"))
+            except ValueError as e:
+                logger.warning(f"Задача {key} не возобновлена: {e}")
+                await db.delete_chat_task(*key)
+                continue
+            if animation.done():
+                await db.delete_chat_task(*key)
+                continue
+            resumed += 1
+        logger.info(f"Возобновлено задач в чатах: {resumed}")
+
+    async def stop(self):
+        """
+        Выключение бота: дождаться удаления описаний завершенных задач.
+
+        Сами анимации останавливает animation_engine.stop() без вызова обработчиков
+        завершения, поэтому описания работающих задач сохраняются для возобновления.
+        """
+        if self._pending:
+            await asyncio.gather(*self._pending, return_exceptions=True)
+
+    async def watch_expirations(self):
+        """Останавливать задачи владельцев, у которых закончилась подписка."""
+        async for owner_id in entitlements.expirations():
+            stopped = self.stop_owner(owner_id)
+            if stopped:
+                logger.info(f"Таски пользователя {owner_id} остановлены: подписка закончилась ({stopped})")
+
+
+task_registry = TaskRegistry()
@@ -0,0 +1,147 @@
+"""
+Учет вызовов Bot API.
+
+Middleware сессии бота считает каждый вызов: метод, обработчик, из которого
+он сделан (по трейсу апдейта, см. bot/utils/tracing.py), длительность, ошибки
+и flood wait. Вызовы вне апдейтов (рассылки, движок подписок, планировщик)
+учитываются под именем BACKGROUND. Итоги — в /metrics и команде /apistats.
+"""
+import time
+from dataclasses import dataclass
+from datetime import datetime
+from typing import Dict, List, Optional, Tuple
+
+from aiogram import Bot
+from aiogram.client.session.middlewares.base import BaseRequestMiddleware
+from aiogram.exceptions import TelegramAPIError, TelegramRetryAfter
+
+from bot.utils.metrics import registry
+from bot.utils.tracing import UpdateTrace, add_finish_listener, current_handler, current_trace, record_api
+
+# Обработчик для вызовов, сделанных вне апдейта
+BACKGROUND = "background"
+
+# Результаты вызова
+RESULT_OK = "ok"
+RESULT_ERROR = "error"
+RESULT_FLOOD_WAIT = "flood_wait"
+
+API_CALLS = registry.counter(
+    "bot_api_calls_total", "Вызовы Bot API", ["method", "handler", "result"]
+)
+API_SECONDS = registry.histogram(
+    "bot_api_call_seconds", "Длительность вызовов Bot API", ["method"]
+)
+API_FLOOD_WAIT_SECONDS = registry.counter(
+    "bot_api_flood_wait_seconds_total", "Суммарное ожидание по flood wait (retry_after)", ["method"]
+)
+
+
+@dataclass
+class ApiMethodStats:
+    """Накопленная статистика одного метода Bot API."""
+    method: str
+    calls: int = 0
+    errors: int = 0
+    flood_waits: int = 0
+    total_seconds: float = 0.0
+    max_seconds: float = 0.0
+    last_error: str = ""
+
+
+class ApiAccounting:
+    """Счетчики вызовов Bot API по методам и по обработчикам."""
+
+    def __init__(self):
+        self.reset()
+
+    def reset(self):
+        """Сбросить накопленную статистику (метрики /metrics не сбрасываются)."""
+        self.started = datetime.now()
+        self._methods: Dict[str, ApiMethodStats] = {}
+        # (обработчик, метод) -> [вызовов, ошибок]
+        self._pairs: Dict[Tuple[str, str], List[int]] = {}
+        # обработчик -> [апдейтов, вызовов за время апдейта]
+        self._handlers: Dict[str, List[int]] = {}
+
+    def record(self, method: str, handler: str, seconds: float, error: Optional[TelegramAPIError] = None):
+        """
+        Учесть вызов.
+
+        :param method: Метод Bot API (sendMessage, editMessageText...).
+        :param handler: Обработчик, из которого сделан вызов, или BACKGROUND.
+        :param seconds: Длительность вызова.
+        :param error: Ошибка Telegram, если вызов не удался.
+        """
+        stats = self._methods.get(method)
+        if stats is None:
+            stats = self._methods[method] = ApiMethodStats(method)
+        stats.calls += 1
+        stats.total_seconds += seconds
+        stats.max_seconds = max(stats.max_seconds, seconds)
+        pair = self._pairs.setdefault((handler, method), [0, 0])
+        pair[0] += 1
+
+        if error is None:
+            result = RESULT_OK
+        else:
+            pair[1] += 1
+            stats.errors += 1
+            stats.last_error = str(error)
+            result = RESULT_ERROR
+            if isinstance(error, TelegramRetryAfter):
+                result = RESULT_FLOOD_WAIT
+                stats.flood_waits += 1
+                API_FLOOD_WAIT_SECONDS.inc(error.retry_after, method=method)
+        API_CALLS.inc(method=method, handler=handler, result=result)
+        API_SECONDS.observe(seconds, method=method)
+
+    def update_finished(self, trace: UpdateTrace, total: float):
+        """Слушатель завершения апдейта: сколько вызовов стоил апдейт обработчику."""
+        handler_stats = self._handlers.setdefault(trace.handler, [0, 0])
+        handler_stats[0] += 1
+        handler_stats[1] += trace.api_calls
+
+    def methods(self) -> List[ApiMethodStats]:
+        """Методы от самых частых к редким."""
+        return sorted(self._methods.values(), key=lambda stats: stats.calls, reverse=True)
+
+    def pairs(self, limit: int = 10) -> List[Tuple[str, str, int, int]]:
+        """Пары (обработчик, метод, вызовов, ошибок) от самых частых."""
+        return sorted(((handler, method, calls, errors) for (handler, method), (calls, errors) in self._pairs.items()),
+                      key=lambda item: item[2], reverse=True)[:limit]
+
+    def handlers(self) -> List[Tuple[str, int, int]]:
+        """Обработчики с количеством апдейтов и вызовов за время апдейта."""
+        return sorted(((name, updates, calls) for name, (updates, calls) in self._handlers.items()),
+                      key=lambda item: item[2], reverse=True)
+
+
+api_accounting = ApiAccounting()
+add_finish_listener(api_accounting.update_finished)
+
+
+class ApiAccountingMiddleware(BaseRequestMiddleware):
+    """
+    Middleware сессии бота: учет каждого вызова Bot API и время вызова в трейсе апдейта.
+
+    Задачи, запущенные обработчиком, наследуют его трейс, а длительные задачи
+    (анимации) — только имя обработчика, поэтому их вызовы тоже учитываются
+    под этим именем.
+    """
+
+    async def __call__(self, make_request, bot: Bot, method):
+        name = method.__api_method__
+        trace = current_trace.get()
+        handler = trace.handler if trace is not None else current_handler.get() or BACKGROUND
+        started = time.perf_counter()
+        error = None
+        try:
+            return await make_request(bot, method)
+        except TelegramAPIError as e:
+            error = e
+            raise
+        finally:
+            seconds = time.perf_counter() - started
+            record_api(name, seconds)
+            api_accounting.record(name, handler, seconds, error)
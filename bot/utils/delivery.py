@@ -0,0 +1,66 @@
+from typing import Optional
+
+from aiogram.exceptions import TelegramBadRequest, TelegramForbiddenError, TelegramNotFound
+
+# Причины, по которым пользователю больше нельзя доставить сообщение
+UNREACHABLE_BLOCKED = "blocked"
+UNREACHABLE_DEACTIVATED = "deactivated"
+UNREACHABLE_CHAT_NOT_FOUND = "chat_not_found"
+
+# Область постоянной ошибки длительной задачи в чате (анимации, статусы)
+TASK_FAILURE_MESSAGE = "message"        # пропало сообщение задачи, чат доступен
+TASK_FAILURE_CHAT = "chat"              # чат недоступен
+TASK_FAILURE_CONNECTION = "connection"  # бизнес-подключение недействительно
+
+_CONNECTION_ERRORS = ("business_connection_invalid", "business_connection_not_allowed",
+                      "business connection not found")
+_CHAT_ERRORS = ("business_peer_invalid", "business_peer_usage_missing", "peer_id_invalid",
+                "chat_write_forbidden", "not enough rights to send")
+_MESSAGE_ERRORS = ("message to edit not found", "message can't be edited", "message_id_invalid")
+
+
+def classify_delivery_error(error: BaseException) -> Optional[str]:
+    """
+    Определить, означает ли ошибка отправки, что пользователь недоступен.
+
+    Временные ошибки (лимиты, сеть) и запреты, не связанные с пользователем
+    (например, бота исключили из канала), не считаются недоступностью: для них
+    возвращается None, и пользователь остается в рассылках.
+
+    :param error: Исключение, полученное при отправке сообщения.
+    :return: UNREACHABLE_* или None.
+    """
+    message = str(error).lower()
+    if isinstance(error, TelegramForbiddenError):
+        if "user is deactivated" in message:
+            return UNREACHABLE_DEACTIVATED
+        if "blocked by the user" in message or "can't initiate conversation" in message:
+            return UNREACHABLE_BLOCKED
+        return None
+    if isinstance(error, TelegramBadRequest) and "chat not found" in message:
+        return UNREACHABLE_CHAT_NOT_FOUND
+    return None
+
+
+def classify_task_error(error: BaseException) -> Optional[str]:
+    """
+    Определить, имеет ли смысл длительной задаче в чате повторять вызов после ошибки.
+
+    Лимиты, сетевые ошибки и ошибки сервера Telegram временные — для них
+    возвращается None. Постоянные ошибки возвращаются с областью: дальше
+    нельзя работать с сообщением, с чатом или со всем бизнес-подключением.
+
+    :param error: Исключение, полученное при вызове Bot API.
+    :return: TASK_FAILURE_* или None.
+    """
+    if not isinstance(error, (TelegramBadRequest, TelegramForbiddenError, TelegramNotFound)):
+        return None
+    message = str(error).lower()
+    if any(marker in message for marker in _CONNECTION_ERRORS):
+        return TASK_FAILURE_CONNECTION
+    if (isinstance(error, TelegramForbiddenError) or classify_delivery_error(error)
+            or any(marker in message for marker in _CHAT_ERRORS)):
+        return TASK_FAILURE_CHAT
+    if any(marker in message for marker in _MESSAGE_ERRORS):
+        return TASK_FAILURE_MESSAGE
+    return None
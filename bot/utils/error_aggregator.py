@@ -0,0 +1,134 @@
+import logging
+import re
+import threading
+import time
+from collections import OrderedDict
+from dataclasses import dataclass
+from datetime import datetime
+from typing import List
+
+# Сколько различных ошибок хранится в памяти для /logs
+ERROR_BUFFER_SIZE = 200
+
+# Одинаковая ошибка пишется в файл не чаще, чем раз в ERROR_REPEAT_INTERVAL секунд
+ERROR_REPEAT_INTERVAL = 60.0
+
+# Числа, hex-идентификаторы и строки в кавычках отличаются от вызова к вызову
+# (ID чатов, секунды до снятия лимита), но не меняют сути ошибки
+_VARIABLE_PARTS = re.compile(r"0x[0-9a-fA-F]+|\d+|'[^']*'|\"[^\"]*\"")
+
+
+def fingerprint(record: logging.LogRecord) -> str:
+    """
+    Отпечаток ошибки: логгер, уровень, тип исключения и текст без переменных частей.
+
+    :param record: Запись лога.
+    :return: Строка, одинаковая для повторов одной и той же ошибки.
+    """
+    message = _VARIABLE_PARTS.sub("#", record.getMessage())
+    exc_type = record.exc_info[0].__name__ if record.exc_info and record.exc_info[0] else ""
+    return f"{record.name}|{record.levelname}|{exc_type}|{message}"
+
+
+@dataclass
+class ErrorGroup:
+    """Одна ошибка и все ее повторы."""
+    fingerprint: str
+    logger: str
+    level: str
+    # Текст последнего повтора: в нем видны актуальные ID и значения
+    message: str
+    count: int
+    first_seen: datetime
+    last_seen: datetime
+
+
+class ErrorAggregator(logging.Handler):
+    """
+    Обработчик логов, который группирует ошибки по отпечатку.
+
+    Для каждой группы хранятся количество повторов и время первого и последнего
+    появления. Группы лежат в кольцевом буфере: последняя сработавшая ошибка
+    в конце, а при переполнении вытесняется та, что давно не повторялась.
+    """
+
+    def __init__(self, capacity: int = ERROR_BUFFER_SIZE, level: int = logging.ERROR):
+        super().__init__(level)
+        self._capacity = capacity
+        self._groups: "OrderedDict[str, ErrorGroup]" = OrderedDict()
+        self.total = 0
+
+    def emit(self, record: logging.LogRecord):
+        # Handler.handle уже держит self.lock, поэтому записи из потоков безопасны
+        key = fingerprint(record)
+        now = datetime.fromtimestamp(record.created)
+        message = record.getMessage()
+        group = self._groups.get(key)
+        if group is None:
+            group = ErrorGroup(key, record.name, record.levelname, message, 0, now, now)
+            self._groups[key] = group
+            if len(self._groups) > self._capacity:
+                self._groups.popitem(last=False)
+        else:
+            self._groups.move_to_end(key)
+            group.message = message
+            group.last_seen = now
+        group.count += 1
+        self.total += 1
+
+    def recent(self, limit: int = 20) -> List[ErrorGroup]:
+        """
+        Последние различные ошибки, от свежих к старым.
+
+        :param limit: Максимальное количество групп.
+        """
+        with self.lock:
+            groups = list(self._groups.values())[-limit:]
+        return groups[::-1]
+
+    def clear(self):
+        with self.lock:
+            self._groups.clear()
+            self.total = 0
+
+
+class RateLimitFilter(logging.Filter):
+    """
+    Фильтр для файлового обработчика: пропускает одинаковые ошибки не чаще,
+    чем раз в interval секунд. Записи ниже level проходят без ограничений.
+
+    Пропущенные повторы не теряются бесследно: следующая записанная копия
+    получает атрибут repeated с их количеством (для форматтера), а точные
+    счетчики есть в ErrorAggregator.
+    """
+
+    def __init__(self, interval: float = ERROR_REPEAT_INTERVAL, capacity: int = ERROR_BUFFER_SIZE,
+                 level: int = logging.ERROR):
+        super().__init__()
+        self._interval = interval
+        self._level = level
+        self._capacity = capacity
+        # отпечаток -> [время последней записи, пропущено с тех пор]
+        self._seen: "OrderedDict[str, list]" = OrderedDict()
+        self._lock = threading.Lock()
+
+    def filter(self, record: logging.LogRecord) -> bool:
+        if record.levelno < self._level:
+            return True
+        key = fingerprint(record)
+        now = time.monotonic()
+        with self._lock:
+            state = self._seen.get(key)
+            if state is not None and now - state[0] < self._interval:
+                state[1] += 1
+                return False
+            suppressed = state[1] if state is not None else 0
+            self._seen[key] = [now, 0]
+            self._seen.move_to_end(key)
+            if len(self._seen) > self._capacity:
+                self._seen.popitem(last=False)
+        record.repeated = suppressed
+        return True
+
+
+error_aggregator = ErrorAggregator()
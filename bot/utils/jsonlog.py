@@ -0,0 +1,353 @@
+"""
+Структурированные логи в формате JSONL со сжатой ротацией и поиском.
+
+Каждая запись — одна JSON-строка. Файл ротируется по времени, закрытые файлы
+сжимаются gzip в фоновом потоке. Сжатие идет блоками: каждый блок — отдельный
+gzip-член (multi-member gzip), а рядом кладется индекс .idx со смещениями блоков,
+диапазоном времени, максимальным уровнем и модулями внутри блока. По индексу
+поиск распаковывает только подходящие блоки, а не файл целиком.
+
+Поиск: python -m bot.utils.jsonlog query --level ERROR --module business --user 123 --since 2025-02-12T04:00
+"""
+import argparse
+import gzip
+import json
+import logging
+import os
+import re
+import sys
+import threading
+import traceback
+import zlib
+from datetime import datetime
+from logging.handlers import TimedRotatingFileHandler
+from pathlib import Path
+from typing import Any, Dict, Iterator, List, Optional
+
+LOG_DIR = Path("logs")
+LOG_FILE = "bot.jsonl"
+# Ротация в полночь, хранится месяц сжатых файлов
+LOG_RETENTION_DAYS = 30
+# Минимальный уровень записей в файле; по умолчанию только предупреждения и ошибки
+LOG_FILE_LEVEL = os.getenv("LOG_FILE_LEVEL", "WARNING").upper()
+
+# Размер несжатого блока; чем меньше блок, тем точнее поиск, но хуже сжатие
+INDEX_BLOCK_SIZE = 256 * 1024
+INDEX_VERSION = 1
+
+_NUMBER = re.compile(r"\d+")
+
+
+def _level_number(name: str) -> int:
+    level = logging.getLevelName(name)
+    return level if isinstance(level, int) else 0
+
+
+class JsonFormatter(logging.Formatter):
+    """
+    Форматирует запись в одну JSON-строку.
+
+    Поля: ts, level, logger, module, message; при наличии — user_id (из extra),
+    repeated (пропущенные повторы от RateLimitFilter) и exc (трассировка).
+    """
+
+    def format(self, record: logging.LogRecord) -> str:
+        entry: Dict[str, Any] = {
+            "ts": datetime.fromtimestamp(record.created).isoformat(timespec="milliseconds"),
+            "level": record.levelname,
+            "logger": record.name,
+            "module": record.module,
+            "message": record.getMessage(),
+        }
+        user_id = getattr(record, "user_id", None)
+        if user_id is not None:
+            entry["user_id"] = user_id
+        repeated = getattr(record, "repeated", 0)
+        if repeated:
+            entry["repeated"] = repeated
+        if record.exc_info:
+            entry["exc"] = "".join(traceback.format_exception(*record.exc_info)).rstrip()
+        if record.stack_info:
+            entry["stack"] = record.stack_info
+        return json.dumps(entry, ensure_ascii=False)
+
+
+def _index_path(path: Path) -> Path:
+    return path.with_name(path.name + ".idx")
+
+
+class _BlockStats:
+    """Сводка по блоку для индекса."""
+
+    def __init__(self):
+        self.first_ts: Optional[str] = None
+        self.last_ts: Optional[str] = None
+        self.max_level = 0
+        self.modules = set()
+
+    def add(self, line: bytes):
+        try:
+            entry = json.loads(line)
+        except ValueError:
+            return
+        ts = entry.get("ts")
+        if ts:
+            self.first_ts = ts if self.first_ts is None else min(self.first_ts, ts)
+            self.last_ts = ts if self.last_ts is None else max(self.last_ts, ts)
+        self.max_level = max(self.max_level, _level_number(entry.get("level", "")))
+        if entry.get("module"):
+            self.modules.add(entry["module"])
+
+    def to_json(self, offset: int, length: int) -> Dict[str, Any]:
+        return {"offset": offset, "length": length, "first_ts": self.first_ts, "last_ts": self.last_ts,
+                "max_level": self.max_level, "modules": sorted(self.modules)}
+
+
+def _write_index(path: Path, blocks: List[Dict[str, Any]]):
+    tmp_path = _index_path(path).with_suffix(".idx.tmp")
+    with open(tmp_path, "w", encoding="utf-8") as f:
+        json.dump({"version": INDEX_VERSION, "blocks": blocks}, f)
+    tmp_path.replace(_index_path(path))
+
+
+def compress_log(source: Path, target: Path, block_size: int = INDEX_BLOCK_SIZE):
+    """
+    Сжать JSONL-файл блоками в multi-member gzip и записать индекс.
+
+    :param source: Несжатый файл; удаляется после успешного сжатия.
+    :param target: Путь к сжатому файлу.
+    :param block_size: Размер несжатого блока в байтах.
+    """
+    blocks = []
+    tmp_target = target.with_name(target.name + ".tmp")
+    with open(source, "rb") as src, open(tmp_target, "wb") as dst:
+        while True:
+            # Блок заканчивается на границе строки, чтобы каждую можно было читать отдельно
+            data = src.read(block_size)
+            if not data:
+                break
+            if not data.endswith(b"\n"):
+                data += src.readline()
+            stats = _BlockStats()
+            for line in data.splitlines():
+                stats.add(line)
+            offset = dst.tell()
+            dst.write(gzip.compress(data, compresslevel=6))
+            blocks.append(stats.to_json(offset, dst.tell() - offset))
+    tmp_target.replace(target)
+    _write_index(target, blocks)
+    source.unlink()
+
+
+def build_index(path: Path) -> List[Dict[str, Any]]:
+    """
+    Построить индекс для сжатого файла без него (например, сжатого вручную).
+
+    Границы gzip-членов находятся по unused_data распаковщика, поэтому файл
+    читается один раз; у файла из одного члена получится один блок.
+    """
+    blocks = []
+    with open(path, "rb") as f:
+        data = f.read()
+    offset = 0
+    while offset < len(data):
+        decompressor = zlib.decompressobj(wbits=31)
+        chunk = decompressor.decompress(data[offset:])
+        length = len(data) - offset - len(decompressor.unused_data)
+        stats = _BlockStats()
+        for line in chunk.splitlines():
+            stats.add(line)
+        blocks.append(stats.to_json(offset, length))
+        offset += length
+    _write_index(path, blocks)
+    return blocks
+
+
+def load_index(path: Path) -> List[Dict[str, Any]]:
+    """Индекс блоков сжатого файла; при отсутствии или устаревшем формате строится заново."""
+    index_path = _index_path(path)
+    if index_path.exists() and index_path.stat().st_mtime >= path.stat().st_mtime:
+        try:
+            with open(index_path, encoding="utf-8") as f:
+                index = json.load(f)
+            if index.get("version") == INDEX_VERSION:
+                return index["blocks"]
+        except ValueError:
+            pass
+    return build_index(path)
+
+
+class CompressedTimedRotatingFileHandler(TimedRotatingFileHandler):
+    """
+    TimedRotatingFileHandler, который сжимает закрытые файлы в фоне.
+
+    При ротации файл только переименовывается, а сжатие и индексирование
+    выполняются в отдельном потоке, чтобы не задерживать логирующий код
+    (а значит, и event loop). Хранятся backupCount последних сжатых файлов.
+    """
+
+    def __init__(self, filename: Path, when: str = "midnight", backup_count: int = LOG_RETENTION_DAYS,
+                 block_size: int = INDEX_BLOCK_SIZE):
+        Path(filename).parent.mkdir(parents=True, exist_ok=True)
+        super().__init__(filename, when=when, backupCount=backup_count, encoding="utf-8")
+        self._block_size = block_size
+        self.namer = lambda name: name + ".gz"
+        self.rotator = self._rotate
+        # Файлы, которые не успели сжать до остановки бота
+        base = Path(self.baseFilename)
+        for raw in base.parent.glob(f"{base.name}.*.raw"):
+            self._start_compression(raw, raw.with_suffix(".gz"))
+
+    def _rotate(self, source: str, dest: str):
+        raw = Path(dest).with_suffix(".raw")
+        os.replace(source, raw)
+        self._start_compression(raw, Path(dest))
+
+    def _start_compression(self, raw: Path, dest: Path):
+        threading.Thread(target=self._compress, args=(raw, dest), name="log-compress", daemon=True).start()
+
+    def _compress(self, raw: Path, dest: Path):
+        try:
+            compress_log(raw, dest, self._block_size)
+            for path in self._expired_archives():
+                path.unlink(missing_ok=True)
+                _index_path(path).unlink(missing_ok=True)
+        except Exception:
+            # Сжатие не должно ронять логирование; несжатый файл остается на месте
+            print(f"Не удалось сжать лог {raw}", file=sys.stderr)
+            traceback.print_exc()
+
+    def _expired_archives(self) -> List[Path]:
+        # Рядом лежат индексы и временные файлы, поэтому считаем только сами архивы
+        base = Path(self.baseFilename)
+        archives = sorted(base.parent.glob(f"{base.name}.*.gz"))
+        return archives[:-self.backupCount] if self.backupCount > 0 else []
+
+    def getFilesToDelete(self) -> List[str]:
+        # Старые архивы удаляются после сжатия в фоновом потоке (_compress)
+        return []
+
+
+def _log_files(directory: Path, name: str = LOG_FILE) -> List[Path]:
+    """Сжатые файлы от старых к новым, затем текущий файл."""
+    files = sorted(directory.glob(f"{name}.*.gz"))
+    current = directory / name
+    if current.exists():
+        files.append(current)
+    return files
+
+
+class LogQuery:
+    """Условия поиска по логам."""
+
+    def __init__(self, level: Optional[str] = None, module: Optional[str] = None,
+                 user_id: Optional[int] = None, since: Optional[datetime] = None,
+                 until: Optional[datetime] = None):
+        self.min_level = _level_number(level.upper()) if level else 0
+        self.module = module
+        self.user_id = user_id
+        self.since = since.isoformat(timespec="milliseconds") if since else None
+        self.until = until.isoformat(timespec="milliseconds") if until else None
+
+    def block_matches(self, block: Dict[str, Any]) -> bool:
+        if block["max_level"] < self.min_level:
+            return False
+        if self.module and self.module not in block["modules"]:
+            return False
+        if self.since and block["last_ts"] and block["last_ts"] < self.since:
+            return False
+        if self.until and block["first_ts"] and block["first_ts"] > self.until:
+            return False
+        return True
+
+    def matches(self, entry: Dict[str, Any]) -> bool:
+        if _level_number(entry.get("level", "")) < self.min_level:
+            return False
+        if self.module and entry.get("module") != self.module:
+            return False
+        ts = entry.get("ts", "")
+        if self.since and ts < self.since:
+            return False
+        if self.until and ts > self.until:
+            return False
+        if self.user_id is not None and entry.get("user_id") != self.user_id:
+            # У большинства записей ID пользователя есть только в тексте
+            if str(self.user_id) not in _NUMBER.findall(entry.get("message", "")):
+                return False
+        return True
+
+
+def _parse_lines(lines: Iterator[bytes], query: LogQuery) -> Iterator[Dict[str, Any]]:
+    for line in lines:
+        try:
+            entry = json.loads(line)
+        except ValueError:
+            continue
+        if query.matches(entry):
+            yield entry
+
+
+def search(query: LogQuery, directory: Path = LOG_DIR, name: str = LOG_FILE) -> Iterator[Dict[str, Any]]:
+    """
+    Найти записи логов по условиям, от старых к новым.
+
+    В сжатых файлах по индексу читаются только блоки, которые могут содержать
+    подходящие записи; текущий несжатый файл просматривается целиком.
+    """
+    for path in _log_files(directory, name):
+        if path.suffix != ".gz":
+            with open(path, "rb") as f:
+                yield from _parse_lines(f, query)
+            continue
+        blocks = load_index(path)
+        with open(path, "rb") as f:
+            for block in blocks:
+                if not query.block_matches(block):
+                    continue
+                f.seek(block["offset"])
+                data = gzip.decompress(f.read(block["length"]))
+                yield from _parse_lines(data.splitlines(), query)
+
+
+def _format_entry(entry: Dict[str, Any]) -> str:
+    text = f"[{entry.get('ts')}] {entry.get('level')} in {entry.get('module')}: {entry.get('message')}"
+    if entry.get("repeated"):
+        text += f" (пропущено повторов: {entry['repeated']})"
+    if entry.get("exc"):
+        text += "\n" + entry["exc"]
+    return text
+
+
+def main(argv: Optional[List[str]] = None):
+    parser = argparse.ArgumentParser(description="Поиск по структурированным логам бота")
+    parser.add_argument("--dir", type=Path, default=LOG_DIR, help="Каталог логов")
+    commands = parser.add_subparsers(dest="command", required=True)
+    query = commands.add_parser("query", help="Найти записи")
+    query.add_argument("--level", help="Минимальный уровень: DEBUG, INFO, WARNING, ERROR")
+    query.add_argument("--module", help="Модуль, например business")
+    query.add_argument("--user", type=int, help="Telegram ID пользователя")
+    query.add_argument("--since", type=datetime.fromisoformat, help="Начало интервала (ISO 8601)")
+    query.add_argument("--until", type=datetime.fromisoformat, help="Конец интервала (ISO 8601)")
+    query.add_argument("--limit", type=int, default=0, help="Максимум записей (0 — без ограничения)")
+    query.add_argument("--json", action="store_true", help="Выводить исходные JSON-строки")
+    commands.add_parser("index", help="Перестроить индексы сжатых файлов")
+    args = parser.parse_args(argv)
+
+    if args.command == "index":
+        for path in _log_files(args.dir):
+            if path.suffix == ".gz":
+                print(f"{path}\tблоков: {len(build_index(path))}")
+        return
+
+    if args.level and not _level_number(args.level.upper()):
+        parser.error(f"Неизвестный уровень: {args.level}")
+    found = search(LogQuery(args.level, args.module, args.user, args.since, args.until), args.dir)
+    for count, entry in enumerate(found, 1):
+        print(json.dumps(entry, ensure_ascii=False) if args.json else _format_entry(entry))
+        if count == args.limit:
+            break
+    sys.stdout.flush()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,155 @@
+"""
+Профилировщик SQL-запросов.
+
+Слушатель after_cursor_execute (bot/database/database.py) передает сюда
+каждый выполненный запрос. Запросы сводятся к «форме» — тексту без значений,
+поэтому get_user(1) и get_user(2) считаются одним запросом. По формам ведется
+статистика времени, а по завершении апдейта проверяется, не выполнялась ли
+одна и та же форма несколько раз за апдейт (признак N+1: запрос в цикле
+вместо одного запроса на всю пачку). Отчет — команда /sqlprofile.
+"""
+import re
+from dataclasses import dataclass
+from datetime import datetime
+from functools import lru_cache
+from typing import Dict, List, Tuple
+
+from bot.utils.metrics import registry
+from bot.utils.tracing import UpdateTrace, add_finish_listener, record_db
+
+# С какого числа повторов одной формы за апдейт он попадает в отчет
+REPEAT_THRESHOLD = 3
+
+# Ограничение числа хранимых форм: остальные учитываются одной строкой
+MAX_STATEMENTS = 500
+OTHER_STATEMENTS = "<прочие запросы>"
+
+# Литералы и списки параметров IN (...) разной длины не меняют форму запроса
+_LITERALS = re.compile(r"'(?:[^']|'')*'|\b\d+(?:\.\d+)?\b")
+_PARAMETER_LISTS = re.compile(r"\(\s*\?(?:\s*,\s*\?)+\s*\)")
+_WHITESPACE = re.compile(r"\s+")
+_SELECT_COLUMNS = re.compile(r"^SELECT .+? FROM ")
+
+QUERIES_PER_UPDATE = registry.histogram(
+    "bot_db_queries_per_update", "Количество SQL-запросов за один апдейт", ["handler"],
+    buckets=(0, 1, 2, 3, 5, 10, 20, 50, 100),
+)
+REPEATED_STATEMENTS = registry.counter(
+    "bot_db_repeated_statements_total",
+    "Апдейты, в которых одна форма запроса выполнена не меньше REPEAT_THRESHOLD раз", ["handler"],
+)
+
+
+@lru_cache(maxsize=1024)
+def statement_shape(statement: str) -> str:
+    """
+    Форма запроса: текст без значений и с одним плейсхолдером вместо списка.
+
+    SQLAlchemy передает курсору одни и те же строки из кэша компиляции,
+    поэтому результат кэшируется по тексту запроса.
+    """
+    shape = _WHITESPACE.sub(" ", statement).strip()
+    shape = _LITERALS.sub("?", shape)
+    return _PARAMETER_LISTS.sub("(?, …)", shape)
+
+
+def display_shape(shape: str) -> str:
+    """Форма запроса для отчета: длинный список колонок SELECT заменяется многоточием."""
+    return _SELECT_COLUMNS.sub("SELECT … FROM ", shape, count=1)
+
+
+@dataclass
+class StatementStats:
+    """Накопленная статистика одной формы запроса."""
+    shape: str
+    count: int = 0
+    total_seconds: float = 0.0
+    max_seconds: float = 0.0
+
+
+@dataclass
+class RepeatIncident:
+    """Повторяющийся запрос внутри апдейтов одного обработчика."""
+    handler: str
+    shape: str
+    updates: int
+    max_repeats: int
+    last_seen: datetime
+
+
+class SqlProfiler:
+    """Статистика запросов по формам и поиск повторов внутри апдейта."""
+
+    def __init__(self, repeat_threshold: int = REPEAT_THRESHOLD, max_statements: int = MAX_STATEMENTS):
+        self.repeat_threshold = repeat_threshold
+        self.max_statements = max_statements
+        self.reset()
+
+    def reset(self):
+        """Сбросить накопленную статистику."""
+        self.started = datetime.now()
+        self._statements: Dict[str, StatementStats] = {}
+        self._incidents: Dict[Tuple[str, str], RepeatIncident] = {}
+        # обработчик -> [апдейтов, запросов]
+        self._handlers: Dict[str, List[int]] = {}
+
+    def record(self, statement: str, seconds: float):
+        """
+        Учесть выполненный запрос.
+
+        :param statement: Текст запроса, переданный курсору.
+        :param seconds: Длительность выполнения.
+        """
+        shape = statement_shape(statement)
+        stats = self._statements.get(shape)
+        if stats is None:
+            if len(self._statements) >= self.max_statements:
+                shape = OTHER_STATEMENTS
+                stats = self._statements.get(shape)
+            if stats is None:
+                stats = self._statements[shape] = StatementStats(shape)
+        stats.count += 1
+        stats.total_seconds += seconds
+        stats.max_seconds = max(stats.max_seconds, seconds)
+        record_db(seconds, shape)
+
+    def update_finished(self, trace: UpdateTrace, total: float):
+        """Слушатель завершения апдейта: число запросов и повторы форм."""
+        QUERIES_PER_UPDATE.observe(trace.db_queries, handler=trace.handler)
+        handler_stats = self._handlers.setdefault(trace.handler, [0, 0])
+        handler_stats[0] += 1
+        handler_stats[1] += trace.db_queries
+
+        repeated = False
+        for shape, repeats in trace.db_statements.items():
+            if repeats < self.repeat_threshold or shape == OTHER_STATEMENTS:
+                continue
+            repeated = True
+            key = (trace.handler, shape)
+            incident = self._incidents.get(key)
+            if incident is None:
+                self._incidents[key] = RepeatIncident(trace.handler, shape, 1, repeats, datetime.now())
+            else:
+                incident.updates += 1
+                incident.max_repeats = max(incident.max_repeats, repeats)
+                incident.last_seen = datetime.now()
+        if repeated:
+            REPEATED_STATEMENTS.inc(handler=trace.handler)
+
+    def top_statements(self, limit: int = 10) -> List[StatementStats]:
+        """Формы запросов с наибольшим суммарным временем."""
+        return sorted(self._statements.values(), key=lambda stats: stats.total_seconds, reverse=True)[:limit]
+
+    def repeats(self, limit: int = 10) -> List[RepeatIncident]:
+        """Повторяющиеся запросы, начиная с самых частых."""
+        return sorted(self._incidents.values(),
+                      key=lambda incident: (incident.updates, incident.max_repeats), reverse=True)[:limit]
+
+    def handlers(self) -> List[Tuple[str, int, int]]:
+        """Обработчики с количеством апдейтов и запросов, от самых «тяжелых» по запросам."""
+        return sorted(((name, updates, queries) for name, (updates, queries) in self._handlers.items()),
+                      key=lambda item: item[2], reverse=True)
+
+
+sql_profiler = SqlProfiler()
+add_finish_listener(sql_profiler.update_finished)
@@ -0,0 +1,202 @@
+"""
+Трассировка обработки апдейтов: сколько времени занял обработчик и из чего
+сложилось это время.
+
+На каждый апдейт заводится UpdateTrace в контекстной переменной. Слушатели
+курсора SQLAlchemy (bot/database/database.py) и middleware сессии бота
+добавляют в нее время запросов к базе и вызовов Bot API; задачи, созданные
+обработчиком, наследуют контекст и пишут в тот же трейс, а длительные
+задачи получают контекст без трейса (detached_context). Апдейты дольше
+SLOW_UPDATE_THRESHOLD секунд попадают в лог медленных апдейтов с разбивкой
+«база / Bot API / собственное время».
+"""
+import logging
+import os
+import time
+from contextvars import Context, ContextVar, copy_context
+from dataclasses import dataclass, field
+from typing import Callable, Dict, List, Optional
+
+from aiogram import BaseMiddleware, Bot, Dispatcher
+from aiogram.types.update import UpdateTypeLookupError
+
+from bot.utils.metrics import registry
+
+# Настройка логирования
+logger = logging.getLogger(__name__)
+# Отдельный логгер, чтобы медленные апдейты можно было отфильтровать в JSONL-логе
+# (python -m bot.utils.jsonlog query --module tracing)
+slow_logger = logging.getLogger("bot.slow_updates")
+
+# Порог медленного апдейта в секундах
+SLOW_UPDATE_THRESHOLD = float(os.getenv("SLOW_UPDATE_THRESHOLD", "1.0"))
+
+# Имя обработчика, если апдейт не подошел ни под один фильтр
+UNHANDLED = "unhandled"
+
+UPDATE_SECONDS = registry.histogram(
+    "bot_update_seconds", "Длительность обработки апдейта целиком", ["type"]
+)
+HANDLER_SECONDS = registry.histogram(
+    "bot_handler_seconds", "Длительность обработчика апдейта", ["handler"]
+)
+SLOW_UPDATES = registry.counter(
+    "bot_slow_updates_total", "Апдейты дольше порога SLOW_UPDATE_THRESHOLD", ["handler"]
+)
+
+
+@dataclass
+class UpdateTrace:
+    """Время, потраченное на один апдейт, по составляющим."""
+    update_id: int
+    update_type: str
+    started: float = field(default_factory=time.perf_counter)
+    handler: str = UNHANDLED
+    user_id: Optional[int] = None
+    db_seconds: float = 0.0
+    db_queries: int = 0
+    api_seconds: float = 0.0
+    api_calls: int = 0
+    # метод Bot API -> [количество вызовов, суммарное время]
+    api_methods: Dict[str, List[float]] = field(default_factory=dict)
+    # форма SQL-запроса -> сколько раз он выполнен за апдейт
+    db_statements: Dict[str, int] = field(default_factory=dict)
+
+    def breakdown(self, total: float) -> str:
+        """Текст разбивки для лога медленных апдейтов."""
+        # Запросы из параллельных задач могут перекрываться, поэтому остаток не меньше нуля
+        own = max(total - self.db_seconds - self.api_seconds, 0.0)
+        methods = ", ".join(
+            f"{method}×{int(count)} {seconds:.3f} с"
+            for method, (count, seconds) in sorted(self.api_methods.items(), key=lambda item: -item[1][1])
+        )
+        return (
+            f"{self.handler} ({self.update_type}, update_id={self.update_id}, user={self.user_id}): "
+            f"всего {total:.3f} с — база {self.db_seconds:.3f} с / {self.db_queries} запр., "
+            f"Bot API {self.api_seconds:.3f} с / {self.api_calls} выз."
+            f"{f' ({methods})' if methods else ''}, собственное {own:.3f} с"
+        )
+
+
+current_trace: ContextVar[Optional[UpdateTrace]] = ContextVar("current_trace", default=None)
+# Обработчик, запустивший длительную задачу (анимацию): ее вызовы учитываются под
+# его именем, но в трейс давно завершенного апдейта уже не пишутся
+current_handler: ContextVar[Optional[str]] = ContextVar("current_handler", default=None)
+
+# Слушатели завершения апдейта: вызываются с трейсом и полной длительностью
+_finish_listeners: List[Callable[[UpdateTrace, float], None]] = []
+
+
+def add_finish_listener(listener: Callable[[UpdateTrace, float], None]):
+    """Подписаться на завершение обработки каждого апдейта."""
+    _finish_listeners.append(listener)
+
+
+def record_db(seconds: float, shape: Optional[str] = None):
+    """
+    Учесть запрос к базе в трейсе текущего апдейта (вне апдейта ничего не делает).
+
+    :param seconds: Длительность запроса.
+    :param shape: Форма запроса для поиска повторов (см. bot/utils/sqlprofile.py).
+    """
+    trace = current_trace.get()
+    if trace is not None:
+        trace.db_seconds += seconds
+        trace.db_queries += 1
+        if shape is not None:
+            trace.db_statements[shape] = trace.db_statements.get(shape, 0) + 1
+
+
+def record_api(method: str, seconds: float):
+    """Учесть вызов Bot API в трейсе текущего апдейта (вне апдейта ничего не делает)."""
+    trace = current_trace.get()
+    if trace is not None:
+        trace.api_seconds += seconds
+        trace.api_calls += 1
+        stats = trace.api_methods.setdefault(method, [0, 0.0])
+        stats[0] += 1
+        stats[1] += seconds
+
+
+def detached_context() -> Context:
+    """
+    Копия текущего контекста для задачи, которая переживет апдейт.
+
+    Трейс апдейта в копию не попадает (иначе задача держала бы его и дописывала
+    в него после записи в лог), остается только имя обработчика.
+    """
+    trace = current_trace.get()
+    context = copy_context()
+    context.run(current_trace.set, None)
+    if trace is not None:
+        context.run(current_handler.set, trace.handler)
+    return context
+
+
+class UpdateTraceMiddleware(BaseMiddleware):
+    """
+    Внешний middleware апдейтов: заводит трейс, замеряет апдейт целиком
+    и пишет медленные апдейты в лог.
+    """
+
+    def __init__(self, threshold: float = SLOW_UPDATE_THRESHOLD):
+        self.threshold = threshold
+
+    async def __call__(self, handler, event, data: dict):
+        try:
+            update_type = event.event_type
+        except UpdateTypeLookupError:
+            update_type = "unknown"
+        trace = UpdateTrace(event.update_id, update_type)
+        token = current_trace.set(trace)
+        try:
+            return await handler(event, data)
+        finally:
+            current_trace.reset(token)
+            total = time.perf_counter() - trace.started
+            UPDATE_SECONDS.observe(total, type=trace.update_type)
+            if total >= self.threshold:
+                SLOW_UPDATES.inc(handler=trace.handler)
+                slow_logger.warning(f"🐢 Медленный апдейт: {trace.breakdown(total)}",
+                                    extra={"user_id": trace.user_id})
+            for listener in _finish_listeners:
+                try:
+                    listener(trace, total)
+                except Exception as e:
+                    logger.error(f"❌ Ошибка слушателя завершения апдейта: {e}")
+
+
+class HandlerTimingMiddleware(BaseMiddleware):
+    """
+    Внутренний middleware событий: вызывается только для обработчика, прошедшего
+    фильтры, поэтому знает его имя.
+    """
+
+    async def __call__(self, handler, event, data: dict):
+        name = data["handler"].callback.__name__
+        user = data.get("event_from_user")
+        trace = current_trace.get()
+        if trace is not None:
+            trace.handler = name
+            trace.user_id = user.id if user else None
+        with HANDLER_SECONDS.time(handler=name):
+            return await handler(event, data)
+
+
+def setup_tracing(dp: Dispatcher, bot: Bot, threshold: float = SLOW_UPDATE_THRESHOLD):
+    """
+    Подключить трассировку к диспетчеру и учет вызовов Bot API к сессии бота.
+
+    :param threshold: Порог медленного апдейта в секундах.
+    """
+    # Импорт здесь: модуль учета вызовов сам зависит от трейса апдейта
+    from bot.utils.api_stats import ApiAccountingMiddleware
+
+    dp.update.outer_middleware(UpdateTraceMiddleware(threshold))
+    # Внутренние middleware диспетчера применяются к обработчикам всех вложенных роутеров
+    timing = HandlerTimingMiddleware()
+    for name, observer in dp.observers.items():
+        if name not in ("update", "error"):
+            observer.middleware(timing)
+    bot.session.middleware(ApiAccountingMiddleware())
+    logger.info(f"Трассировка апдейтов включена, порог медленного апдейта {threshold} с")
@@ -5,19 +5,17 @@ import colorlog
 import traceback
 import sys
 from datetime import datetime
-from logging.handlers import RotatingFileHandler
-
-# Настройка основного логгера для записи в файл
-file_handler = RotatingFileHandler(
-    'errors.log',
-    maxBytes=1024 * 1024,  # 1MB
-    backupCount=5,
-    encoding='utf-8'
-)
-file_handler.setFormatter(logging.Formatter(
-    '[%(asctime)s] %(levelname)s in %(module)s: %(message)s\nStack trace:\n%(stack_info)s\n'
-))
-file_handler.setLevel(logging.ERROR)
+
+from bot.utils.error_aggregator import error_aggregator, RateLimitFilter
+from bot.utils.jsonlog import CompressedTimedRotatingFileHandler, JsonFormatter, LOG_DIR, LOG_FILE, LOG_FILE_LEVEL
+
+# Структурированный лог в logs/bot.jsonl: ротация в полночь, старые дни сжимаются
+# и индексируются для поиска (python -m bot.utils.jsonlog query ...)
+file_handler = CompressedTimedRotatingFileHandler(LOG_DIR / LOG_FILE)
+file_handler.setFormatter(JsonFormatter())
+file_handler.setLevel(LOG_FILE_LEVEL)
+# Повторы одной и той же ошибки не забивают файл: их счетчики ведет error_aggregator
+file_handler.addFilter(RateLimitFilter())
 
 # Настройка перехватчика необработанных исключений
 def handle_exception(exc_type, exc_value, exc_traceback):
@@ -67,16 +65,21 @@ bot_logger.addHandler(bot_handler)
 bot_logger.setLevel(logging.INFO)
 bot_logger.propagate = False
 bot_logger.addHandler(file_handler)
+bot_logger.addHandler(error_aggregator)
 
 user_logger = colorlog.getLogger('user')
-user_logger.addHandler(file_handler)
 user_logger.handlers.clear()
 user_logger.addHandler(user_handler)
+user_logger.addHandler(file_handler)
 user_logger.setLevel(logging.INFO)
 user_logger.propagate = False
+user_logger.addHandler(error_aggregator)
 
-# Отключаем логи aiogram
+# Отключаем логи aiogram; ошибки обработчиков из aiogram все равно попадают в /logs
 logging.getLogger('aiogram').propagate = False
+logging.getLogger('aiogram').addHandler(error_aggregator)
+logging.getLogger().addHandler(error_aggregator)
+logging.getLogger().addHandler(file_handler)
 
 from aiogram import Bot, Dispatcher
 from aiogram.enums import ParseMode
@@ -87,7 +90,16 @@ from apscheduler.schedulers.asyncio import AsyncIOScheduler
 from bot.handlers.user import user_router
 from bot.handlers.business import business_router
 from bot.handlers.admin import admin_router
-from bot.database.database import init_db, delete_expired_subscriptions, migrate_db
+from bot.database.database import init_db, reconcile_stats_rollup, downsample_activity, drop_old_message_partitions
+from bot.services.activity import activity_buffer
+from bot.services.expiry import expiry_engine
+from bot.services.entitlements import entitlements
+from bot.services.backup import create_backup
+from bot.services.broadcast import broadcast_engine
+from bot.services.animations import animation_engine
+from bot.services.tasks import task_registry
+from bot.utils.metrics import start_metrics_server
+from bot.utils.tracing import setup_tracing
 from config import BOT_TOKEN
 
 # Инициализация бота
@@ -101,20 +113,38 @@ async def main():
     for router in [user_router, business_router, admin_router]:
         dp.include_router(router)
 
-    # Сначала создаем базу данных
+    # Время обработчиков в метриках и лог медленных апдейтов (порог SLOW_UPDATE_THRESHOLD)
+    setup_tracing(dp, bot)
+
+    # Подготавливаем базу данных (на актуальной схеме — одно чтение версии)
     try:
         await init_db()
-        bot_logger.info("✅ База данных успешно создана")
-        # Только потом делаем миграцию
-        await migrate_db()
-        bot_logger.info("✅ Миграция успешно выполнена")
+        bot_logger.info("✅ База данных готова к работе")
     except Exception as e:
         bot_logger.error(f"❌ Ошибка при инициализации базы данных: {e}")
         raise
 
+    # Кэш подписок для горячего пути и движок окончания подписок
+    await entitlements.start()
+    await expiry_engine.start(bot)
+    # Рассылки, прерванные перезапуском, продолжаются с сохраненного места
+    await broadcast_engine.start(bot)
+    # Задачи в чатах (pin, онлайн-статус) продолжаются после перезапуска и
+    # останавливаются, когда у владельца заканчивается подписка
+    await task_registry.resume(bot)
+    expirations_task = asyncio.create_task(task_registry.watch_expirations())
+
     # Запуск планировщика
     scheduler = AsyncIOScheduler()
-    scheduler.add_job(delete_expired_subscriptions, 'interval', hours=1)
+    # Периодическая сверка сводной статистики с исходными таблицами
+    scheduler.add_job(reconcile_stats_rollup, 'interval', hours=24)
+    # Временные ряды активности: пакетная запись буфера и прореживание старых интервалов
+    scheduler.add_job(activity_buffer.flush, 'interval', minutes=1)
+    scheduler.add_job(downsample_activity, 'interval', hours=24)
+    # Сообщения старше срока хранения удаляются целыми помесячными партициями
+    scheduler.add_job(drop_old_message_partitions, 'interval', hours=24)
+    # Онлайн-резервная копия базы без остановки бота
+    scheduler.add_job(create_backup, 'interval', hours=24)
     
     # Добавляем задачу отправки статистики каждые 30 минут
     from bot.handlers.admin import send_stats_message
@@ -122,9 +152,28 @@ async def main():
     
     scheduler.start()
 
+    # Метрики в формате Prometheus на localhost (METRICS_PORT=0 — отключить)
+    try:
+        metrics_runner = await start_metrics_server()
+    except OSError as e:
+        metrics_runner = None
+        bot_logger.error(f"❌ Не удалось запустить эндпоинт метрик: {e}")
+
     # Запуск бота
     await bot(DeleteWebhook(drop_pending_updates=True))
-    await dp.start_polling(bot)
+    try:
+        await dp.start_polling(bot)
+    finally:
+        if metrics_runner:
+            await metrics_runner.cleanup()
+        expirations_task.cancel()
+        await asyncio.gather(expirations_task, return_exceptions=True)
+        await expiry_engine.stop()
+        await broadcast_engine.stop()
+        await task_registry.stop()
+        await animation_engine.stop()
+        # Не теряем накопленные события активности при остановке
+        await activity_buffer.flush()
 
 if __name__ == '__main__':
     try: